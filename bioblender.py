@@ -151,7 +151,13 @@ class Bioblender:
          can_skip = True,
          speed = 1)
 
-      if not prog.program():
+      programmed = prog.program()
+
+      # The combined file was only wanted for this.
+      if os.path.exists(filename):
+         os.remove(filename)
+
+      if not programmed:
          draw.message('Something went wrong while programming the CPU.', colors = 10)
          return False
 
@@ -167,9 +173,9 @@ class Bioblender:
       ignore = ['*.pyc', 'finalize.sh', 'install.sh', 'testing_cycle.sh',
          'old', 'buildroot']
 
-      def copy_func (s, d):
-         draw.write_output(f'Copying {s}...')
-         time.sleep(0.01)
+      def copy_func (done, total, path):
+         if path is not None:
+            draw.write_output(f'Copied {done // 1024:,}K of {total // 1024:,}K: {path}')
 
       draw.begin_output('Copying Files', rows = 24, cols = 130)
 
@@ -187,28 +193,12 @@ class Bioblender:
 
    def make_sd_card (self):
       card = sd_card.SDCardBuilder()
-      if not card.build():
-         return False
 
-      # Copy the program data from the staging directory.
-      try:
-         utils.copy_tree('./staging', card.prog_path)
-      except (IOError, OSError, PermissionError, FileNotFoundError) as e:
-         draw.message((f'Unable to copy the Bioblender software to {card.prog_path}.\n'
-            '\n'
-            f'Python says: {e}\n\n'
-            'Steven says "You should probably show me this."'),
-            colors = 10)
+      # The program data from the staging directory, belonging to root.
+      card.prog.add_tree('./staging', mode = 0o755)
+      if not card.build():
          return False
 
-      # Change ownership and permissions.
-      os.system(f'sudo chown -R root:root {card.prog_path}/*')
-      os.system(f'sudo chmod -R 755 {card.prog_path}/*')
-
-      # Again, change ownership and permissions.
-      os.system(f'sudo chown -R root:root {card.conf_path}/*')
-      os.system(f'sudo chmod -R 777 {card.conf_path}/*')
-
       # Set up the network.
       set_network(card.root_path, self.network)
 
@@ -0,0 +1,230 @@
+# What disks are attached, straight from /sys/block, /proc/self/mounts and
+# udev's database, in place of asking lsblk.
+#
+# The picture is built once and kept until something changes: any uevent
+# (a card going in or out, a new partition table, udev finishing with a
+# disk) or any change to the mount table throws it away, and the next call
+# builds it again. Without netlink it's simply rebuilt once it's older
+# than 'max_age'. Safe to call from worker threads; never touches the
+# screen.
+
+import os
+import time
+import select
+import threading
+
+import devices
+
+sector_size = 512
+
+# How long (seconds) a picture is trusted when uevents can't tell us.
+max_age = 1.0
+
+class Partition:
+   def __init__ (self, disk, name):
+      self.disk = disk
+      self.name = name
+      self.path = f'/dev/{name}'
+      base = f'/sys/block/{disk.name}/{name}'
+      self.number = int(read_attr(f'{base}/partition', 0))
+      self.start = int(read_attr(f'{base}/start', 0)) * sector_size
+      self.size = int(read_attr(f'{base}/size', 0)) * sector_size
+      self.dev_id = read_attr(f'{base}/dev')
+      self.mountpoints = []
+
+      info = udev_info(self.dev_id)
+      self.fstype = info.get('ID_FS_TYPE')
+      self.label = info.get('ID_FS_LABEL')
+      self.uuid = info.get('ID_FS_UUID')
+      self.partuuid = info.get('ID_PART_ENTRY_UUID')
+
+class Disk:
+   def __init__ (self, name):
+      self.name = name
+      self.path = f'/dev/{name}'
+      base = f'/sys/block/{name}'
+      self.size = int(read_attr(f'{base}/size', 0)) * sector_size
+      self.removable = read_attr(f'{base}/removable') == '1'
+      self.read_only = read_attr(f'{base}/ro') == '1'
+      self.dev_id = read_attr(f'{base}/dev')
+      self.mountpoints = []
+      self.is_root = False
+
+      info = udev_info(self.dev_id)
+      self.transport = transport(name, info)
+      self.hotplug = self.removable or self.transport == 'usb'
+      self.vendor = (read_attr(f'{base}/device/vendor') or info.get('ID_VENDOR') or '').strip() or None
+      self.model = (read_attr(f'{base}/device/model') or read_attr(f'{base}/device/name')
+         or info.get('ID_MODEL') or '').strip() or None
+      self.fstype = info.get('ID_FS_TYPE')
+      self.label = info.get('ID_FS_LABEL')
+      self.uuid = info.get('ID_FS_UUID')
+
+      self.partitions = sorted((Partition(self, entry.name) for entry in os.scandir(base)
+         if os.path.exists(f'{entry.path}/partition')), key = lambda part: part.number)
+
+   def all_mountpoints (self):
+      return self.mountpoints + [path for part in self.partitions for path in part.mountpoints]
+
+class Snapshot:
+   def __init__ (self):
+      self.disks = []
+      for entry in sorted(os.scandir('/sys/block'), key = lambda entry: entry.name):
+         try:
+            self.disks.append(Disk(entry.name))
+         except OSError:
+            # It went away while we were looking at it.
+            pass
+
+      self.by_path = {}
+      self.by_id = {}
+      for disk in self.disks:
+         for node in [disk] + disk.partitions:
+            self.by_path[node.path] = node
+            if node.dev_id:
+               self.by_id[node.dev_id] = node
+
+      self.read_mounts()
+      root = self.root_node()
+      if root is not None:
+         (root.disk if isinstance(root, Partition) else root).is_root = True
+
+   def read_mounts (self):
+      with open('/proc/self/mounts', 'r') as f:
+         for line in f.read().splitlines():
+            fields = line.split()
+            if len(fields) < 2 or not fields[0].startswith('/dev/'):
+               continue
+            node = self.lookup(fields[0])
+            if node is not None:
+               node.mountpoints.append(fields[1].replace('\\040', ' '))
+
+   def lookup (self, path):
+      # The disk or partition at a /dev path, whichever name it goes by.
+      node = self.by_path.get(path)
+      if node is not None:
+         return node
+      try:
+         rdev = os.stat(path).st_rdev
+      except OSError:
+         return None
+      return self.by_id.get(f'{os.major(rdev)}:{os.minor(rdev)}')
+
+   def root_node (self):
+      # Whatever '/' is on. Its st_dev says so directly, unless it's on
+      # something like btrfs or an overlay; then the kernel command line's
+      # root= has to do.
+      st_dev = os.stat('/').st_dev
+      node = self.by_id.get(f'{os.major(st_dev)}:{os.minor(st_dev)}')
+      if node is not None:
+         return node
+
+      root = kernel_root()
+      if root is None:
+         return None
+      for disk in self.disks:
+         for node in [disk] + disk.partitions:
+            names = [f'UUID={node.uuid}', f'PARTUUID={getattr(node, "partuuid", None)}']
+            if root == node.path or root in [name.lower() for name in names]:
+               return node
+      return self.lookup(root)
+
+def read_attr (path, default = None):
+   try:
+      with open(path, 'r') as f:
+         return f.read().strip()
+   except OSError:
+      return default
+
+def udev_info (dev_id):
+   # The E: (property) lines of udev's database entry for a block device.
+   info = {}
+   if not dev_id:
+      return info
+   try:
+      with open(f'/run/udev/data/b{dev_id}', 'r', errors = 'replace') as f:
+         for line in f.read().splitlines():
+            if line.startswith('E:') and '=' in line:
+               key, value = line[2:].split('=', 1)
+               info[key] = value
+   except OSError:
+      pass
+   return info
+
+def transport (name, info):
+   path = os.path.realpath(f'/sys/block/{name}')
+   if '/usb' in path or info.get('ID_BUS') == 'usb': return 'usb'
+   if name.startswith('mmcblk'): return 'mmc'
+   if name.startswith('nvme'): return 'nvme'
+   if '/ata' in path: return 'sata'
+   if '/virtual/' in path: return 'virtual'
+   return info.get('ID_BUS')
+
+cmdline_root = []
+
+def kernel_root ():
+   # root= from the kernel command line, which can't change until a reboot.
+   if not len(cmdline_root):
+      root = None
+      for arg in (read_attr('/proc/cmdline') or '').split():
+         if arg.startswith('root='):
+            root = arg[5:]
+      if root is not None and '=' in root:
+         kind, value = root.split('=', 1)
+         root = f'{kind.lower()}={value.lower()}'
+      cmdline_root.append(root)
+   return cmdline_root[0]
+
+lock = threading.Lock()
+current = None
+built = 0.0
+uevents = None
+mounts = None
+mount_poller = None
+
+def changed ():
+   # Has anything happened since the picture was built?
+   global uevents, mounts, mount_poller
+   if mount_poller is None:
+      uevents = devices.uevent_socket()
+      mounts = open('/proc/self/mounts', 'r')
+      mount_poller = select.poll()
+      mount_poller.register(mounts, select.POLLPRI | select.POLLERR)
+      return True
+
+   # Both have to be read, so neither carries a stale change over.
+   events = devices.drain(uevents, 0) if uevents is not None else 0
+   remounted = len(mount_poller.poll(0)) > 0
+   if uevents is None and time.monotonic() - built > max_age:
+      return True
+   return events > 0 or remounted
+
+def snapshot ():
+   global current, built
+   with lock:
+      if changed() or current is None:
+         current = Snapshot()
+         built = time.monotonic()
+      return current
+
+def disks ():
+   return snapshot().disks
+
+def find (path):
+   # The Disk or Partition at 'path', or None if there's no such thing.
+   return snapshot().lookup(path)
+
+def disk_of (path):
+   node = find(path)
+   return node.disk if isinstance(node, Partition) else node
+
+def is_root_device (path):
+   # Is 'path' the disk the system booted from, or one of its partitions?
+   disk = disk_of(path)
+   return disk is not None and disk.is_root
+
+def is_mounted (path):
+   node = find(path)
+   if node is None:
+      return False
+   return len(node.all_mountpoints() if isinstance(node, Disk) else node.mountpoints) > 0
@@ -0,0 +1,165 @@
+#!/usr/bin/python3 -B
+
+# Builds units from job files, with nobody at the keyboard.
+#
+#    build_cli.py job.json [more.json ...]
+#    build_cli.py - < job.json
+#
+# A job file holds one job, or a list of them. Each looks like this:
+#
+#    {
+#       "name": "Smith Farms #2",
+#       "product": "fb_2_stable_pi4",
+#       "serial": "FB123456",
+#       "options": {"num_products": 2, "tank_monitor": "Serial"},
+#       "sd_only": false,
+#       "devices": {"sd_card": "/dev/sdb", "programmer_ports": ["/dev/ttyACM1"]},
+#       "answers": [["Create an image", "N"]]
+#    }
+#
+# 'product' is a key of fuel_boss.fuel_boss_data, and 'options' are the
+# same settings its build menu changes. 'devices' only last for the job.
+# 'answers' are [pattern, key] pairs for any question the build asks; the
+# rest get their usual default (see headless.py).
+#
+# Progress goes to stdout as one JSON object per line; anything else that
+# would have been printed goes to stderr. Exits with 0 if every job built,
+# 1 if any didn't and 2 if the job files couldn't be read.
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import traceback
+
+import headless
+
+# Events get the real stdout to themselves. make, sudo and friends print
+# to what's left, which is now stderr.
+events = os.fdopen(os.dup(1), 'w')
+os.dup2(2, 1)
+headless.out = events
+
+# colors.py wants to know what the terminal is, and there isn't one.
+os.environ.setdefault('TERM', 'dumb')
+
+serial_regex = '^FB[0-9]{6}$'
+
+# Every module imports these from whatever program started it.
+stdscr = headless.NullWindow()
+
+def crumb (name):
+   headless.emit('step', name = name)
+
+def del_crumb ():
+   pass
+
+def load_jobs (filename):
+   if filename == '-':
+      specs = json.load(sys.stdin)
+   else:
+      with open(filename, 'r') as f:
+         specs = json.load(f)
+
+   if isinstance(specs, dict):
+      specs = [specs]
+   if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+      raise ValueError(f'{filename}: expected a job or a list of jobs.')
+   return specs
+
+def run_job (spec):
+   # Builds one unit and returns the list of what went wrong.
+   import config
+   import jobs
+   import fuel_boss
+
+   product = fuel_boss.fuel_boss_data.get(spec.get('product'))
+   if product is None or product.get('module') is None:
+      raise headless.HeadlessError(f'Unknown product "{spec.get("product")}".')
+   module = product['module']
+
+   data = module.default_data(product)
+   options = spec.get('options', {})
+   unknown = sorted(set(options) - set(data))
+   if len(unknown):
+      raise headless.HeadlessError(f'Unknown options for {product["name"]}: {", ".join(unknown)}.')
+   data.update(options)
+   data['serial'] = spec.get('serial', data['serial'])
+   if not re.match(serial_regex, data['serial']):
+      raise headless.HeadlessError(f'"{data["serial"]}" is not a serial number.')
+
+   # Start from the saved configuration every time, so one job's devices
+   # never leak into the next.
+   config.load()
+   devices = spec.get('devices', {})
+   if 'sd_card' in devices:
+      config.data['sd_card_device'] = devices['sd_card']
+   if 'programmer_ports' in devices:
+      config.data['programmer_ports'] = devices['programmer_ports']
+
+   errors = module.build_unit(data, sd_only = spec.get('sd_only', False))
+
+   # Whatever the build left running (a disk image, say) has to finish
+   # before the card can be swapped for the next job's.
+   while len(jobs.running()):
+      jobs.pump()
+      time.sleep(0.5)
+   jobs.pump()
+   for job in jobs.jobs:
+      if not job.seen and job.state == 'Failed':
+         errors.append(f'- {job.summary()}')
+      job.seen = True
+
+   return errors
+
+def main ():
+   parser = argparse.ArgumentParser(description = 'Builds units from job files, without the menus.')
+   parser.add_argument('files', nargs = '+', metavar = 'JOB_FILE',
+      help = 'a JSON job file, or - to read one from standard input')
+   parser.add_argument('--dir',
+      default = os.environ.get('BUILD_MASTER_DIR', '/home/all-line/build-master'),
+      help = 'the build-master directory to work in')
+   parser.add_argument('--answer', nargs = 2, action = 'append', default = [],
+      metavar = ('PATTERN', 'KEY'), help = 'answer questions matching PATTERN with KEY in every job')
+   args = parser.parse_args()
+
+   # Job files are named relative to where we were started.
+   specs = []
+   try:
+      for filename in args.files:
+         specs += load_jobs(filename)
+   except (OSError, ValueError) as e:
+      headless.emit('failed', error = str(e))
+      return 2
+
+   os.chdir(args.dir)
+   headless.install(events)
+
+   failed = 0
+   for n, spec in enumerate(specs, 1):
+      headless.job = spec.get('name') or spec.get('serial') or f'job {n}'
+      headless.answers = [tuple(rule) for rule in spec.get('answers', [])] + [tuple(rule) for rule in args.answer]
+      headless.asked = {}
+      headless.emit('start', spec = spec)
+      began = time.monotonic()
+
+      try:
+         errors = run_job(spec)
+      except Exception as e:
+         headless.emit('failed', error = str(e) or type(e).__name__, trace = traceback.format_exc(),
+            seconds = int(time.monotonic() - began))
+         failed += 1
+         continue
+
+      headless.emit('done', ok = not len(errors), errors = [error.lstrip('- ') for error in errors],
+         seconds = int(time.monotonic() - began))
+      if len(errors):
+         failed += 1
+
+   headless.job = None
+   headless.emit('finished', jobs = len(specs), failed = failed)
+   return 1 if failed else 0
+
+sys.exit(main())
@@ -11,8 +11,10 @@ import gfx_chars
 from logo import all_line_logo
 from curses import wrapper
 
-# Make sure current working directory is the ~/build-master
-os.chdir("/home/all-line/build-master")
+# Make sure current working directory is the ~/build-master, or wherever
+# BUILD_MASTER_DIR says it is (build_cli.py goes by the same setting).
+home_dir = os.environ.get('BUILD_MASTER_DIR', '/home/all-line/build-master')
+os.chdir(home_dir)
 
 # There's only one standard screen and it's global anyhow
 stdscr = None
@@ -95,6 +97,9 @@ def main (scr):
    import compiler
    import buildroot
    import oled_screen
+   import sd_card
+   import card_batch
+   import jobs
 
    config.load()
 
@@ -110,7 +115,9 @@ def main (scr):
             ('Build a Fuel Boss', 'fuel-boss', False),
             ('Build a Bioblender', 'bioblender', False),
             ('Build a Development SD Card', 'dev'),
+            ('Build a Batch of SD Cards', 'batch'),
             '-',
+            ('Background Jobs', 'jobs'),
             ('Configure this Program', 'config'),
             ('Manage Buildroot', 'buildroot'),
             ('Quit this Program', 'quit'),
@@ -141,6 +148,12 @@ def main (scr):
          elif ret == 'dev':
             sd_card.do_dev_card()
 
+         elif ret == 'batch':
+            card_batch.do_batch_cards()
+
+         elif ret == 'jobs':
+            jobs.do_jobs()
+
          # TODO?
          #elif ret == 'reboot' or ret == 'quit' or ret == -1:
          #   draw.message(('I\'m sorry. I can\'t allow you to do that.'), colors = 10)
@@ -6,13 +6,263 @@ import curses
 import datetime
 import subprocess
 import time
+import hashlib
 
 import draw
 import utils
 import config
+import jobs
 from menu import menu, make_columns
 from __main__ import stdscr, crumb, del_crumb
 
+# What was last built in a tree lives here, relative to the tree.
+state_file = 'output/all_line_build.json'
+
+# Config symbols that only change what goes into the root file system
+# image, which "make" regenerates every time anyway.
+rootfs_prefixes = ('BR2_ROOTFS_', 'BR2_TARGET_ROOTFS_', 'BR2_TARGET_GENERIC_',
+   'BR2_SYSTEM_', 'BR2_INIT_', 'BR2_GLOBAL_PATCH_DIR')
+
+# Config symbols that belong to a package that isn't under BR2_PACKAGE_.
+package_prefixes = {
+   'BR2_LINUX_KERNEL': 'linux',
+   'BR2_TARGET_UBOOT': 'uboot',
+   'BR2_TARGET_GRUB2': 'grub2',
+   'BR2_TARGET_ARM_TRUSTED_FIRMWARE': 'arm-trusted-firmware'}
+
+# Symbols that exist only to be selected by other packages.
+virtual_prefixes = ('BR2_PACKAGE_HAS_', 'BR2_PACKAGE_PROVIDES_')
+
+def shared_dirs ():
+   # Downloads and compiler caches are shared between every Buildroot tree.
+   dl_dir = os.path.abspath(config.get('buildroot_dl_dir'))
+   ccache_dir = os.path.abspath(config.get('buildroot_ccache_dir'))
+   os.makedirs(dl_dir, exist_ok = True)
+   os.makedirs(ccache_dir, exist_ok = True)
+   return dl_dir, ccache_dir
+
+def read_config (root):
+   # Returns the resolved .config of a tree as {symbol: value}, with
+   # unset symbols left out.
+   symbols = {}
+   try:
+      with open(f'{root}/.config', 'r') as f:
+         for line in f:
+            line = line.strip()
+            if line.startswith('BR2_') and '=' in line:
+               key, value = line.split('=', 1)
+               symbols[key] = value
+   except (IOError, OSError):
+      pass
+   return symbols
+
+def hash_path (path):
+   # Content hash of a file or everything under a directory.
+   digest = hashlib.sha1()
+   if os.path.isfile(path):
+      paths = [path]
+   else:
+      paths = []
+      for dir, subdirs, files in os.walk(path):
+         subdirs.sort()
+         paths += [os.path.join(dir, name) for name in sorted(files)]
+
+   for name in paths:
+      digest.update(os.path.relpath(name, path).encode('utf-8') + b'\0')
+      try:
+         with open(name, 'rb') as f:
+            digest.update(f.read())
+      except (IOError, OSError):
+         digest.update(b'?')
+
+   return digest.hexdigest()
+
+def fingerprint (root, symbols):
+   # Everything a build depends on, as {name: hash}. Symbols whose value
+   # names files in the tree (overlays, kernel configs, post-build scripts)
+   # have those files folded into their hash, and each enabled package
+   # gets an entry for its own directory (its .mk file, patches and so on).
+   prints = {}
+   for key, value in symbols.items():
+      digest = hashlib.sha1(value.encode('utf-8'))
+      if value.startswith('"'):
+         for item in value.strip('"').split():
+            path = tree_path(root, item)
+            if item and os.path.exists(path):
+               digest.update(hash_path(path).encode('utf-8'))
+      prints[key] = digest.hexdigest()
+
+   for name in enabled_packages(root, symbols):
+      path = f'{root}/package/{name}'
+      if os.path.isdir(path):
+         prints[f'package:{name}'] = hash_path(path)
+
+   # Every file the overlays put in the root file system gets an entry of
+   # its own, so plan_build() can tell when one goes away. (Changes to what
+   # they hold are already in BR2_ROOTFS_OVERLAY's hash.)
+   for item in symbols.get('BR2_ROOTFS_OVERLAY', '').strip('"').split():
+      path = tree_path(root, item)
+      for dir, subdirs, files in os.walk(path):
+         for name in files:
+            prints[f'overlay:/{os.path.relpath(os.path.join(dir, name), path)}'] = item
+
+   return prints
+
+def tree_path (root, item):
+   # A path from a config value, as seen from the top of the tree.
+   return os.path.join(root, item.replace('$(TOPDIR)/', '').replace('$(CONFIG_DIR)/', ''))
+
+def package_names (root):
+   # Maps the upper-case symbol form of every package name to the name.
+   names = {}
+   try:
+      for entry in os.scandir(f'{root}/package'):
+         if entry.is_dir():
+            names[entry.name.upper().replace('-', '_')] = entry.name
+   except (IOError, OSError):
+      pass
+   return names
+
+def owner (symbol, names):
+   # Works out what a config symbol belongs to: ('rootfs', None) for
+   # things that only affect the final image, ('package', name) for one
+   # package, or ('toolchain', None) for anything that could affect
+   # everything that's been built.
+   if symbol.startswith('package:'):
+      return ('package', symbol[8:])
+
+   if symbol.startswith('overlay:'):
+      return ('rootfs', None)
+
+   if symbol.startswith(rootfs_prefixes):
+      return ('rootfs', None)
+
+   for prefix, name in package_prefixes.items():
+      if symbol.startswith(prefix):
+         return ('package', name)
+
+   if symbol.startswith(virtual_prefixes):
+      return ('rootfs', None)
+
+   if symbol.startswith('BR2_PACKAGE_'):
+      rest = symbol[12:]
+      host = rest.startswith('HOST_')
+      if host:
+         rest = rest[5:]
+
+      # Longest package name that the symbol starts with.
+      parts = rest.split('_')
+      for n in range(len(parts), 0, -1):
+         name = names.get('_'.join(parts[:n]))
+         if name is not None:
+            return ('package', 'host-' + name if host else name)
+
+   return ('toolchain', None)
+
+def enabled_packages (root, symbols):
+   names = package_names(root)
+   found = set()
+   for key, value in symbols.items():
+      if value == 'y':
+         kind, name = owner(key, names)
+         if kind == 'package' and not name.startswith('host-'):
+            found.add(name)
+   return sorted(found)
+
+def load_state (root):
+   try:
+      with open(f'{root}/{state_file}', 'r') as f:
+         return json.loads(f.read())
+   except (IOError, OSError, ValueError):
+      return None
+
+def save_state (root, board, prints):
+   with open(f'{root}/{state_file}', 'w') as f:
+      f.write(json.dumps({'board': board, 'fingerprint': prints}))
+
+def plan_build (root, prints):
+   # Compares a fingerprint with what was last built and returns
+   # ('full', [], why) if everything has to go, or ('incremental',
+   # [packages to dirclean], why) otherwise. Buildroot never takes
+   # anything back out of output/target, so a package that was turned off
+   # or an overlay file that was deleted means starting again too.
+   state = load_state(root)
+   if state is None or not os.path.isdir(f'{root}/output/build'):
+      return ('full', [], 'nothing has been built in this tree yet')
+
+   old = state.get('fingerprint', {})
+   names = package_names(root)
+   packages = set()
+
+   for key in sorted(set(old) | set(prints)):
+      if old.get(key) == prints.get(key):
+         continue
+
+      if key not in prints and key.startswith('package:'):
+         return ('full', [], f'{key[8:]} was turned off')
+      if key not in prints and key.startswith('overlay:'):
+         return ('full', [], f'{key[8:]} was taken out of the overlay')
+
+      kind, name = owner(key, names)
+      if kind == 'toolchain':
+         return ('full', [], f'{key} changed')
+      elif kind == 'package':
+         packages.add(name)
+
+   if len(packages):
+      why = f'{len(packages)} package(s) changed'
+   else:
+      why = 'only the root file system changed'
+
+   return ('incremental', sorted(packages), why)
+
+def error_file (root):
+   # Each tree gets its own, since several can be building at once.
+   return f'/dev/shm/br_errors_{os.path.basename(os.path.normpath(root))}'
+
+def build_board (root, defconfig, board = None, full = False):
+   # Brings a tree up to date with a board's defconfig, rebuilding as
+   # little as possible. Returns (success, plan) where plan is the result
+   # of plan_build(). Errors go to error_file(root).
+   dl_dir, ccache_dir = shared_dirs()
+   make = f'BR2_DL_DIR="{dl_dir}" BR2_CCACHE_DIR="{ccache_dir}" make -C "{root}"'
+   errors = error_file(root)
+   quiet = f'> /dev/null 2>> "{errors}"'
+
+   if os.path.exists(errors):
+      os.remove(errors)
+
+   # Resolve the defconfig (with ccache switched on) so we know exactly
+   # what's about to be built. This only writes .config.
+   code = os.system(f'{make} {defconfig} {quiet} && '
+      f'"{root}/utils/config" --file "{root}/.config" --enable BR2_CCACHE {quiet} && '
+      f'{make} olddefconfig {quiet}')
+   if (code >> 8) != 0:
+      return (False, None)
+
+   prints = fingerprint(root, read_config(root))
+   plan = ('full', [], 'a full rebuild was asked for') if full else plan_build(root, prints)
+   kind, packages, why = plan
+
+   if kind == 'full':
+      # "make clean" leaves .config alone, so the one just made still holds.
+      commands = [f'{make} clean']
+   else:
+      commands = [f'{make} {name}-dirclean' for name in packages]
+
+   commands.append(make)
+
+   # If this fails part way, the next build has to start from scratch.
+   if os.path.exists(f'{root}/{state_file}'):
+      os.remove(f'{root}/{state_file}')
+
+   code = os.system(' && '.join(f'{command} {quiet}' for command in commands))
+   if (code >> 8) != 0:
+      return (False, plan)
+
+   save_state(root, board or defconfig, prints)
+   return (True, plan)
+
 class BuildrootCompiler:
    def __init__ (self):
       # Use the default Buildroot tree?
@@ -107,27 +357,39 @@ class BuildrootCompiler:
             # This is fine
             return
 
-      # Clean the directory and make the default board configuration
-      draw.begin_wait(f'Compiling {self.buildroot_version}, board {board["name"]}...')
-      code = os.system(f'cd {self.buildroot_root} ; make clean > /dev/null 2>&1 && make {board["defconfig"]} > /dev/null 2>&1 && make > /dev/null 2>&1')
-
-      if (code >> 8) != 0:
-         draw.end_wait()
-         draw.message((
-            'Unable to build this board\'s software. There\'s a good chance you\'ll '
-            'want to talk to Steven about this.'),
-            colors = 10)
+      # Only rebuild what the configuration change actually touched. This
+      # takes a while even so, so it happens in the background.
+      try:
+         jobs.start(f'Compile {self.buildroot_version}, board {board["name"]}',
+            compile_job, self.buildroot_root, board, resource = os.path.abspath(self.buildroot_root))
+      except jobs.JobBusy as e:
+         draw.message(f'This Buildroot tree is busy.\n\n{e}', colors = 10)
          return
 
-      if (code >> 8) == 0:
-         draw.end_wait()
-         draw.message('Built successfully! You can now use this to make SD cards.', colors = 11)
-      else:
-         draw.end_wait()
-         draw.message((
-            'Unable to build this board\'s software. There\'s a good chance you\'ll '
-            'want to talk to Steven about this.'),
-            colors = 10)
+      draw.message((
+         f'Compiling board {board["name"]} in the background.\n'
+         '\n'
+         'You can carry on with something else; its progress is shown at the top of the '
+         'screen, and the result under Background Jobs on the main menu.'),
+         colors = 11)
+
+def compile_job (job, root, board):
+   # Runs as a background job (see jobs.py), so no drawing in here.
+   job.progress(text = 'working out what to rebuild')
+   success, plan = build_board(root, board['defconfig'], board = board['name'])
+   if not success:
+      raise RuntimeError(f'Unable to build this board\'s software; see {error_file(root)}.')
+
+   kind, packages, why = plan
+   if kind == 'full':
+      what = f'Full rebuild ({why})'
+   elif len(packages):
+      what = f'Rebuilt {", ".join(packages)}'
+   else:
+      what = 'Regenerated the root file system'
+
+   job.log(f'{what}. You can now use this to make SD cards.')
+   return True
 
 def do_buildroot ():
    br = BuildrootCompiler()
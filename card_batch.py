@@ -0,0 +1,244 @@
+# Builds base SD cards on every card reader at once.
+#
+# Each card gets its own worker thread that partitions, formats, copies the
+# boot files, unpacks the root file system and then checks the file systems.
+# Workers never touch the screen; they just update their CardJob, and the
+# main thread draws one row per card from those.
+
+import os
+import time
+import curses
+import threading
+import subprocess
+
+import draw
+import utils
+import config
+import sd_card
+import gfx_chars
+from menu import menu
+from __main__ import stdscr, crumb, del_crumb
+
+# Which Buildroot trees and boards a batch can be built from.
+presets = [
+   ('Fuel Boss 2.0, Pi 4', ('buildroot-fb-TNG', 'all_line_pi4')),
+   ('Configured Buildroot, Pi 2', (None, 'all_line_pi2'))]
+
+class CardError (Exception):
+   pass
+
+class CardJob:
+   def __init__ (self, builder, dev, golden = None):
+      self.builder = builder
+      self.dev = dev
+      self.golden = golden
+      self.part = builder.make_partitioner(dev = dev, mount_prefix = os.path.basename(dev) + '_')
+      self.state = 'Waiting'
+      self.percent = 0.0
+      self.error = None
+      self.finished = False
+      self.began = None
+      self.ended = None
+      self.thread = threading.Thread(target = self.run, daemon = True)
+
+   def step (self, state, percent = None):
+      self.state = state
+      if percent is not None:
+         self.percent = percent
+
+   def run (self):
+      self.began = time.monotonic()
+      try:
+         self.build()
+         self.step('Done', 100.0)
+      except Exception as e:
+         # Anything at all going wrong has to show up as a failed card.
+         self.error = str(e) or type(e).__name__
+         self.state = 'Failed'
+      finally:
+         self.ended = time.monotonic()
+         self.finished = True
+
+   def wait_for_partitions (self, timeout = 10.0):
+      if not self.part.wait_for_partitions(timeout):
+         last = self.part.partition_path(len(self.part.part_types) - 1)
+         raise CardError(f'{last} never showed up.')
+
+   def build (self):
+      part = self.part
+      if not part.safety_check():
+         raise CardError(f'{self.dev} looks like part of the boot drive.')
+      error = sd_card.busy_error(self.dev)
+      if error is not None:
+         raise CardError(error)
+
+      self.step('Unmounting')
+      for path in part.device_partitions():
+         if part.is_mounted(path) and not part.run_unmount(path):
+            raise CardError(f'Unable to unmount {path}.')
+
+      if self.golden is not None:
+         self.build_from_image()
+      else:
+         self.build_from_scratch()
+
+      self.step('Syncing')
+      os.system('sync')
+      self.verify()
+
+   def build_from_image (self):
+      part = self.part
+      if not utils.claim_device(self.dev):
+         raise CardError(f'Unable to write to {self.dev}.')
+
+      self.step('Writing image', 0.0)
+      try:
+         utils.write_device_image(self.golden['image'], self.dev,
+            callback = lambda done, total: self.step('Writing image', 90.0 * done / total))
+      finally:
+         utils.release_device(self.dev)
+
+      self.step('Partitioning', 90.0)
+      error = part.run_partition()
+      if error is not None:
+         raise CardError(error)
+      self.wait_for_partitions()
+
+      for id in range(2, len(part.part_types)):
+         self.step(f'Formatting {id+1}', 90.0 + id * 2.5)
+         if not part.run_format(id):
+            raise CardError(f'Unable to format {part.partition_path(id)}.')
+
+   def build_from_scratch (self):
+      part = self.part
+      builder = self.builder
+
+      self.step('Partitioning', 0.0)
+      error = part.run_partition(clear = True)
+      if error is not None:
+         raise CardError(error)
+      self.wait_for_partitions()
+
+      self.step('Formatting', 1.0)
+      for id in (2, 3):
+         if not part.run_format(id):
+            raise CardError(f'Unable to format {part.partition_path(id)}.')
+
+      # The boot image and the root tree were made before any of the
+      # workers started.
+      self.step('Boot partition', 3.0)
+      error = builder.write_boot(part)
+      if error is not None:
+         raise CardError(error)
+
+      self.step('Root file system', 10.0)
+      error = part.run_populate(1, builder.root_contents())
+      if error is not None:
+         raise CardError(error)
+
+   def verify (self):
+      # Read-only file system checks on everything we wrote.
+      part = self.part
+      self.step('Verifying', 97.0)
+      for id, is_vfat in enumerate(part.part_types):
+         tool = 'fsck.vfat -n' if is_vfat else 'e2fsck -fn'
+         proc = subprocess.run(f'sudo {tool} {part.partition_path(id)}',
+            shell = True, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+         if proc.returncode != 0:
+            raise CardError(f'{part.partition_path(id)} failed its check ({proc.returncode}).')
+
+def find_cards ():
+   # Every eligible card reader that actually has a card in it.
+   devs = []
+   for dev in config.find_card_readers():
+      if dev.size > 0 and not dev.is_root:
+         devs.append(dev)
+   return devs
+
+def draw_jobs (win, jobs):
+   rows, cols = win.getmaxyx()
+   bar_w = cols - 52
+   for n, job in enumerate(jobs):
+      row = 2 + n * 2
+      if job.error:
+         status = job.error
+      else:
+         status = job.state
+      elapsed = (job.ended if job.finished else time.monotonic()) - (job.began or time.monotonic())
+      blocks = int((job.percent / 100.0) * bar_w)
+      color = curses.color_pair(10) if job.error else curses.color_pair(11) if job.finished else curses.color_pair(6)
+
+      win.addstr(row, 2, job.dev.ljust(14))
+      win.addstr(row, 16, (blocks * gfx_chars.block).ljust(bar_w), color | curses.A_BOLD)
+      win.addstr(row, 17 + bar_w, f'{job.percent:5.1f}% {int(elapsed) // 60:3d}:{int(elapsed) % 60:02d}')
+      win.addstr(row + 1, 16, status[:cols - 18].ljust(cols - 18))
+   win.refresh()
+
+def do_batch_cards (buildroot_version = None, board_name = None):
+   if board_name is None:
+      sel = menu([(name, preset) for name, preset in presets], title = 'Which Kind of Card?')
+      if sel == -1:
+         return False
+      buildroot_version, board_name = sel
+
+   crumb('Build a Batch of SD Cards')
+   builder = sd_card.SDCardBuilder(buildroot_version, board_name)
+
+   if not builder.locate() or not builder.prepare_buildroot():
+      del_crumb()
+      return False
+
+   while True:
+      draw.begin_wait('Looking for SD cards...')
+      try:
+         devs = find_cards()
+      except ValueError as e:
+         draw.end_wait()
+         draw.message(f'Something went wrong when scanning for devices.\n\nTalk to Steven and tell him this:\n\n{e}', colors = 10)
+         del_crumb()
+         return False
+      draw.end_wait()
+
+      names = ', '.join(dev.path for dev in devs) if len(devs) else 'none'
+      result = draw.question((
+         f'Found {len(devs)} SD card(s): {names}.\n'
+         '\n'
+         'Every one of them will be wiped. Press ENTER to go ahead, '
+         'R to rescan, or ESCAPE to cancel.'),
+         choices = ('&OK', '&Rescan', '&Cancel'), default = 0, escape = 2)
+
+      if result == 'C':
+         del_crumb()
+         return False
+      elif result == 'O' and len(devs):
+         break
+
+   # A golden image makes every card a straight block copy.
+   golden = builder.find_golden_image() if config.get('image_cache') else None
+   if golden is None and (not builder.make_boot_image() or not builder.unpack_rootfs()):
+      del_crumb()
+      return False
+   jobs = [CardJob(builder, dev.path, golden) for dev in devs]
+
+   win = draw.newwin(len(jobs) * 2 + 3, 110, title = f'Building {len(jobs)} SD Cards', colors = 4)
+   for job in jobs:
+      job.thread.start()
+
+   throttle = utils.Throttle()
+   while not all(job.finished for job in jobs):
+      if throttle.ready():
+         draw_jobs(win, jobs)
+      time.sleep(0.02)
+   draw_jobs(win, jobs)
+
+   failed = [job for job in jobs if job.error]
+   text = f'{len(jobs) - len(failed)} of {len(jobs)} cards were built successfully.'
+   if len(failed):
+      text += '\n\n' + '\n'.join(f'{job.dev}: {job.error}' for job in failed)
+   draw.message(text, colors = 10 if len(failed) else 11)
+
+   del win
+   stdscr.touchwin()
+   stdscr.refresh()
+   del_crumb()
+   return not len(failed)
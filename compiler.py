@@ -4,24 +4,197 @@ import curses
 import time
 import re
 import shutil
+import json
+import hashlib
+import codecs
+import threading
+import collections
 
 import config
 import draw
 import utils
+import jobs
 from __main__ import stdscr
 
 compile_dir = './compile'
 combine_dir = './compile/combine'
+firmware_cache_dir = './cache/firmware'
+
+# Files that make produces, or that are left behind by editing, and so
+# aren't part of what a build's cache key should depend on.
+product_suffixes = ('.o', '.d', '.elf', '.hex', '.eep', '.lss', '.lst',
+   '.map', '.sym', '.a', '.bin', '.backup')
+skip_dirs = ('.git', '.dep')
+
+# ANSI escape sequences, whether make passed them on as real escapes or as
+# the literal text "\x1b" (or "\033").
+ansi_regex = re.compile(r'(?:\x1b|\\x1b|\\033|\\e)(?:\[[0-?]*[ -/]*[@-~]|[@-Z\\-_])')
+
+def strip_ansi (text):
+   # A quick look first; most text has no escapes at all.
+   if '\x1b' in text or '\\' in text:
+      return ansi_regex.sub('', text)
+   return text
+
+# A compiler complaint, "file:line[:column]: error|warning: text", and the
+# failures that come without a line number (mostly from the linker).
+problem_regex = re.compile(
+   r'^(?P<file>[^\s:][^:]*):(?P<line>\d+):(?:\d+:)?\s*(?P<kind>fatal error|error|warning):\s*(?P<text>.*)$')
+failure_regex = re.compile(
+   r'(?:undefined reference to|collect2: error:|ld: .*error|\*\*\* No rule to make target)')
+
+# How many of the most recent lines of make's output a BuildLog keeps, and
+# how many errors and warnings.
+log_lines = 2000
+log_problems = 200
+
+class FirmwareCache:
+   # Finished builds, keyed by a hash of everything in the source tree
+   # (including the symbols a DefinitionEditor has already saved into it).
+   # Each entry is a directory holding the .hex and .eep files make left in
+   # the top of the tree, plus make's output. Entries are touched when used
+   # and the least recently used ones go once the cache grows past
+   # 'firmware_cache_mb'.
+   def __init__ (self, path = firmware_cache_dir):
+      self.path = path
+      self.stats_file = f'{path}/stats.json'
+      os.makedirs(path, exist_ok = True)
+
+   def key (self, src):
+      digest = hashlib.sha1()
+      for dir, subdirs, files in os.walk(src):
+         subdirs[:] = sorted(d for d in subdirs if d not in skip_dirs)
+         for name in sorted(files):
+            if name.endswith(product_suffixes): continue
+            path = os.path.join(dir, name)
+            digest.update(os.path.relpath(path, src).encode('utf-8') + b'\0')
+            with open(path, 'rb') as f:
+               digest.update(hashlib.sha1(f.read()).digest())
+      return digest.hexdigest()
+
+   def stats (self):
+      try:
+         with open(self.stats_file, 'r') as f:
+            return json.loads(f.read())
+      except (IOError, OSError, ValueError):
+         return {'hits': 0, 'misses': 0}
+
+   def count (self, hit):
+      stats = self.stats()
+      stats['hits' if hit else 'misses'] += 1
+      with open(self.stats_file, 'w') as f:
+         f.write(json.dumps(stats))
+      return stats
+
+   def fetch (self, key, dest):
+      # Copies a cached build into 'dest' and returns make's output from
+      # when it was built, or None if there isn't one.
+      entry = f'{self.path}/{key}'
+      if not os.path.isdir(entry):
+         return None
+
+      for name in os.listdir(entry):
+         if name.endswith(('.hex', '.eep')):
+            shutil.copy2(f'{entry}/{name}', f'{dest}/{name}')
+
+      os.utime(entry)
+      with open(f'{entry}/output.txt', 'r') as f:
+         return f.read()
+
+   def store (self, key, src, output):
+      entry = f'{self.path}/{key}'
+      temp = f'{entry}.tmp'
+      shutil.rmtree(temp, ignore_errors = True)
+      os.mkdir(temp)
+
+      for name in os.listdir(src):
+         if name.endswith(('.hex', '.eep')):
+            shutil.copy2(f'{src}/{name}', f'{temp}/{name}')
+      with open(f'{temp}/output.txt', 'w') as f:
+         f.write(output)
+
+      shutil.rmtree(entry, ignore_errors = True)
+      os.rename(temp, entry)
+      self.evict()
+
+   def evict (self):
+      limit = config.get('firmware_cache_mb') * 1024 * 1024
+      entries = []
+      total = 0
+      for entry in os.scandir(self.path):
+         if not entry.is_dir(): continue
+         size = sum(f.stat().st_size for f in os.scandir(entry.path))
+         entries.append((entry.stat().st_mtime, size, entry.path))
+         total += size
+
+      # Oldest first.
+      for when, size, path in sorted(entries):
+         if total <= limit: break
+         shutil.rmtree(path, ignore_errors = True)
+         total -= size
+
+# A #define or #undef line, possibly commented out, such as:
+#    #define SYMBOL VALUE
+#    #define SYMBOL
+#    // #undef SYMBOL
+define_regex = re.compile(
+   r'^\s*?(?P<comment>/*)\s*?#\s*?(?P<type>define|undef)\s*?(?P<symbol>\w+)\s*?(?P<value>[ -~]*?)\s*?$')
+
+# Headers already parsed, by path: ((mtime, size), lines, definitions). The
+# definitions are kept as tuples; every editor gets its own dicts of them.
+parsed_headers = {}
+
+def header_key (filename):
+   stat = os.stat(filename)
+   return (stat.st_mtime_ns, stat.st_size)
+
+def parse_header (filename):
+   # Returns the lines of a header and the definitions in it, reading it
+   # only if it changed since the last time.
+   key = header_key(filename)
+   cached = parsed_headers.get(filename)
+   if cached is not None and cached[0] == key:
+      return cached[1], cached[2]
+
+   with open(filename, 'r') as f:
+      lines = f.read().split('\n')
+   found = find_defines(lines)
+   parsed_headers[filename] = (key, lines, found)
+   return lines, found
+
+def find_defines (lines):
+   # One pass over the lines; returns a tuple (comment, line, line_no,
+   # type, symbol, value, args) for each definition.
+   found = []
+   for nr, line in enumerate(lines):
+      # Nearly every line can be skipped without the regex.
+      if '#' not in line: continue
+      line = line.strip()
+      match = define_regex.match(line)
+      if match is None: continue
+      values = match.groupdict()
+
+      # Arguments will get absorbed as values.
+      # Modifying the regex is unpleasant at this point, so let's
+      # handle that here.
+      arg_begin = line.find(values['symbol'] + '(')
+      if arg_begin >= 0:
+         # There are arguments.
+         arg_begin += len(values['symbol'])
+         arg_end = line.find(')', arg_begin)
+         args = line[arg_begin:arg_end + 1]
+         if values['value'].startswith(args):
+            values['value'] = values['value'][len(args):]
+      else:
+         args = ''
+
+      comment = len(values['comment']) >= 2 and values['comment'].count('/') == len(values['comment'])
+      found.append((comment, line, nr, values['type'], values['symbol'], values['value'], args))
+   return tuple(found)
 
 class DefinitionEditor:
    def __init__ (self, filename):
-      self.tempfile = f'{utils.ramdisk}/temp_file'
       self.filename = filename
-
-      if os.path.exists(self.tempfile):
-         os.remove(self.tempfile)
-      shutil.copy2(self.filename, self.tempfile)
-
       self.find_defines()
 
    def define (self, symbol, value = None):
@@ -54,9 +227,8 @@ class DefinitionEditor:
 
    def get_symbols (self, *args):
       out = []
-      for item in self.items:
-         if item['symbol'] in args:
-            out.append(item)
+      for symbol in args:
+         out += self.symbols.get(symbol, [])
       return out
 
    def get_single_line (self, item):
@@ -65,76 +237,155 @@ class DefinitionEditor:
       if item['comment']: new += '//'
       if item['is_define']: new += '#define'
       if item['is_undef']: new += '#undef'
-      new += ' ' + item['symbol']
+      new += ' ' + item['symbol'] + item['args']
       if item['is_define'] and len(item['value']):
          new += ' ' + item['value']
       return new
 
    def get_text (self):
-      lines = [line.strip() for line in open(self.filename, 'r')]
-
+      # Only the definitions that were changed are rewritten; every other
+      # line is left exactly as it was.
+      lines = self.lines[:]
       for item in self.items:
          new = self.get_single_line(item)
-         lines[item['line_no']] = new
-
+         if new != self.unchanged[item['line_no']]:
+            lines[item['line_no']] = new
       return '\n'.join(lines)
 
    def save (self):
-      # Remove the original file and move our temporary file into its spot.
-      # Make a backup first.
-      with open(self.tempfile, 'w') as f:
+      # Writes next to the original and renames over it, so the header is
+      # never half written. The old one is kept as .backup (a hard link,
+      # where the file system has them, rather than a copy).
+      temp = f'{self.filename}.{os.getpid()}.tmp'
+      backup = f'{self.filename}.backup'
+      with open(temp, 'w') as f:
          f.write(self.get_text())
-      shutil.copy2(self.filename, f'{self.filename}.backup')
-      os.remove(self.filename)
-      shutil.copy2(self.tempfile, self.filename)
+      shutil.copymode(self.filename, temp)
+
+      if os.path.lexists(backup):
+         os.remove(backup)
+      try:
+         os.link(self.filename, backup)
+      except OSError:
+         shutil.copy2(self.filename, backup)
+      os.replace(temp, self.filename)
+
+      # What we just wrote is what the next editor of this file will see.
+      self.find_defines()
 
    def find_defines (self):
-      # This searches for a line containing something like:
-      #    #define SYMBOL VALUE
-      # or just
-      #    #define SYMBOL
-      # or even
-      #    #undef SYMBOL
-      # and fills in self.items.
-
-      #expr = '\s*(?P<comment>/*)\s*#\s*(?P<type>define|undef)\s*(?P<symbol>\w+)\s*(?P<value>\w*)'
-      expr = '^\s*?(?P<comment>/*)\s*?#\s*?(?P<type>define|undef)\s*?(?P<symbol>\w+)\s*?(?P<value>[ -~]*?)\s*?$'
+      # Fills in self.items (and self.symbols, the same items by symbol)
+      # from the header, which is only parsed again if it changed.
+      self.lines, found = parse_header(self.filename)
       self.items = []
-
-      for nr, line in [(n, l.strip()) for n, l in enumerate(open(self.tempfile, 'r'))]:
-         # Skip this line?
-         if not re.search(expr, line): continue
-
-         for match in re.finditer(expr, line):
-            values = match.groupdict()
-
-            # No dict from the match object?
-            if not values: continue
-
-            # Arguments will get absorbed as values.
-            # Modifying the regex is unpleasant at this point, so let's
-            # handle that here.
-            arg_begin = line.find(values['symbol'] + '(')
-            if arg_begin >= 0:
-               # There are arguments.
-               arg_begin += len(values['symbol'])
-               arg_end = line.find(')', arg_begin)
-               args = line[arg_begin:arg_end + 1]
-               if values['value'].startswith(args):
-                  values['value'] = values['value'][len(args):]
-            else:
-               args = ''
-
-            self.items.append({
-               'comment': len(values['comment']) >= 2 and values['comment'].count('/') == len(values['comment']),
-               'line': line,
-               'line_no': nr,
-               'is_define': values['type'] == 'define',
-               'is_undef': values['type'] == 'undef',
-               'symbol': values['symbol'],
-               'value': values['value'],
-               'args': args
-            })
+      self.symbols = {}
+      self.unchanged = {}
+
+      for comment, line, nr, kind, symbol, value, args in found:
+         item = {
+            'comment': comment,
+            'line': line,
+            'line_no': nr,
+            'is_define': kind == 'define',
+            'is_undef': kind == 'undef',
+            'symbol': symbol,
+            'value': value,
+            'args': args
+         }
+         self.items.append(item)
+         self.symbols.setdefault(symbol, []).append(item)
+         self.unchanged[nr] = self.get_single_line(item)
+
+class BuildLog:
+   # make's output, fed in as it arrives: escapes stripped, errors and
+   # warnings picked out, and only the last 'log_lines' lines kept, so a
+   # runaway build can't fill memory (or the viewer).
+   def __init__ (self):
+      self.lines = collections.deque(maxlen = log_lines)
+      self.total = 0
+      self.errors = []
+      self.warnings = []
+      self.partial = ''
+      self.decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+
+   def feed (self, data):
+      if not isinstance(data, str): data = self.decoder.decode(data)
+      lines = (self.partial + data).split('\n')
+      self.partial = lines.pop()
+      for line in lines:
+         self.add(line)
+
+   def close (self):
+      rest = self.partial + self.decoder.decode(b'', final = True)
+      self.partial = ''
+      if len(rest):
+         self.add(rest)
+
+   def read_from (self, pipe):
+      # Feeds everything from 'pipe' until it's closed.
+      while True:
+         chunk = os.read(pipe.fileno(), 65536)
+         if not chunk:
+            break
+         self.feed(chunk)
+      self.close()
+
+   def add (self, line):
+      # Most lines have no escapes, and no colon means no problem either;
+      # those checks are much cheaper than the regexes.
+      line = strip_ansi(line.rstrip('\r'))
+      self.lines.append(line)
+      self.total += 1
+      if ':' not in line:
+         return
+
+      # Each problem is (file, line number, message, the whole line).
+      match = problem_regex.match(line)
+      if match is not None:
+         problems = self.warnings if match['kind'] == 'warning' else self.errors
+         if len(problems) < log_problems:
+            problems.append((match['file'], int(match['line']), match['text'], line))
+      elif failure_regex.search(line) and len(self.errors) < log_problems:
+         self.errors.append((None, None, line, line))
+
+   def text (self):
+      dropped = self.total - len(self.lines)
+      text = '\n'.join(self.lines)
+      if dropped:
+         text = f'({dropped:,} earlier lines not shown)\n' + text
+      return text
+
+   def summary (self):
+      counts = []
+      for problems, word in ((self.errors, 'error'), (self.warnings, 'warning')):
+         if len(problems):
+            more = '+' if len(problems) == log_problems else ''
+            counts.append(f'{len(problems)}{more} {word}{"s" if len(problems) != 1 else ""}')
+      return ', '.join(counts)
+
+def make_job (job, dest, threads):
+   # Runs as a background job (see jobs.py). Returns make's return code and
+   # BuildLogs of its output and errors, or None if the tree couldn't even
+   # be cleaned.
+   job.progress(text = 'cleaning')
+   proc = subprocess.run(f'make -C "{dest}" clean',
+      shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+   if proc.returncode != 0:
+      return None
+
+   job.progress(text = 'compiling')
+   proc = subprocess.Popen(f'make -C "{dest}" -j {threads}',
+      shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+
+   # Both pipes have to be drained at once, or make can block on either.
+   output = BuildLog()
+   errors = BuildLog()
+   reader = threading.Thread(target = errors.read_from, args = (proc.stderr,), daemon = True)
+   reader.start()
+   output.read_from(proc.stdout)
+   reader.join()
+   proc.wait()
+   return proc.returncode, output, errors
 
 class Compiler:
    def __init__ (self, src, in_place = False):
@@ -157,60 +408,89 @@ class Compiler:
    def compile (self):
       draw.begin_wait('Compiling from source...')
 
-      proc = subprocess.run(f'make -C "{self.dest}" clean', 
-         shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-      if proc.returncode != 0:
+      # Has this exact source (and set of features) been built before?
+      cache = FirmwareCache()
+      key = cache.key(self.dest)
+      output = cache.fetch(key, self.dest)
+      if output is not None:
+         stats = cache.count(hit = True)
+         draw.end_wait()
+         draw.viewer(
+            self.cache_summary(stats, hit = True) + output,
+            rows = 40, cols = 120,
+            title = 'Successful Compilation',
+            colors = 11, attrs = curses.A_BOLD)
+         return True
+
+      # make runs as a job so the screen (and anything else running)
+      # carries on while it works.
+      draw.end_wait()
+      try:
+         proc = jobs.run(f'Compile {os.path.basename(os.path.normpath(self.source))}',
+            make_job, self.dest, config.get('compiler_threads'), resource = os.path.abspath(self.dest))
+      except (jobs.JobBusy, RuntimeError) as e:
+         draw.message(f'Unable to compile right now.\n\n{e}', colors = 10)
+         return False
+
+      if proc is None:
          draw.viewer(
             'Unable to clean source directory.\n\nYou might need to talk to Steven.',
             rows = 36, cols = 120, colors = 10, attrs = curses.A_BOLD)
          return False
 
-      proc = subprocess.run(f'make -C "{self.dest}" -j {config.get("compiler_threads")}',
-         shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-
-      if proc.returncode != 0:
-         draw.end_wait()
+      returncode, output, errors = proc
+      if returncode != 0:
+         text, first = self.error_report(errors)
          draw.viewer(
-            self.clean_output(proc.stderr.decode('utf-8')),
+            text,
             rows = 40, cols = 120,
             title = 'Error Compiling',
-            colors = 10, attrs = curses.A_BOLD)
+            colors = 10, attrs = curses.A_BOLD,
+            find = first)
          return False
       else:
-         draw.end_wait()
+         output = output.text()
+         if len(errors.warnings):
+            output = (f'{errors.summary()}:\n' + '\n'.join(warning[3] for warning in errors.warnings) +
+               '\n\n' + output)
+         cache.store(key, self.dest, output)
+         stats = cache.count(hit = False)
          draw.viewer(
-            self.clean_output(proc.stdout.decode('utf-8')),
+            self.cache_summary(stats, hit = False) + output,
             rows = 40, cols = 120,
             title = 'Successful Compilation',
             colors = 11, attrs = curses.A_BOLD)
          return True
 
-   def clean_output (self, text):
-      # This just replaces ANSI stuff with nothing.
-      if not isinstance(text, str): text = text.decode('utf-8')
-      out_text = ''
-
-      is_escape = False
-      for index, ch in enumerate(text):
-         if is_escape:
-            # The only ANSI codes that are used are for colorizing text,
-            # meaning that they all end with 'm'.
-            if ch == 'm':
-               is_escape = False
-         else:
-            # I guess the way 'make' outputs "\x1b" is literally as the ASCII
-            # string "\x1b", so let's assume the '\x' is out escape marker.
-            if ch == '\\' and index < len(text) - 1 and text[index + 1] == 'x':
-               is_escape = True
-            else:
-               out_text += ch
+   def cache_summary (self, stats, hit):
+      if hit:
+         text = 'Nothing changed since this was last compiled, so the cached firmware was used.\n'
+      else:
+         text = 'Compiled from scratch and added to the firmware cache.\n'
+      return text + f'Build cache: {stats["hits"]} hits, {stats["misses"]} misses.\n\n'
 
-      return out_text
+   def error_report (self, log):
+      # What the Error Compiling viewer shows, and the line it should open
+      # at: the first error, in among the output around it.
+      text = (log.summary() or 'make failed without saying why') + '.\n\n'
+      first = log.errors[0][3] if len(log.errors) else None
+
+      # If the first error has scrolled out of what was kept, list them all
+      # up top instead.
+      if first is not None and first not in log.lines:
+         text += 'Errors:\n' + '\n'.join(error[3] for error in log.errors) + '\n\n'
+      return text + log.text(), first
+
+   def clean_output (self, text):
+      # This just replaces ANSI stuff with nothing, the same way BuildLog
+      # does for make's output.
+      if not isinstance(text, str): text = text.decode('utf-8', 'replace')
+      return strip_ansi(text)
 
    def combine_with (self, src, hex_file = None):
       # This is usually for combining a bootloader with a main program.
       # We'll create an instance of ourselves but with a different destination
-      # directory. Then we'll compile that, and use srec_cat to combine the
+      # directory. Then we'll compile that, and merge the
       # resulting hex files.
 
       comp = Compiler(src, combine_dir)
@@ -219,10 +499,10 @@ class Compiler:
 
       hex_file = 'main.hex' if hex_file is None else hex_file
 
-      result = utils.combine_hexes(f'{self.dest}/main.hex', hex_file)
-      if result == False:
+      result, filename = utils.combine_hexes(f'{self.dest}/main.hex', hex_file)
+      if not result:
          return False
 
-      # Return the combined file name.
-      return result[1]
+      # Return the combined file name; it's the caller's to remove.
+      return filename
 
@@ -1,11 +1,11 @@
 import json
 import os
 import curses
-import subprocess
 
 import draw
 import utils
 import gfx_chars
+import block_devices
 from menu import menu, make_columns
 from text_input import text_input
 from __main__ import crumb, del_crumb, stdscr
@@ -18,6 +18,12 @@ defaults = {
    'buildroot_version': 'buildroot-2021.08.13-pi2-tmp',
    'compiler_threads': 16,
    'compression_threads': 16,
+   'firmware_cache_mb': 256,
+   'image_cache': False,
+   'programmer_ports': [],
+   'auto_isp_clock': False,
+   'buildroot_dl_dir': './buildroot/dl',
+   'buildroot_ccache_dir': './buildroot/ccache',
    'verbose': False
 }
 
@@ -53,11 +59,14 @@ def do_config ():
       ret = menu([
          ('-Setting                     Value'),
          (f'Programming Port            {data["port"]}', 'port'),
+         (f'Extra Programmer Ports      {", ".join(data["programmer_ports"]) or "None"}', 'ports'),
          (f'SD Card Device              {data["sd_card_device"]}', 'device'),
          (f'Buildroot Version           {data["buildroot_version"]}', 'buildroot'),
          (f'Compilation Threads         {data["compiler_threads"]}', 'threads'),
          (f'Image Compression Threads   {data["compression_threads"]}', 'comp_threads'),
          (f'Verbose avrdude Commands    {data["verbose"]}', 'verbose'),
+         (f'Tune Programming Speed      {data["auto_isp_clock"]}', 'auto_isp_clock'),
+         (f'Cache SD Card Images        {data["image_cache"]}', 'image_cache'),
          '-',
          (f'Back to Main Menu', 'quit')
       ], title = 'Options', pre_select = ret)
@@ -70,6 +79,9 @@ def do_config ():
          if new_port is not None:
             data['port'] = new_port
 
+      elif ret == 'ports':
+         data['programmer_ports'] = do_ports(data['programmer_ports'])
+
       elif ret == 'device':
          new_device = do_device()
          if new_device is not None:
@@ -92,6 +104,12 @@ def do_config ():
       elif ret == 'verbose':
          data['verbose'] = not data['verbose']
 
+      elif ret == 'auto_isp_clock':
+         data['auto_isp_clock'] = not data['auto_isp_clock']
+
+      elif ret == 'image_cache':
+         data['image_cache'] = not data['image_cache']
+
       elif ret == 'threads':
          new_threads = text_input(
             prompt = 'How many threads should be used for compilation?',
@@ -126,30 +144,41 @@ def do_port ():
 
    return ret
 
-def do_device ():
-   proc = subprocess.run(
-      f'lsblk -Jpo KNAME,HOTPLUG,SUBSYSTEMS,VENDOR,MODEL,SIZE',
-      shell = True,
-      stdout = subprocess.PIPE)
-
-   error_message = 'Something went wrong when scanning for devices.\n\nTalk to Steven'
-   if proc.returncode != 0:
-      draw.message(error_message + '.', colors = 10)
-      return None
+def do_ports (ports):
+   # Pick any number of extra programmer ports, so that several chips can
+   # be programmed at once. Selecting a port toggles it.
+   ports = list(ports)
+   ret = 0
+   while True:
+      items = [('Done', 'quit'), '-']
+      for n in sorted(os.listdir('/dev')):
+         if 'tty' not in n: continue
+         port = f'/dev/{n}'
+         mark = 'Yes' if port in ports else '-'
+         items.append((f'{port.ljust(24)}{mark}', port))
+
+      ret = menu(items, title = 'Extra Programmer Ports', pre_select = ret)
+      if ret == 'quit' or ret == -1:
+         return ports
 
-   try:
-      data = json.loads(proc.stdout.decode('utf-8'))['blockdevices']
-   except (KeyError, TypeError, ValueError, json.decoder.JSONDecodeError) as e:
-      draw.message(error_message + f' and tell him this:\n\n{e}', colors = 10)
-      return None
+      if ret in ports:
+         ports.remove(ret)
+      else:
+         ports.append(ret)
 
-   # Filter the list down to only those that make sense
+def find_card_readers ():
+   # Returns every USB card reader that could hold a card we're allowed to
+   # write to, as block_devices.Disk objects.
    devs = []
-   for dev in data:
-      if dev['hotplug'] == '1' or dev['hotplug'] == True:
-         if 'usb' in dev['subsystems']:
-            if dev['model'] is not None and any(model in dev['model'].lower() for model in ['sd', 'transcend']):
-               devs.append(dev)
+   for dev in block_devices.disks():
+      if dev.hotplug and dev.transport == 'usb':
+         if dev.model is not None and any(model in dev.model.lower() for model in ['sd', 'transcend']):
+            devs.append(dev)
+
+   return devs
+
+def do_device ():
+   devs = find_card_readers()
 
    sizes = (20, 20, 24, 12)
    align = ('ljust', 'ljust', 'ljust', 'rjust')
@@ -158,11 +187,10 @@ def do_device ():
       make_columns(sizes, cols, align = align, header = True)]
 
    for dev in devs:
-      kname = dev['kname']
-      vendor = dev['vendor'] if dev['vendor'] else 'Unknown'
-      model = dev['model'] if dev['model'] else 'Unknown'
-      size = dev['size'] if dev['size'] else 'Unknown'
-      items.append((make_columns(sizes, (kname, vendor, model, size), align = align), kname))
+      vendor = dev.vendor if dev.vendor else 'Unknown'
+      model = dev.model if dev.model else 'Unknown'
+      size = utils.format_size(dev.size, suffix = '') if dev.size else 'No card'
+      items.append((make_columns(sizes, (dev.path, vendor, model, size), align = align), dev.path))
 
    while True:
       ret = menu(items, title = 'Select a Device')
@@ -0,0 +1,200 @@
+# A local index of a data tree like ./data/injector: one directory per
+# serial number, each with a desc.txt, a version directory or two, and the
+# HEX files built in them.
+#
+# The tree usually lives on the NAS, where reading all of it is slow. The
+# index is an SQLite database on this machine, and only the serials whose
+# directory (or desc.txt) changed since last time are read again. Searches
+# go through SQLite's full text search, ranked, when it has it.
+
+import os
+import time
+import sqlite3
+
+import utils
+
+# How long (seconds) the tree is trusted before update() looks at it again.
+max_age = 60
+
+schema = '''
+   create table if not exists systems (
+      serial text primary key,
+      stamp text,
+      tree text,
+      has_desc integer,
+      description text,
+      versions text);
+   create table if not exists files (
+      serial text,
+      name text,
+      path text,
+      dir text,
+      size integer,
+      timestamp real);
+   create index if not exists files_serial on files (serial);
+'''
+
+class DataIndex:
+   def __init__ (self, root, db_file):
+      self.root = root
+      self.db_file = db_file
+      self.db = None
+      self.fts = False
+      self.checked = None
+      self.walk_cache = utils.WalkCache()
+
+   def open (self):
+      if self.db is not None:
+         return self.db
+
+      os.makedirs(os.path.dirname(self.db_file), exist_ok = True)
+      self.db = sqlite3.connect(self.db_file)
+      self.db.executescript(schema)
+      try:
+         self.db.execute(('create virtual table if not exists words '
+            'using fts5(serial, description, versions, files)'))
+         self.fts = True
+      except sqlite3.OperationalError:
+         # This SQLite was built without FTS5; search() makes do with LIKE.
+         self.fts = False
+      return self.db
+
+   def stamp (self, path, deep = False):
+      # Something that changes whenever the serial at 'path' does: its own
+      # mtime and desc.txt's, plus (if 'deep') every directory's under it.
+      stamps = []
+      for where in [path, f'{path}/desc.txt']:
+         try:
+            stamps.append(str(os.stat(where).st_mtime_ns))
+         except OSError:
+            stamps.append('-')
+
+      if deep:
+         for where, dirs, files in os.walk(path):
+            for name in sorted(dirs):
+               try:
+                  stamps.append(f'{name}={os.stat(os.path.join(where, name)).st_mtime_ns}')
+               except OSError:
+                  pass
+            dirs.sort()
+
+      return ':'.join(stamps)
+
+   def update (self, force = False):
+      # Catches the index up with the tree. Returns how many serials had to
+      # be read again.
+      db = self.open()
+      if not force and self.checked is not None and time.monotonic() - self.checked < max_age:
+         return 0
+
+      known = dict(db.execute('select serial, stamp from systems'))
+      seen = set()
+      changed = 0
+
+      for entry in os.scandir(self.root):
+         if not entry.is_dir(): continue
+         seen.add(entry.name)
+         if self.stamp(entry.path) != known.get(entry.name):
+            self.index(entry.name)
+            changed += 1
+
+      for serial in set(known) - seen:
+         self.forget(serial)
+
+      db.commit()
+      self.checked = time.monotonic()
+      return changed
+
+   def refresh (self, serial):
+      # Reads one serial again, whatever its stamp says; after compiling
+      # into it, for example.
+      self.open()
+      self.index(serial)
+      self.db.commit()
+
+   def forget (self, serial):
+      self.db.execute('delete from systems where serial = ?', (serial,))
+      self.db.execute('delete from files where serial = ?', (serial,))
+      if self.fts:
+         self.db.execute('delete from words where serial = ?', (serial,))
+
+   def index (self, serial):
+      path = f'{self.root}/{serial}'
+      self.forget(serial)
+      if not os.path.isdir(path):
+         return
+
+      try:
+         with open(f'{path}/desc.txt', 'r', errors = 'replace') as f:
+            desc = f.read()
+      except OSError:
+         desc = None
+
+      versions = sorted(entry.name for entry in os.scandir(path) if entry.is_dir())
+      files = utils.find_files(path, '.hex', compare = 'endswith', cache = self.walk_cache)
+
+      self.db.execute('insert into systems values (?, ?, ?, ?, ?, ?)', (
+         serial, self.stamp(path), self.stamp(path, deep = True),
+         desc is not None, desc or '', '\n'.join(versions)))
+      self.db.executemany('insert into files values (?, ?, ?, ?, ?, ?)', [
+         (serial, f['name'], f['path'], f['dir'], f['size'], f['timestamp']) for f in files])
+      if self.fts:
+         self.db.execute('insert into words values (?, ?, ?, ?)', (
+            serial, desc or '', ' '.join(versions), ' '.join(f['path'][len(path):] for f in files)))
+
+   def serials (self):
+      self.update()
+      return [row[0] for row in self.db.execute('select serial from systems order by serial')]
+
+   def counts (self):
+      # How many serials do and don't have a description.
+      self.update()
+      with_desc, total = self.db.execute('select sum(has_desc), count(*) from systems').fetchone()
+      return with_desc or 0, total - (with_desc or 0)
+
+   def files (self, serial, under = None):
+      # The HEX files under a serial (or one of its versions), in the form
+      # utils.find_files() gives them. Builds made since we last looked show
+      # up as a changed directory, so the serial is read again first.
+      self.open()
+      base = f'{self.root}/{serial}'
+      row = self.db.execute('select tree from systems where serial = ?', (serial,)).fetchone()
+      if row is None or row[0] != self.stamp(base, deep = True):
+         self.refresh(serial)
+
+      under = under.rstrip('/') + '/' if under else ''
+      return [utils.file_entry(name, path, where, size, timestamp)
+         for name, path, where, size, timestamp in self.db.execute(
+            'select name, path, dir, size, timestamp from files where serial = ? order by path', (serial,))
+         if path.startswith(under)]
+
+   def search (self, text, limit = 500):
+      # Returns [(serial, excerpt)], best match first. Every word has to
+      # appear, as the start of a word, in the serial, description, versions
+      # or file names. If that finds nothing, anything containing the text
+      # as typed will do.
+      self.update()
+      words = text.split()
+      if not len(words):
+         return []
+
+      matches = []
+      if self.fts:
+         query = ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+         try:
+            matches = self.db.execute((
+               'select serial, snippet(words, -1, \'\', \'\', \'...\', 10) from words '
+               'where words match ? order by rank limit ?'), (query, limit)).fetchall()
+         except sqlite3.OperationalError:
+            matches = []
+
+      if not len(matches):
+         needle = text.lower()
+         for serial, desc in self.db.execute((
+            'select serial, description from systems '
+            'where instr(lower(description), ?) or instr(lower(serial), ?) '
+            'order by serial limit ?'), (needle, needle, limit)):
+            line = next((line for line in desc.splitlines() if needle in line.lower()), '')
+            matches.append((serial, line.strip()))
+
+      return [(serial, ' '.join(excerpt.split())) for serial, excerpt in matches]
@@ -0,0 +1,131 @@
+# Waits for the kernel (and udev) to finish doing something to a device,
+# instead of sleeping for what's hopefully long enough.
+#
+# Every wait here has a condition it re-checks whenever a uevent arrives on
+# a netlink socket, so it finishes the moment the device is ready. The
+# condition is also checked every 'poll_interval' seconds, in case netlink
+# isn't available or the event was one we'd never see, so a wait is never
+# worse than polling. None of this touches the screen; it's safe to use
+# from worker threads.
+
+import os
+import time
+import shutil
+import select
+import socket
+import subprocess
+
+# <linux/netlink.h>
+netlink_kobject_uevent = 15
+
+# Kernel uevents are multicast group 1; udev passes them on, once it's done
+# with them, on group 2.
+uevent_groups = 1 | 2
+
+poll_interval = 0.25
+default_timeout = 10.0
+
+def uevent_socket ():
+   # A socket that gets every uevent, or None if we can't have one.
+   try:
+      sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, netlink_kobject_uevent)
+      sock.bind((0, uevent_groups))
+      return sock
+   except (AttributeError, OSError):
+      return None
+
+def drain (sock, wait):
+   # Waits up to 'wait' seconds for uevents and throws them away; the
+   # conditions decide what mattered. Returns how many came in. An error
+   # (ENOBUFS, when the socket overflowed while nobody was reading it)
+   # means some were lost, so it counts as one too.
+   count = 0
+   ready, _, _ = select.select([sock], [], [], wait)
+   while len(ready):
+      try:
+         sock.recv(65536)
+      except OSError:
+         count += 1
+         break
+      count += 1
+      ready, _, _ = select.select([sock], [], [], 0)
+   return count
+
+def wait_for (check, timeout = None):
+   # Waits until check() is true, or 'timeout' seconds go by. Returns
+   # whether it came true.
+   limit = time.monotonic() + (default_timeout if timeout is None else timeout)
+
+   # Listen before the first check, so nothing can slip in between.
+   sock = uevent_socket()
+   try:
+      while not check():
+         left = limit - time.monotonic()
+         if left <= 0:
+            return False
+         if sock is None:
+            time.sleep(min(left, poll_interval))
+         else:
+            drain(sock, min(left, poll_interval))
+      return True
+   finally:
+      if sock is not None:
+         sock.close()
+
+def wait_device (path, timeout = None):
+   # Waits for a device node (a disk, a partition) to show up.
+   return wait_for(lambda: os.path.exists(path), timeout)
+
+def wait_quiet (quiet = 0.2, timeout = None):
+   # Waits until no uevents have come in for 'quiet' seconds.
+   limit = time.monotonic() + (default_timeout if timeout is None else timeout)
+   sock = uevent_socket()
+   if sock is None:
+      time.sleep(quiet)
+      return True
+
+   try:
+      while drain(sock, quiet):
+         if time.monotonic() > limit:
+            return False
+      return True
+   finally:
+      sock.close()
+
+def settle (timeout = None):
+   # Waits for udev to deal with every event so far: device nodes, links,
+   # and the probing it does after a disk is written to.
+   timeout = default_timeout if timeout is None else timeout
+   udevadm = shutil.which('udevadm')
+   if udevadm is None:
+      return wait_quiet(timeout = timeout)
+
+   proc = subprocess.run([udevadm, 'settle', f'--timeout={max(1, int(timeout))}'],
+      stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+   return proc.returncode == 0
+
+def mounted (mounts, path):
+   # Is anything mounted at 'path' (or is 'path', a device, mounted)?
+   # 'mounts' is an open /proc/self/mounts.
+   mounts.seek(0)
+   for line in mounts.read().splitlines():
+      fields = line.split()
+      if len(fields) >= 2 and path in (fields[0], fields[1].replace('\\040', ' ')):
+         return True
+   return False
+
+def wait_unmounted (path, timeout = None):
+   # Waits until nothing's mounted at 'path'. The kernel flags the mount
+   # table with POLLPRI whenever it changes, so this needs no uevents.
+   limit = time.monotonic() + (default_timeout if timeout is None else timeout)
+   path = path.rstrip('/') or '/'
+
+   with open('/proc/self/mounts', 'r') as mounts:
+      poller = select.poll()
+      poller.register(mounts, select.POLLPRI | select.POLLERR)
+      while mounted(mounts, path):
+         left = limit - time.monotonic()
+         if left <= 0:
+            return False
+         poller.poll(int(min(left, poll_interval) * 1000))
+   return True
@@ -0,0 +1,347 @@
+# Captures SD cards into compressed, block-indexed images and writes them
+# back again.
+#
+# An image is an ordinary .xz file that "xz -d" can unpack, made of one
+# xz stream per block of the card. Next to it sits a small JSON index
+# (<image>.index) recording where each block's stream starts, how long it
+# is, its SHA-256 and whether it is all zeros, so a restore can seek to any
+# block and skip the empty ones.
+#
+# Only the parts of the card that hold data are read: the partition table is
+# parsed, and for ext2/3/4 partitions the block bitmaps say which blocks are
+# actually allocated. Everything else is stored as zeros without touching
+# the card.
+
+import os
+import re
+import json
+import lzma
+import stat
+import queue
+import struct
+import hashlib
+import threading
+import concurrent.futures
+
+import utils
+
+# Size of each independently compressed block.
+block_size = 8 * 1024 * 1024
+
+# Same tuning "xz -e -9" used, but with the dictionary capped to the block
+# size so each compression thread needs ~100 MB instead of ~700 MB.
+filters = [{
+   'id': lzma.FILTER_LZMA2,
+   'preset': 9 | lzma.PRESET_EXTREME,
+   'dict_size': block_size}]
+
+index_suffix = '.index'
+
+nonzero = re.compile(rb'[^\x00]+')
+
+def read_partitions (fd):
+   # Parses the MBR and returns a list of (type, offset, length) in bytes
+   # for each primary partition.
+   mbr = os.pread(fd, 512, 0)
+   if len(mbr) < 512 or mbr[510:512] != b'\x55\xaa':
+      return []
+
+   parts = []
+   for n in range(4):
+      entry = mbr[446 + n * 16:446 + (n + 1) * 16]
+      kind = entry[4]
+      start, count = struct.unpack('<II', entry[8:16])
+      if kind == 0 or count == 0:
+         continue
+      parts.append((kind, start * 512, count * 512))
+
+   return parts
+
+def ext_allocated (fd, offset, length):
+   # Returns a list of (offset, length) ranges that an ext2/3/4 file system
+   # at 'offset' has in use, or None if it isn't one we understand (in which
+   # case the caller should treat all of it as in use).
+   sb = os.pread(fd, 1024, offset + 1024)
+   if len(sb) < 1024 or sb[56:58] != b'\x53\xef':
+      return None
+
+   blocks, = struct.unpack('<I', sb[4:8])
+   first_block, log_size, _, per_group = struct.unpack('<IIII', sb[20:36])
+   incompat, = struct.unpack('<I', sb[96:100])
+   ro_compat, = struct.unpack('<I', sb[100:104])
+   size = 1024 << log_size
+
+   if incompat & 0x80:
+      # 64-bit file systems have bigger group descriptors.
+      desc_size, = struct.unpack('<H', sb[254:256])
+      blocks |= struct.unpack('<I', sb[336:340])[0] << 32
+   else:
+      desc_size = 32
+
+   # Lazily-initialized bitmaps (uninit_bg, metadata_csum) can't be trusted.
+   lazy = ro_compat & (0x10 | 0x400)
+
+   if blocks * size > length or per_group == 0:
+      return None
+
+   groups = (blocks - first_block + per_group - 1) // per_group
+   table = os.pread(fd, groups * desc_size, offset + (first_block + 1) * size)
+   if len(table) < groups * desc_size:
+      return None
+
+   ranges = []
+   for group in range(groups):
+      desc = table[group * desc_size:(group + 1) * desc_size]
+      bitmap_block, = struct.unpack('<I', desc[0:4])
+      flags, = struct.unpack('<H', desc[18:20])
+      base = first_block + group * per_group
+      count = min(per_group, blocks - base)
+
+      if lazy and flags & 0x2:
+         # BLOCK_UNINIT: nothing in this group is in use except its own
+         # metadata, which lives somewhere we can't cheaply tell. Keep it all.
+         ranges.append((offset + base * size, count * size))
+         continue
+
+      # Runs of non-zero bytes in the bitmap cover everything in use, give
+      # or take a few blocks on either end, which is close enough.
+      bitmap = os.pread(fd, size, offset + bitmap_block * size)
+      for run in nonzero.finditer(bitmap, 0, (count + 7) // 8):
+         first, last = run.start() * 8, min(run.end() * 8, count)
+         ranges.append((offset + (base + first) * size, (last - first) * size))
+
+   # Block 0 (and the boot sector in front of a 1K-block file system) is
+   # never in the bitmap but is always needed.
+   ranges.insert(0, (offset, (first_block + 1) * size))
+   return ranges
+
+def used_blocks (fd, length):
+   # Works out which of the image's blocks need to be read at all.
+   # Everything is needed unless a file system says otherwise.
+   count = (length + block_size - 1) // block_size
+   needed = [True] * count
+
+   for kind, offset, part_len in read_partitions(fd):
+      if kind != 0x83:
+         continue
+
+      ranges = ext_allocated(fd, offset, part_len)
+      if ranges is None:
+         continue
+
+      # Start by assuming the blocks fully inside this partition are empty,
+      # then mark the ones that hold something.
+      first = (offset + block_size - 1) // block_size
+      last = (offset + part_len) // block_size
+      for n in range(first, min(last, count)):
+         needed[n] = False
+
+      for start, size in ranges:
+         for n in range(start // block_size, min((start + size - 1) // block_size + 1, count)):
+            needed[n] = True
+
+   return needed
+
+def compress_block (data):
+   # Runs on a worker thread; lzma and hashlib both let go of the GIL.
+   return (lzma.compress(data, format = lzma.FORMAT_XZ, filters = filters),
+      hashlib.sha256(data).hexdigest())
+
+def capture (dev, dest, threads = 4, callback = None):
+   # Image 'dev' into 'dest'. 'callback' gets (bytes done, total bytes,
+   # bytes actually read) no more than utils.progress_fps times a second.
+   # Returns the index that was written next to the image.
+   throttle = utils.Throttle()
+   fd = os.open(dev, os.O_RDONLY)
+
+   try:
+      length = os.lseek(fd, 0, os.SEEK_END)
+      needed = used_blocks(fd, length)
+
+      # Every empty block compresses to exactly the same thing.
+      zero_job = compress_block(bytes(block_size))
+      blocks = []
+      done = 0
+      read = 0
+      position = 0
+
+      with open(dest, 'wb') as out, \
+         concurrent.futures.ThreadPoolExecutor(max_workers = threads) as pool:
+
+         pending = []
+
+         def flush (limit):
+            # Write out finished blocks in order, keeping at most 'limit'
+            # in flight so memory stays bounded.
+            nonlocal position, done
+            while len(pending) > limit:
+               size, job = pending.pop(0)
+               zero = job is zero_job
+               stream, digest = job.result() if not zero else job
+
+               out.write(stream)
+               blocks.append((position, len(stream), digest, zero))
+               position += len(stream)
+               done += size
+
+               if callable(callback) and throttle.ready():
+                  callback(done, length, read)
+
+         for n, need in enumerate(needed):
+            size = min(block_size, length - n * block_size)
+
+            if need:
+               data = os.pread(fd, size, n * block_size)
+               read += len(data)
+               if len(data) < size:
+                  raise IOError(f'Short read from {dev} at block {n}.')
+            else:
+               data = None
+
+            if size == block_size and (data is None or data.count(0) == size):
+               pending.append((size, zero_job))
+            else:
+               pending.append((size, pool.submit(compress_block, data if data is not None else bytes(size))))
+
+            flush(threads * 2)
+
+         flush(0)
+   finally:
+      os.close(fd)
+
+   index = {
+      'block_size': block_size,
+      'length': length,
+      'blocks': blocks}
+
+   with open(dest + index_suffix, 'w') as f:
+      f.write(json.dumps(index))
+
+   if callable(callback):
+      callback(length, length, read)
+
+   return index
+
+def load_index (src):
+   # Returns the block index for an image, or None for an image without one
+   # (such as those made by the old "dd | xz" pipeline).
+   try:
+      with open(src + index_suffix, 'r') as f:
+         return json.loads(f.read())
+   except (IOError, OSError, ValueError):
+      return None
+
+def decompress_block (fd, position, length):
+   # Runs on a worker thread.
+   data = lzma.decompress(os.pread(fd, length, position), format = lzma.FORMAT_XZ)
+   return (data, hashlib.sha256(data).hexdigest())
+
+def device_size (fd):
+   # Size of a block device, or None if it's just a file.
+   if not stat.S_ISBLK(os.fstat(fd).st_mode):
+      return None
+   return os.lseek(fd, 0, os.SEEK_END)
+
+def restore (src, dev, threads = 4, callback = None):
+   # Write an image back to 'dev' in a single streaming pass. Blocks are
+   # decompressed on worker threads and handed to this thread through a
+   # bounded queue, so memory use stays flat however big the card is.
+   # Every block is checked against the hash in the index as it goes by.
+   #
+   # 'callback' gets (bytes done, total bytes, bytes written) no more than
+   # utils.progress_fps times a second. Returns the SHA-256 of everything
+   # written for images without an index, or True for those with one.
+   index = load_index(src)
+   block = index['block_size'] if index else utils.block_size
+   throttle = utils.Throttle()
+   pending = queue.Queue(maxsize = threads * 2)
+   src_fd = os.open(src, os.O_RDONLY)
+   total = index['length'] if index else os.fstat(src_fd).st_size
+   stop = threading.Event()
+
+   def put (item):
+      # Don't block forever if the writer has given up.
+      while not stop.is_set():
+         try:
+            pending.put(item, timeout = 0.25)
+            return True
+         except queue.Full:
+            pass
+      return False
+
+   def feed_indexed (pool):
+      for n, (position, length, digest, zero) in enumerate(index['blocks']):
+         size = min(block, total - n * block)
+         job = None if zero else pool.submit(decompress_block, src_fd, position, length)
+         if not put((n * block, size, job, digest)):
+            return
+
+   def feed_stream (pool):
+      # Without an index the .xz has to be unpacked in order, so there's
+      # only one decompressor (our thread); xz checks its own CRCs as it goes.
+      raw = utils.CountingReader(os.fdopen(os.dup(src_fd), 'rb'))
+      offset = 0
+      with lzma.open(raw, 'rb') as f:
+         while True:
+            data = f.read(block)
+            if not data: break
+            if not put((offset, len(data), data, raw.count)):
+               return
+            offset += len(data)
+
+   def feed ():
+      try:
+         with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as pool:
+            (feed_indexed if index else feed_stream)(pool)
+            put(None)
+      except BaseException as e:
+         put(e)
+
+   writer = utils.DirectWriter(dev, block = block)
+   feeder = threading.Thread(target = feed, daemon = True)
+   digest = hashlib.sha256()
+   written = 0
+
+   try:
+      size = device_size(writer.fd)
+      if index and size is not None and size < total:
+         raise IOError(f'{dev} is too small for this image ({total} bytes needed, {size} available).')
+
+      feeder.start()
+
+      while True:
+         item = pending.get()
+         if item is None: break
+         if isinstance(item, BaseException): raise item
+
+         offset, size, job, check = item
+
+         if index and job is None:
+            # An empty block.
+            if not writer.zero(offset, size):
+               writer.write(offset, bytes(size))
+            done = offset + size
+         elif index:
+            data, actual = job.result()
+            if actual != check or len(data) != size:
+               raise ValueError(f'Block {offset // block} of {src} is corrupt.')
+            writer.write(offset, data)
+            done = offset + size
+         else:
+            digest.update(job)
+            writer.write(offset, job)
+            done = check
+
+         written = offset + size
+         if callable(callback) and throttle.ready():
+            callback(done, total, written)
+   finally:
+      stop.set()
+      writer.close()
+      feeder.join()
+      os.close(src_fd)
+
+   if callable(callback):
+      callback(total, total, written)
+
+   return True if index else digest.hexdigest()
@@ -9,6 +9,13 @@ from __main__ import stdscr, crumb, del_crumb
 import math
 
 waiting_window = None
+
+# Called every tenth of a second or so while we're waiting for a key, so
+# that background work (see jobs.py) can be shown as it goes.
+idle_hooks = []
+
+# The window get_key() is reading keys for, if it was told.
+key_window = None
 output_window = None
 output_scroll_window = None
 
@@ -313,7 +320,7 @@ def question (text,
 
    ret = False
    while True:
-      key = stdscr.getch()
+      key = get_key(win)
 
       # ASCII?
       if key < 255:
@@ -349,7 +356,7 @@ def question (text,
    if isinstance(ret, bool): return ret
    return ret.upper()
 
-def viewer (text, rows = None, cols = None, row = None, col = None, colors = None, attrs = None, title = None, center = False, show_meter = True):
+def viewer (text, rows = None, cols = None, row = None, col = None, colors = None, attrs = None, title = None, center = False, show_meter = True, find = None):
    # Use a reasonably-sized window?
    if rows is None:
       rows = curses.LINES - 8
@@ -393,6 +400,14 @@ def viewer (text, rows = None, cols = None, row = None, col = None, colors = Non
    #win.addstr(4, 4, f'{scroll_limit}')
    scroll_pct = 0.0
 
+   # Open at the first line of 'find', if it's in there. A long line is
+   # wrapped, so look for its first piece.
+   if find is not None:
+      for y, line in enumerate(text):
+         if len(line) >= min(len(find), wrap_width // 2) and find.startswith(line):
+            scroll = max(0, min(y, scroll_limit))
+            break
+
    # Help text
    up, down = gfx_chars.up_arrow, gfx_chars.down_arrow
    help_text = f'{up}/{down}/PgUp/PgDn: Scroll Text     Enter: Go Back'
@@ -428,7 +443,7 @@ def viewer (text, rows = None, cols = None, row = None, col = None, colors = Non
          redraw()
          need_draw = False
 
-      key = stdscr.getch()
+      key = get_key(win)
 
       # ASCII escape?
       if key == 27 or (key < 255 and chr(key) in '\r\n'):
@@ -550,6 +565,35 @@ def end_wait ():
    stdscr.touchwin()
    stdscr.refresh()
 
+def get_key (win = None):
+   # stdscr.getch(), but background jobs keep being drawn while we wait.
+   # 'win' is the window waiting for the key, so they can keep out of it.
+   global key_window
+   if not len(idle_hooks):
+      return stdscr.getch()
+
+   key_window = win
+   stdscr.timeout(100)
+   try:
+      while True:
+         key = stdscr.getch()
+         if key != -1:
+            return key
+         for hook in idle_hooks:
+            hook()
+   finally:
+      stdscr.timeout(-1)
+      key_window = None
+
+def covers (row):
+   # Is screen row 'row' under a window that's up right now?
+   for win in (key_window, waiting_window, output_window):
+      if win is not None:
+         top = win.getbegyx()[0]
+         if top <= row < top + win.getmaxyx()[0]:
+            return True
+   return False
+
 help_list = []
 last_help_text = ''
 def help (help_text = None):
@@ -610,7 +654,7 @@ class Observe:
 
    def wait_key (self, specific = None):
       while True:
-         key = stdscr.getch()
+         key = get_key(self.win)
 
          if specific is not None:
             if isinstance(specific, str) and key < 255:
@@ -645,7 +689,7 @@ class Observe:
          errwin = newwin(8, 60, colors = 10, title = 'Error',
             text = 'Something went wrong. Try again, or talk to Steven.\n\nPress any key.')
          errwin.refresh()
-         stdscr.getch()
+         get_key(errwin)
          del errwin
          stdscr.touchwin()
          stdscr.refresh()
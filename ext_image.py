@@ -0,0 +1,273 @@
+# Builds ext2 file systems with everything already on them, straight onto
+# a partition (or into an image file), instead of formatting, mounting and
+# copying files in one by one.
+#
+# mke2fs -d fills the new file system from a directory. Whatever the
+# files should end up owned by, and whatever modes they should have, are
+# then set with debugfs on the unmounted file system, so there's no
+# "sudo chown -R" or "chmod -R" walk, and no device nodes need creating on
+# this machine. Root file systems come from Buildroot's rootfs.tar.gz,
+# unpacked once into './cache/trees' and reused for every card after.
+
+import os
+import json
+import stat
+import shutil
+import hashlib
+import tempfile
+import posixpath
+import subprocess
+
+import utils
+
+tree_cache_dir = './cache/trees'
+default_kind = 'ext2'
+
+class ImageError (Exception):
+   pass
+
+class Contents:
+   # What goes on one file system. Anything added later wins over what's
+   # already there. Modes are the permission bits only (0o755, say); None
+   # keeps whatever the source has.
+   def __init__ (self, tarball = None):
+      self.tarball = tarball
+      self.trees = []
+      self.files = []
+      self.modes = {}
+
+   def add_tree (self, src, dest = '/', mode = None, uid = 0, gid = 0):
+      # Everything under 'src', directories included.
+      self.trees.append((src, fs_path(dest), mode, uid, gid))
+
+   def add_file (self, dest, data, mode = 0o644, uid = 0, gid = 0):
+      if isinstance(data, str): data = data.encode('utf-8')
+      self.files.append((fs_path(dest), data, mode, uid, gid))
+
+   def set_mode (self, dest, mode):
+      self.modes[fs_path(dest)] = mode
+
+   def is_empty (self):
+      return self.tarball is None and not len(self.trees) and not len(self.files)
+
+def fs_path (path):
+   return posixpath.normpath('/' + path.strip('/'))
+
+def tool (name):
+   # e2fsprogs lives in /sbin, which isn't always on a user's path.
+   return shutil.which(name) or shutil.which(name, path = '/usr/sbin:/sbin') or name
+
+def file_type (member):
+   if member.isdir(): return stat.S_IFDIR
+   if member.issym(): return stat.S_IFLNK
+   if member.ischr(): return stat.S_IFCHR
+   if member.isblk(): return stat.S_IFBLK
+   if member.isfifo(): return stat.S_IFIFO
+   return stat.S_IFREG
+
+def unpack_tarball (src, callback = None):
+   # Unpacks a root file system tarball, as far as someone who isn't root
+   # can, and remembers what the tar said about every entry. Returns
+   # (tree, meta, specials): 'meta' maps each path to [mode, uid, gid] and
+   # 'specials' lists the device nodes and FIFOs that were left out, as
+   # [path, mode, uid, gid, major, minor]. The result is kept until the
+   # tarball changes.
+   info = os.stat(src)
+   prefix = hashlib.sha1(os.path.abspath(src).encode('utf-8')).hexdigest()[:8]
+   tree = f'{tree_cache_dir}/{prefix}_{info.st_size}_{info.st_mtime_ns}'
+
+   try:
+      with open(f'{tree}.json', 'r') as f:
+         saved = json.load(f)
+      if os.path.isdir(tree):
+         return tree, saved['meta'], saved['specials']
+   except (OSError, ValueError, KeyError):
+      pass
+
+   # Only the newest tree for each tarball is worth keeping.
+   os.makedirs(tree_cache_dir, exist_ok = True)
+   for entry in os.scandir(tree_cache_dir):
+      if entry.name.startswith(prefix + '_'):
+         if entry.is_dir(follow_symlinks = False):
+            shutil.rmtree(entry.path)
+         else:
+            os.remove(entry.path)
+
+   meta = {}
+   specials = []
+
+   def transform (member):
+      path = fs_path(member.name)
+      kind = file_type(member)
+      mode = kind | (member.mode & 0o7777)
+      if kind in (stat.S_IFCHR, stat.S_IFBLK, stat.S_IFIFO):
+         specials.append([path, mode, member.uid, member.gid, member.devmajor, member.devminor])
+         return None
+
+      # The real modes go on later. Until then we have to be able to read
+      # everything, and to get into (and later delete) every directory.
+      meta[path] = [mode, member.uid, member.gid]
+      member.mode = (member.mode & 0o7777) | (0o700 if kind == stat.S_IFDIR else 0o600)
+      return member
+
+   work = f'{tree}.tmp'
+   utils.extract_tarball(src, work, callback = callback, transform = transform)
+   os.rename(work, tree)
+
+   with open(f'{tree}.json.tmp', 'w') as f:
+      json.dump({'meta': meta, 'specials': specials}, f)
+   os.replace(f'{tree}.json.tmp', f'{tree}.json')
+   return tree, meta, specials
+
+def place (src, dst):
+   # Hard-links 'src' in where we can, so staging costs next to nothing.
+   # Whatever was at 'dst' may be a link into the cached tree, so it's
+   # unlinked rather than written over.
+   if os.path.lexists(dst):
+      os.unlink(dst)
+   try:
+      os.link(src, dst)
+   except OSError:
+      shutil.copy2(src, dst)
+
+def link_tree (src, dst, dest, meta, mode, uid, gid):
+   # Stages the tree at 'src' into 'dst', which is 'dest' on the new file
+   # system.
+   for where, dirs, files in os.walk(src):
+      rel = os.path.relpath(where, src)
+      rel = '' if rel == '.' else rel
+      os.makedirs(os.path.join(dst, rel), exist_ok = True)
+      info = os.lstat(where)
+      if rel or dest != '/':
+         # The top of the file system itself is left to mke2fs.
+         meta[fs_path(posixpath.join(dest, rel))] = [stat.S_IFDIR | (stat.S_IMODE(info.st_mode) if mode is None else mode), uid, gid]
+
+      for name in files + [name for name in dirs if os.path.islink(os.path.join(where, name))]:
+         path = os.path.join(where, name)
+         target = os.path.join(dst, rel, name)
+         info = os.lstat(path)
+         if stat.S_ISLNK(info.st_mode):
+            if os.path.lexists(target): os.unlink(target)
+            os.symlink(os.readlink(path), target)
+         elif stat.S_ISREG(info.st_mode):
+            place(path, target)
+         else:
+            continue
+         bits = stat.S_IMODE(info.st_mode) if mode is None or stat.S_ISLNK(info.st_mode) else mode
+         meta[fs_path(posixpath.join(dest, rel, name))] = [stat.S_IFMT(info.st_mode) | bits, uid, gid]
+
+def stage (contents, callback = None):
+   # Puts everything in one directory for mke2fs. Returns (tree, meta,
+   # specials, work); 'work' is a directory for the caller to remove, if
+   # one had to be made.
+   meta = {}
+   specials = []
+   base = None
+   if contents.tarball is not None:
+      base, meta, specials = unpack_tarball(contents.tarball, callback)
+      meta = dict(meta)
+
+   if not len(contents.trees) and not len(contents.files):
+      return base, meta, specials, None
+
+   os.makedirs(tree_cache_dir, exist_ok = True)
+   work = tempfile.mkdtemp(prefix = 'stage_', dir = tree_cache_dir)
+   try:
+      # mke2fs gives the top of the file system the same mode.
+      os.chmod(work, 0o755)
+      if base is not None:
+         link_tree(base, work, '/', {}, None, 0, 0)
+
+      for src, dest, mode, uid, gid in contents.trees:
+         if not os.path.isdir(src):
+            raise FileNotFoundError(f'{src} does not exist.')
+         link_tree(src, work + dest, dest, meta, mode, uid, gid)
+
+      for dest, data, mode, uid, gid in contents.files:
+         target = work + dest
+         os.makedirs(os.path.dirname(target), exist_ok = True)
+         if os.path.lexists(target): os.unlink(target)
+         with open(target, 'wb') as f:
+            f.write(data)
+         meta[dest] = [stat.S_IFREG | mode, uid, gid]
+   except:
+      shutil.rmtree(work, ignore_errors = True)
+      raise
+
+   return work, meta, specials, work
+
+def quote (path):
+   # debugfs takes a doubled quote inside quotes as a quote, and has no
+   # other escapes; a name with a line break in it can't be given at all.
+   if '\n' in path or '\r' in path:
+      raise ImageError(f'debugfs can\'t handle the line break in {path!r}.')
+   return '"' + path.replace('"', '""') + '"'
+
+def owner_script (tree, meta, specials, modes):
+   # debugfs commands that give everything its owner and mode. Anything
+   # nobody said anything about belongs to root and keeps its mode.
+   lines = []
+
+   def set_inode (path, mode, uid, gid):
+      if path in modes:
+         mode = stat.S_IFMT(mode) | modes[path]
+      lines.append(f'sif {quote(path)} mode 0{mode:o}')
+      lines.append(f'sif {quote(path)} uid {uid}')
+      lines.append(f'sif {quote(path)} gid {gid}')
+
+   if tree is not None:
+      for where, dirs, files in os.walk(tree):
+         for name in [''] + dirs + files:
+            path = os.path.join(where, name) if name else where
+            rel = fs_path(os.path.relpath(path, tree))
+            if rel == '/.': rel = '/'
+            if rel in meta:
+               set_inode(rel, *meta[rel])
+            else:
+               set_inode(rel, os.lstat(path).st_mode, 0, 0)
+
+   for path, mode, uid, gid, major, minor in specials:
+      kind = {stat.S_IFCHR: 'c', stat.S_IFBLK: 'b'}.get(stat.S_IFMT(mode), 'p')
+      lines.append(f'cd {quote(posixpath.dirname(path))}')
+      lines.append(f'mknod {quote(posixpath.basename(path))} {kind}' + (f' {major} {minor}' if kind != 'p' else ''))
+      lines.append('cd /')
+      set_inode(path, mode, uid, gid)
+
+   return lines
+
+def build (target, contents, label = None, kind = default_kind, size = None, callback = None):
+   # Makes a file system on 'target' (a partition, or an image file of
+   # 'size' bytes) holding 'contents'. 'callback' gets the unpacking
+   # progress, as utils.extract_tarball() gives it. Raises ImageError or
+   # OSError if it can't.
+   if size is not None:
+      with open(target, 'ab') as f:
+         f.truncate(size)
+
+   tree, meta, specials, work = stage(contents, callback)
+   try:
+      command = [tool('mke2fs'), '-q', '-F', '-t', kind, '-E', 'root_owner=0:0']
+      if label is not None:
+         command += ['-L', label]
+      if tree is not None:
+         command += ['-d', tree]
+      proc = subprocess.run(command + [target], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+      if proc.returncode != 0:
+         raise ImageError(f'mke2fs failed on {target}: {proc.stderr.decode("utf-8", "replace").strip()}')
+
+      script = owner_script(tree, meta, specials, contents.modes)
+      with tempfile.NamedTemporaryFile('w', suffix = '.debugfs') as f:
+         f.write('\n'.join(script) + '\n')
+         f.flush()
+         proc = subprocess.run([tool('debugfs'), '-w', '-f', f.name, target],
+            stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+
+      # debugfs carries on past a failed command and still exits with 0;
+      # only its complaints on stderr say something went wrong.
+      problems = [line for line in proc.stderr.decode('utf-8', 'replace').splitlines()
+         if len(line.strip()) and not line.startswith('debugfs ')]
+      if proc.returncode != 0 or len(problems):
+         raise ImageError(f'Unable to set owners on {target}: {"; ".join(problems[:3])}')
+   finally:
+      if work is not None:
+         shutil.rmtree(work, ignore_errors = True)
@@ -0,0 +1,322 @@
+# Builds a FAT32 file system image from a list of files, without mkfs,
+# mount or a file-by-file copy onto the card.
+#
+# Every directory and file gets one contiguous run of clusters, laid out
+# in the order they're written, so the image comes out front to back in a
+# single pass: boot sector, FATs, then the data. Nothing past the last
+# used cluster needs writing at all. Given the same files (and their
+# mtimes) the image is the same byte for byte, so it can be cached.
+
+import os
+import time
+import struct
+import hashlib
+import posixpath
+from array import array
+
+sector_size = 512
+reserved_sectors = 32
+num_fats = 2
+fsinfo_sector = 1
+backup_boot_sector = 6
+root_cluster = 2
+
+# FAT32 needs at least this many clusters, or it's really FAT16.
+min_clusters = 65525
+
+end_of_chain = 0x0fffffff
+media = 0xf8
+
+attr_volume_id = 0x08
+attr_directory = 0x10
+attr_archive = 0x20
+attr_long_name = 0x0f
+
+# Characters a short (8.3) name can't have.
+short_invalid = set(' "*+,./:;<=>?[\\]|')
+
+class FatError (Exception):
+   pass
+
+class Node:
+   # A file or directory in the image. 'source' is a path on this machine
+   # or the file's contents as bytes.
+   def __init__ (self, name, is_dir, source = None, mtime = None):
+      self.name = name
+      self.is_dir = is_dir
+      self.source = source
+      self.mtime = mtime
+      self.children = []
+      self.size = 0
+      self.cluster = 0
+      self.clusters = 0
+      self.short = None
+      self.needs_long = False
+
+def sectors_per_cluster (total_sectors):
+   # Microsoft's table for FAT32 cluster sizes.
+   for limit, count in ((532480, 1), (16777216, 8), (33554432, 16), (67108864, 32)):
+      if total_sectors <= limit:
+         return count
+   return 64
+
+def dos_time (mtime):
+   # (date, time) the way directory entries keep them. FAT has no time
+   # zones; its times are local, like the ones mkfs and cp used to leave.
+   if mtime is None:
+      return 0x21, 0
+   t = time.localtime(mtime)
+   year = min(max(t.tm_year, 1980), 2107)
+   return ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday, (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+
+def short_name (name, taken):
+   # The 8.3 name for 'name', as the 11 bytes that go in its entry, and
+   # whether it needs long name entries as well. A numeric tail (~1) is
+   # only added when something had to be dropped or the name is taken.
+   base, dot, ext = name.rpartition('.')
+   if not dot or not base:
+      base, ext = name, ''
+
+   def clean (text):
+      return ''.join('_' if c in short_invalid or ord(c) < 0x20 or ord(c) > 0x7e else c for c in text.upper())
+
+   short_base, short_ext = clean(base), clean(ext)
+   lossy = (short_base != base.upper() or short_ext != ext.upper()
+      or len(short_base) > 8 or len(short_ext) > 3)
+   short_ext = short_ext[:3]
+
+   plain = (short_base[:8].ljust(8) + short_ext.ljust(3)).encode('ascii')
+   if not lossy and plain not in taken:
+      return plain, name != name.upper()
+
+   for n in range(1, 1000000):
+      tail = f'~{n}'
+      candidate = ((short_base[:8 - len(tail)] + tail).ljust(8) + short_ext.ljust(3)).encode('ascii')
+      if candidate not in taken:
+         return candidate, True
+   raise FatError(f'Too many files like "{name}".')
+
+def checksum (short):
+   total = 0
+   for byte in short:
+      total = (((total & 1) << 7) + (total >> 1) + byte) & 0xff
+   return total
+
+def long_entries (name, short):
+   # The long name entries for 'name', in the order they go in the
+   # directory (last part first).
+   chars = name.encode('utf-16-le')
+   units = [chars[n:n + 2] for n in range(0, len(chars), 2)]
+   if len(units) > 255:
+      raise FatError(f'"{name}" is too long for FAT.')
+   if len(units) % 13:
+      units += [b'\x00\x00'] + [b'\xff\xff'] * (12 - len(units) % 13)
+
+   parts = [units[n:n + 13] for n in range(0, len(units), 13)]
+   check = checksum(short)
+   entries = []
+   for n, part in enumerate(parts, 1):
+      order = n | (0x40 if n == len(parts) else 0)
+      entries.append(bytes((order,)) + b''.join(part[:5]) + bytes((attr_long_name, 0, check)) +
+         b''.join(part[5:11]) + b'\x00\x00' + b''.join(part[11:13]))
+   return list(reversed(entries))
+
+def entry (short, attr, cluster, size, mtime):
+   date, clock = dos_time(mtime)
+   return struct.pack('<11sBBBHHHHHHHI', short, attr, 0, 0, clock, date, date,
+      cluster >> 16, clock, date, cluster & 0xffff, size)
+
+def make_tree (files):
+   # 'files' is [(path in the image, source)]; directories along the way
+   # are made as needed. Returns the root Node.
+   root = Node('', True)
+   dirs = {'': root}
+
+   def directory (path):
+      if path not in dirs:
+         parent = directory(posixpath.dirname(path))
+         node = Node(posixpath.basename(path), True)
+         parent.children.append(node)
+         dirs[path] = node
+      return dirs[path]
+
+   for path, source in files:
+      path = posixpath.normpath(path.strip('/'))
+      if isinstance(source, (bytes, bytearray)):
+         node = Node(posixpath.basename(path), False, bytes(source))
+         node.size = len(source)
+      else:
+         info = os.stat(source)
+         node = Node(posixpath.basename(path), False, source, info.st_mtime)
+         node.size = info.st_size
+         if node.size > 0xffffffff:
+            raise FatError(f'{source} is too big for FAT.')
+      directory(posixpath.dirname(path)).children.append(node)
+
+   # Sorted, so the same files always make the same image.
+   for node in dirs.values():
+      node.children.sort(key = lambda child: child.name)
+   return root
+
+def name_children (node):
+   taken = set()
+   for child in node.children:
+      child.short, child.needs_long = short_name(child.name, taken)
+      taken.add(child.short)
+
+def dir_entries (node, parent, label):
+   # The raw directory entries for 'node'; the root is its own parent.
+   out = []
+   if node is parent:
+      out.append(entry(label, attr_volume_id, 0, 0, None))
+   else:
+      out.append(entry(b'.'.ljust(11), attr_directory, node.cluster, 0, node.mtime))
+      # '..' pointing at the root is cluster 0, by convention.
+      up = 0 if parent.cluster == root_cluster else parent.cluster
+      out.append(entry(b'..'.ljust(11), attr_directory, up, 0, node.mtime))
+
+   for child in node.children:
+      if child.needs_long:
+         out += long_entries(child.name, child.short)
+      attr = attr_directory if child.is_dir else attr_archive
+      out.append(entry(child.short, attr, child.cluster, 0 if child.is_dir else child.size, child.mtime))
+   return b''.join(out)
+
+def walk (node):
+   # Directories and files in the order their clusters are given out.
+   yield node, None
+   pending = [node]
+   while len(pending):
+      parent = pending.pop(0)
+      for child in parent.children:
+         yield child, parent
+         if child.is_dir:
+            pending.append(child)
+
+def count_entries (node, is_root):
+   count = 1 if is_root else 2
+   for child in node.children:
+      count += 1 + (len(long_entries(child.name, child.short)) if child.needs_long else 0)
+   return count
+
+class Layout:
+   def __init__ (self, files, size, label = 'BOOT', hidden = 0):
+      self.total_sectors = size // sector_size
+      self.spc = sectors_per_cluster(self.total_sectors)
+      self.cluster_size = self.spc * sector_size
+      self.hidden = hidden
+      self.label = label.upper().encode('ascii', 'replace')[:11].ljust(11)
+
+      # From Microsoft's FAT specification.
+      left = self.total_sectors - reserved_sectors
+      self.fat_sectors = -(-left // ((256 * self.spc + num_fats) // 2))
+      self.data_start = reserved_sectors + num_fats * self.fat_sectors
+      self.cluster_count = (self.total_sectors - self.data_start) // self.spc
+      if self.cluster_count < min_clusters:
+         raise FatError(f'{size // (1024 * 1024)} MiB is too small for FAT32.')
+
+      self.root = make_tree(files)
+      self.order = list(walk(self.root))
+
+      # Give out the clusters.
+      next_cluster = root_cluster
+      for node, parent in self.order:
+         if node.is_dir:
+            name_children(node)
+         length = count_entries(node, parent is None) * 32 if node.is_dir else node.size
+         node.clusters = max(1, -(-length // self.cluster_size)) if node.is_dir or length else 0
+         if node.clusters:
+            node.cluster = next_cluster
+            next_cluster += node.clusters
+      if next_cluster - root_cluster > self.cluster_count:
+         raise FatError(f'The files don\'t fit in {size // (1024 * 1024)} MiB.')
+      self.used = next_cluster - root_cluster
+
+      self.volume_id = struct.unpack('<I', hashlib.sha1(repr([(node.name, node.size, node.mtime)
+         for node, parent in self.order]).encode('utf-8')).digest()[:4])[0]
+
+   def boot_sector (self):
+      sector = bytearray(sector_size)
+      struct.pack_into('<3s8sHBHBHHBHHHII', sector, 0, b'\xeb\x58\x90', b'mkfs.fat',
+         sector_size, self.spc, reserved_sectors, num_fats, 0, 0, media, 0, 63, 255,
+         self.hidden, self.total_sectors)
+      struct.pack_into('<IHHIHH12sBBBI11s8s', sector, 36, self.fat_sectors, 0, 0, root_cluster,
+         fsinfo_sector, backup_boot_sector, bytes(12), 0x80, 0, 0x29, self.volume_id,
+         self.label, b'FAT32   ')
+      sector[510:512] = b'\x55\xaa'
+      return bytes(sector)
+
+   def fsinfo (self):
+      sector = bytearray(sector_size)
+      struct.pack_into('<I', sector, 0, 0x41615252)
+      struct.pack_into('<III', sector, 484, 0x61417272,
+         self.cluster_count - self.used, root_cluster + self.used)
+      struct.pack_into('<I', sector, 508, 0xaa550000)
+      return bytes(sector)
+
+   def fat (self):
+      table = array('I', [0]) * (self.fat_sectors * sector_size // 4)
+      table[0] = 0x0fffff00 | media
+      table[1] = end_of_chain
+      for node, parent in self.order:
+         if node.clusters:
+            first = node.cluster
+            last = first + node.clusters - 1
+            table[first:last] = array('I', range(first + 1, last + 1))
+            table[last] = end_of_chain
+      if table.itemsize != 4:
+         raise FatError('array(\'I\') isn\'t 32 bits here.')
+      if struct.pack('=I', 1) != struct.pack('<I', 1):
+         table.byteswap()
+      return table.tobytes()
+
+   def length (self):
+      # How much of the image actually has to be written.
+      return (self.data_start + self.used * self.spc) * sector_size
+
+   def chunks (self, block = 1 << 20):
+      # The image from the front, up to length(), in pieces of about
+      # 'block' bytes.
+      reserved = bytearray(reserved_sectors * sector_size)
+      for where in (0, backup_boot_sector):
+         reserved[where * sector_size:(where + 1) * sector_size] = self.boot_sector()
+         reserved[(where + 1) * sector_size:(where + 2) * sector_size] = self.fsinfo()
+      yield bytes(reserved)
+
+      fat = self.fat()
+      for n in range(num_fats):
+         yield fat
+
+      for node, parent in self.order:
+         if not node.clusters:
+            continue
+         room = node.clusters * self.cluster_size
+         if node.is_dir:
+            data = dir_entries(node, parent or node, self.label)
+            if len(data) > room:
+               raise FatError(f'Directory "{node.name}" outgrew its clusters.')
+            yield data + bytes(room - len(data))
+            continue
+
+         if isinstance(node.source, bytes):
+            yield node.source + bytes(room - node.size)
+            continue
+
+         done = 0
+         with open(node.source, 'rb') as f:
+            while done < node.size:
+               data = f.read(min(block, node.size - done))
+               if not data:
+                  raise FatError(f'{node.source} got shorter while it was being read.')
+               done += len(data)
+               yield data
+         yield bytes(room - node.size)
+
+def write_image (path, files, size, label = 'BOOT', hidden = 0):
+   # Writes the image to 'path' (only as far as it's used) and returns the
+   # Layout.
+   layout = Layout(files, size, label = label, hidden = hidden)
+   with open(path, 'wb') as f:
+      for chunk in layout.chunks():
+         f.write(chunk)
+   return layout
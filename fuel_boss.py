@@ -2,6 +2,7 @@ import os
 import datetime
 
 import draw
+import utils
 from menu import menu
 from text_input import text_input
 from __main__ import crumb, del_crumb, stdscr
@@ -25,6 +26,7 @@ fuel_boss_data = {
       #'dir': f'{fuel_boss_dir}/StableFB-2021-05-04-with-receipt-printer',
       'dir': f'{fuel_boss_dir}/StableFB-2022-01-03',
       'func': lambda x: fuel_boss_stable_pi2.build(x),
+      'module': fuel_boss_stable_pi2,
       'main_menu': True,
       'portal': False,
       'staging_dir': staging_dir
@@ -33,6 +35,7 @@ fuel_boss_data = {
       'name': 'Fuel-Boss 2.0, Pi 4',
       'dir': f'{fuel_boss_dir}/FuelBossTNG',
       'func': lambda x: fuel_boss_2_stable_pi4.build(x),
+      'module': fuel_boss_2_stable_pi4,
       'main_menu': True,
       'portal': False,
       'staging_dir': staging_dir
@@ -41,6 +44,7 @@ fuel_boss_data = {
       'name': 'Master Slave System, Pi 2',
       'dir': f'{fuel_boss_dir}/MasterSlaveFB-2021-08-20',
       'func': lambda x: fuel_boss_stable_pi2.build(x),
+      'module': fuel_boss_stable_pi2,
       'main_menu': True,
       'portal': False,
       'staging_dir': staging_dir
@@ -49,6 +53,7 @@ fuel_boss_data = {
       'name': 'Portal Fuel-Boss, Pi 2',
       'dir': f'{fuel_boss_dir}/StableFB-with-portal',
       'func': lambda x: fuel_boss_stable_pi2.build(x),
+      'module': fuel_boss_stable_pi2,
       'main_menu': True,
       'portal': True,
       'staging_dir': staging_dir
@@ -57,6 +62,7 @@ fuel_boss_data = {
       'name': 'Road Ranger, Rock Island',
       'dir': '2019-07-06_StableFB_Road-Ranger',
       'func': None,
+      'module': None,
       'main_menu': False,
       'staging_dir': staging_dir
    }
@@ -273,6 +279,46 @@ def show_all (recent_first = False):
 
    del_crumb()
 
+def rebuild ():
+   # Write a saved image of an existing system back onto an SD card.
+   import config
+   import sd_card
+
+   where_dir = f'{utils.storage_dir}/Fuel-Boss-Images'
+   if not utils.is_nas_available() or not os.path.exists(where_dir):
+      draw.message(f'The image directory ({where_dir}) is not available.', colors = 10)
+      return
+
+   images = sorted(e.name for e in os.scandir(where_dir) if e.name.endswith('.img.xz'))
+   if not len(images):
+      draw.message('There are no saved Fuel Boss images.')
+      return
+
+   crumb('Rebuild an Existing System')
+   sel = menu([(name[:-len('.img.xz')], name) for name in images], title = 'Select an Image')
+   if sel == -1:
+      del_crumb()
+      return
+
+   card = sd_card.SDCardBuilder()
+   result = card.find_sd_card()
+   if result == True:
+      # Don't unmount anything out from under a background job either.
+      error = sd_card.busy_error(config.get('sd_card_device'))
+      if error is not None:
+         draw.message(error, colors = 10)
+         del_crumb()
+         return
+
+      sd_card.Partitioner().unmount_all()
+      draw.begin_wait(f'Restoring {sel}...')
+      ok = utils.restore_disk_image(f'{where_dir}/{sel}', config.get('sd_card_device'))
+      draw.end_wait()
+      if ok:
+         draw.message('The SD card was successfully restored!', colors = 11)
+
+   del_crumb()
+
 def do_fuel_boss ():
    crumb('Build a Fuel Boss')
    ret = 0
@@ -305,16 +305,6 @@ def make_xml_tanks_file (data, dest):
 
    return utils.save_xml(root, cfg)
 
-def make_rssh (card):
-   # And what about reverse SSH?
-   os.system(f'chmod +x {card.root_path}/etc/init.d/S90rssh')
-   os.system(f'mkdir -p {card.root_path}/root/.ssh')
-   os.system(f'scp -v all-line@192.168.1.2:/home/all-line/.ssh/id_rsa.pub {card.root_path}/root/.ssh/id_rsa.pub')
-
-   # Now make a cron entry that (re)starts ssh every hour or so
-   os.system(f'mkdir -p {card.conf_path}/cron')
-   os.system(f"echo '0 */1 * * * /etc/init.d/S90rssh check >/dev/null 2>&1' >> {card.conf_path}/cron/root")
-
 def make_managed_mode_file (data, dest):
    cfg = f'{dest}/managed-mode.xml'
 
@@ -441,35 +431,14 @@ def make_config_files (data):
 
 def make_sd_card (data):
    card = sd_card.SDCardBuilder()
-   if not card.build():
-      return False
 
-   # Clear existing program data.
-   if len(card.prog_path) > 1:
-      os.system(f'sudo rm -fr {card.prog_path}/*')
+   # The program data and our configuration, both belonging to root.
+   card.prog.add_tree(data['staging_dir'], mode = 0o755)
+   card.conf.add_file('build.cfg', json.dumps(data), mode = 0o777)
 
-   # Copy the program data.
-   try:
-      utils.copy_tree(data['staging_dir'], card.prog_path)
-   except (IOError, OSError, PermissionError, FileNotFoundError) as e:
-      draw.message((f'Unable to copy Fuel Boss software to {card.prog_path}.\n'
-         '\n'
-         f'Python says: {e}'),
-         colors = 10)
+   if not card.build():
       return False
 
-   # Now change ownership and permissions.
-   os.system(f'sudo chown -R root:root {card.prog_path}/*')
-   os.system(f'sudo chmod -R 755 {card.prog_path}/*')
-
-   # Copy our configuration to the config partition.
-   with open(card.conf_path + '/build.cfg', 'w') as f:
-      f.write(json.dumps(data))
-
-   # Again, change ownership and permissions.
-   os.system(f'sudo chown -R root:root {card.conf_path}/*')
-   os.system(f'sudo chmod -R 777 {card.conf_path}/*')
-
    # Set up the network.
    network = {
       'address': data['ip'],
@@ -502,7 +471,14 @@ def make_sd_card (data):
       default = 0, escape = 1)
 
    if result == 'Y':
-      utils.create_disk_image(config.get('sd_card_device'), where)
+      # This carries on in the background; the card has to stay put until
+      # Background Jobs says it's done.
+      if utils.create_disk_image(config.get('sd_card_device'), where, background = True):
+         draw.message((
+            'The image is being made in the background.\n'
+            '\n'
+            'Leave the SD card where it is until it\'s finished. Its progress is '
+            'shown at the top of the screen.'), colors = 11)
 
    return True
 
@@ -520,7 +496,7 @@ def create_staging_dir (data):
       os.mkdir(dest)
       os.mkdir(f'{dest}/firmware')
 
-def program_main_board (data):
+def program_main_board (data, prog = None):
    # The mainboard code changes depending on selected features.
    # These are stored in inc/features.h
    # We'll use the DefinitionEditor to modify these.
@@ -572,7 +548,8 @@ def program_main_board (data):
       'Press ENTER when ready, to ESCAPE to cancel.\n'
       'You can also press S to skip this step.')
 
-   prog = programmer.BoardProgrammer()
+   own = prog is None
+   if own: prog = programmer.BoardProgrammer()
    prog.add_target('atmega640',
       message = message,
       title = 'Program IO Controller',
@@ -583,12 +560,13 @@ def program_main_board (data):
       copy_to = f'{data["staging_dir"]}/firmware',
       copy_name = 'io')
 
-   if not prog.program():
+   # A shared programmer gets run by the caller, all targets at once.
+   if own and not prog.program():
       return False
 
    return True
 
-def program_debounce (data):
+def program_debounce (data, prog = None):
    # The debounce code never really changes. Just upload the binary.
    message = ('Power the Fuel Boss on with no SD card inserted.\n'
       '\n'
@@ -598,7 +576,8 @@ def program_debounce (data):
       'Press ENTER when ready, or ESCAPE to cancel.\n'
       'You can also press S to skip this step.')
 
-   prog = programmer.BoardProgrammer()
+   own = prog is None
+   if own: prog = programmer.BoardProgrammer()
    prog.add_target('attiny2313',
       message = message,
       title = 'Program Debounce Chip',
@@ -609,12 +588,13 @@ def program_debounce (data):
       copy_to = f'{data["staging_dir"]}/firmware',
       copy_name = 'debounce')
 
-   if not prog.program():
+   # A shared programmer gets run by the caller, all targets at once.
+   if own and not prog.program():
       return False
 
    return True
 
-def program_dfm_board (data):
+def program_dfm_board (data, prog = None):
    # As with the debounce, the DFM code never really changes.
    message = ('Power the Fuel Boss on with no SD card inserted.\n'
       'Ensure that the tank gauge/DFM board is connected.\n'
@@ -625,7 +605,8 @@ def program_dfm_board (data):
       'Press ENTER when ready, or ESCAPE to cancel.\n'
       'You can also press S to skip this step.')
 
-   prog = programmer.BoardProgrammer()
+   own = prog is None
+   if own: prog = programmer.BoardProgrammer()
    prog.add_target('atmega328pb',
       message = message,
       title = 'Program Tank Gauge/DFM Board',
@@ -636,7 +617,8 @@ def program_dfm_board (data):
       copy_to = f'{data["staging_dir"]}/firmware',
       copy_name = 'dfm')
 
-   if not prog.program():
+   # A shared programmer gets run by the caller, all targets at once.
+   if own and not prog.program():
       return False
 
    return True
@@ -652,11 +634,9 @@ def copy_program (data):
       '*.pyc', '*.bat', 'finalize.sh', 'integrated_finalize.sh',
       'make_update.sh', 'new_finalize.sh', 'remote_update.sh',
       'tags', 'todo.txt', 'testing_cycle.sh', 'staging', 'unused']
-   def copy_func (s, d):
-      nonlocal ignore
-      draw.write_output(f'Copying {s}...')
-      time.sleep(0.01)
-      #return shutil.copy2(s, d)
+   def copy_func (done, total, path):
+      if path is not None:
+         draw.write_output(f'Copied {done // 1024:,}K of {total // 1024:,}K: {path}')
 
    try:
       utils.copy_tree(
@@ -670,10 +650,10 @@ def copy_program (data):
    draw.end_output()
    return True
 
-def build (info):
-   crumb(info['name'])
-
-   data = {
+def default_data (info):
+   # A new unit's settings, before anyone has changed them. build() edits
+   # these through its menu; build_cli.py takes them from a job spec.
+   return {
       # Data about where things are
       'portal': info['portal'],
       'staging_dir': info['staging_dir'],
@@ -702,6 +682,43 @@ def build (info):
       'dhcp': False
    }
 
+def build_unit (data, sd_only = False):
+   # Builds the whole unit 'data' describes (or only its SD card) and
+   # returns a list of what went wrong, which is empty if nothing did.
+   errors = []
+   create_staging_dir(data)
+
+   if not sd_only:
+      # Gather up every chip, then program them together so that
+      # several programmers can work at once.
+      prog = programmer.BoardProgrammer()
+      program_debounce(data, prog)
+      if not program_main_board(data, prog):
+         errors.append('- Unable to compile IO chip software')
+
+      if data['tank_monitor'] == 'Serial':
+         program_dfm_board(data, prog)
+
+      prog.program()
+      for target in prog.failed:
+         errors.append(f'- Unable to {target.title[0].lower()}{target.title[1:]}')
+
+   if not copy_program(data):
+      errors.append('- Unable to copy Pi software to staging directory')
+
+   if not make_config_files(data):
+      errors.append('- Unable to generate Fuel Boss configuration files')
+
+   if not make_sd_card(data):
+      errors.append('- Unable to build an SD card')
+
+   return errors
+
+def build (info):
+   crumb(info['name'])
+
+   data = default_data(info)
+
    ret = 0
    q = '"'
    while True:
@@ -918,28 +935,8 @@ def build (info):
       elif ret == 'dhcp':
          data['dhcp'] = not data['dhcp']
 
-      elif ret == 'done':
-         errors = []
-         create_staging_dir(data)
-         if not program_debounce(data):
-            errors.append('- Unable to program debounce chip')
-
-         if not program_main_board(data):
-            errors.append('- Unable to program IO chip')
-
-         if data['tank_monitor'] == 'Serial':
-            if not program_dfm_board(data):
-               errors.append('- Unable to program DFM board')
-
-         if not copy_program(data):
-            errors.append('- Unable to copy Pi software to staging directory')
-
-         if not make_config_files(data):
-            errors.append('- Unable to generate Fuel Boss configuration files')
-
-         if not make_sd_card(data):
-            errors.append('- Unable to build an SD card')
-
+      elif ret == 'done' or ret == 'sd_card':
+         errors = build_unit(data, sd_only = ret == 'sd_card')
          if len(errors):
             errors = 'The following errors occurred:\n\n' + '\n'.join(errors)
             viewer = draw.viewer(
@@ -948,17 +945,6 @@ def build (info):
                title = 'Something Went Wrong',
                colors = 10, attrs = curses.A_BOLD)
 
-      elif ret == 'sd_card':
-         create_staging_dir(data)
-         if not copy_program(data):
-            errors.append('- Unable to copy Pi software to staging directory')
-
-         if not make_config_files(data):
-            errors.append('- Unable to generate Fuel Boss configuration files')
-
-         if not make_sd_card(data):
-            draw.message('Unable to complete the SD card build process.', colors = 10)
-
       elif ret == -1:
          result = draw.question(('Cancel this Fuel Boss build?'),
             default = 1, escape = 0)
@@ -0,0 +1,181 @@
+# Lets the build pipelines run with nobody at the keyboard.
+#
+# install() swaps the screen-drawing parts of draw, utils, jobs and
+# programmer for versions that write one JSON object per line instead, and
+# answers draw.question() from a list of rules. Anything that would need a
+# menu or typed text raises HeadlessError, since there's nobody to ask.
+#
+# Everything here has to be in place before the product modules are
+# imported, because they pull 'menu' and 'text_input' in by name.
+
+import re
+import sys
+import json
+import time
+import curses
+
+# The same question asked more often than this is going round in circles
+# (usually "try again?"), so it gets its escape answer instead.
+max_repeats = 3
+
+# Stand-ins for the terminal curses would have given us.
+lines = 50
+cols = 160
+
+out = None
+job = None
+answers = []
+asked = {}
+
+class HeadlessError (Exception):
+   pass
+
+class NullWindow:
+   # Takes every drawing call and does nothing with it.
+   def __init__ (self, rows = None, cols_ = None, *args):
+      self.rows = rows or lines
+      self.cols = cols_ or cols
+
+   def getmaxyx (self):
+      return self.rows, self.cols
+
+   def getbegyx (self):
+      return 0, 0
+
+   def getch (self):
+      return 27
+
+   def __getattr__ (self, name):
+      return lambda *args, **kwargs: None
+
+def emit (event, **fields):
+   record = {'time': round(time.time(), 3), 'event': event}
+   if job is not None:
+      record['job'] = job
+   record.update(fields)
+   out.write(json.dumps(record) + '\n')
+   out.flush()
+
+def level (colors):
+   if colors == 10: return 'error'
+   if colors == 11: return 'success'
+   return 'info'
+
+def choice_keys (choices):
+   # The hot key of each choice, the letter after its '&'.
+   keys = []
+   for choice in choices:
+      n = choice.find('&')
+      keys.append(choice[n + 1].upper() if n >= 0 and n + 1 < len(choice) else '')
+   return keys
+
+def answer (text, rows = None, cols = None, row = None, col = None, colors = None,
+   attrs = None, title = None, center = True, choices = None, choice_w = None,
+   default = None, escape = None):
+   # Replaces draw.question(). The first rule whose pattern is found in the
+   # question wins; then the question's own default, then its escape.
+   if choices is None:
+      choices = ('&Yes', '&No')
+
+   asked[text] = asked.get(text, 0) + 1
+   keys = choice_keys(choices)
+
+   if not len(keys):
+      result = True
+   elif asked[text] > max_repeats and escape is not None:
+      result = keys[escape]
+   else:
+      result = None
+      for pattern, key in answers:
+         if re.search(pattern, text, re.I) and key.upper() in keys:
+            result = key.upper()
+            break
+      if result is None and default is not None:
+         result = keys[default]
+      if result is None and escape is not None:
+         result = keys[escape]
+
+   if result is None or asked[text] > max_repeats * 2:
+      emit('question', text = text, choices = keys, answer = None)
+      raise HeadlessError(f'Nobody to answer "{text.splitlines()[0]}"')
+
+   emit('question', text = text, choices = keys, answer = result)
+   return result
+
+def install (stream = None):
+   global out
+   out = stream or sys.stdout
+
+   curses.LINES = lines
+   curses.COLS = cols
+   curses.color_pair = lambda n: 0
+   curses.newwin = NullWindow
+   curses.newpad = NullWindow
+
+   import draw
+   import menu
+   import text_input
+
+   def nobody (*args, title = None, prompt = None, **kwargs):
+      raise HeadlessError(f'"{title or prompt or "A menu"}" needs someone at the keyboard.')
+
+   # These first, so that everything imported from here on picks them up.
+   menu.menu = nobody
+   text_input.text_input = nobody
+
+   import utils
+   import jobs
+   import programmer
+
+   def message (text, coords = None, rows = None, cols = None, button_text = None,
+      title = None, center = True, colors = None):
+      emit('message', text = text, level = level(colors), title = title)
+
+   def viewer (text, rows = None, cols = None, row = None, col = None, colors = None,
+      attrs = None, title = None, **kwargs):
+      emit('message', text = text, level = level(colors), title = title)
+
+   def begin_wait (text, title = None, colors = None, **kwargs):
+      if isinstance(text, list):
+         text = '\n'.join(text)
+      emit('wait', text = text, level = level(colors))
+
+   def begin_output (title = None, **kwargs):
+      emit('output', title = title or 'Output')
+
+   def write_output (text):
+      if not isinstance(text, str): text = text.decode('ascii', 'replace')
+      emit('output', text = text.rstrip())
+
+   last_percent = {}
+   def draw_progress (is_write, percent, clear = False, **kwargs):
+      # Whole percents are plenty for a log.
+      if clear or last_percent.get(is_write) == int(percent):
+         return
+      last_percent[is_write] = int(percent)
+      emit('progress', what = 'write' if is_write else 'read', percent = int(percent))
+
+   def draw_status ():
+      emit('jobs', jobs = [job.summary() for job in jobs.jobs])
+
+   def draw_jobs (self, win, chips):
+      emit('chips', chips = [{
+         'title': chip.target.title or chip.target.device,
+         'port': chip.port,
+         'state': chip.error or chip.state,
+         'percent': round(chip.percent, 1),
+         'finished': chip.finished} for chip in chips])
+
+   draw.message = message
+   draw.question = answer
+   draw.viewer = viewer
+   draw.begin_wait = begin_wait
+   draw.end_wait = lambda: None
+   draw.begin_output = begin_output
+   draw.write_output = write_output
+   draw.end_output = lambda: None
+   draw.help = lambda help_text = None: None
+   draw.newwin = lambda rows = None, cols = None, *args, **kwargs: NullWindow(rows, cols)
+   utils.draw_progress = draw_progress
+   jobs.draw_status = draw_status
+   programmer.BoardProgrammer.draw_jobs = draw_jobs
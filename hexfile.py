@@ -0,0 +1,177 @@
+# Reads, merges and writes Intel HEX files without leaving Python.
+#
+# An image is kept as a sorted list of non-overlapping segments, each a
+# start address and a bytearray, so a bootloader at the top of a 256K
+# part and a program at the bottom cost only what they actually hold.
+
+import os
+import bisect
+import hashlib
+
+# Flash sizes, in bytes, of every part we program.
+flash_sizes = {
+   'attiny2313': 2 * 1024,
+   'atmega88': 8 * 1024,
+   'atmega328p': 32 * 1024,
+   'atmega328pb': 32 * 1024,
+   'atmega640': 64 * 1024,
+   'atmega644p': 64 * 1024,
+   'atmega1280': 128 * 1024,
+   'atmega2560': 256 * 1024}
+
+# Data bytes per record when writing, same as srec_cat and avr-objcopy.
+record_size = 16
+
+class HexError (ValueError):
+   pass
+
+class HexImage:
+   def __init__ (self):
+      self.starts = []
+      self.segments = []
+
+   @classmethod
+   def read (cls, filename):
+      image = cls()
+      image.load(filename)
+      return image
+
+   def load (self, filename):
+      # Adds every data record in an Intel HEX file to this image.
+      base = 0
+      with open(filename, 'r') as f:
+         for nr, line in enumerate(f, 1):
+            line = line.strip()
+            if not line: continue
+
+            if not line.startswith(':'):
+               raise HexError(f'{filename}, line {nr}: not an Intel HEX record.')
+            try:
+               record = bytes.fromhex(line[1:])
+            except ValueError:
+               raise HexError(f'{filename}, line {nr}: bad hex digits.')
+
+            if len(record) < 5 or len(record) != record[0] + 5:
+               raise HexError(f'{filename}, line {nr}: wrong record length.')
+            if sum(record) & 0xFF:
+               raise HexError(f'{filename}, line {nr}: bad checksum.')
+
+            kind = record[3]
+            data = record[4:-1]
+            if kind == 0x00:
+               self.add(base + (record[1] << 8 | record[2]), data)
+            elif kind == 0x01:
+               break
+            elif kind == 0x02:
+               base = int.from_bytes(data, 'big') << 4
+            elif kind == 0x04:
+               base = int.from_bytes(data, 'big') << 16
+            # 0x03 and 0x05 are start addresses, which AVRs don't use.
+
+   def add (self, address, data):
+      # Puts 'data' at 'address'. Raises HexError if any of it is already
+      # taken; joins up with neighbouring segments where it touches them.
+      if not len(data):
+         return
+
+      end = address + len(data)
+      n = bisect.bisect_right(self.starts, address)
+
+      # The segment before might reach into us, or end right where we begin.
+      if n > 0:
+         prev_start = self.starts[n - 1]
+         prev_end = prev_start + len(self.segments[n - 1])
+         if prev_end > address:
+            raise HexError(f'Overlap at 0x{address:05X}.')
+         if prev_end == address:
+            self.segments[n - 1] += data
+            n -= 1
+            address = prev_start
+         else:
+            self.starts.insert(n, address)
+            self.segments.insert(n, bytearray(data))
+      else:
+         self.starts.insert(n, address)
+         self.segments.insert(n, bytearray(data))
+
+      # And the one after might start inside us, or right where we end.
+      if n + 1 < len(self.starts):
+         next_start = self.starts[n + 1]
+         if next_start < end:
+            raise HexError(f'Overlap at 0x{next_start:05X}.')
+         if next_start == end:
+            self.segments[n] += self.segments.pop(n + 1)
+            self.starts.pop(n + 1)
+
+   def merge (self, other):
+      for start, data in zip(other.starts, other.segments):
+         self.add(start, data)
+      return self
+
+   def size (self):
+      # Bytes actually used.
+      return sum(len(data) for data in self.segments)
+
+   def end (self):
+      # One past the highest address used.
+      if not len(self.starts):
+         return 0
+      return self.starts[-1] + len(self.segments[-1])
+
+   def digest (self):
+      digest = hashlib.sha1()
+      for start, data in zip(self.starts, self.segments):
+         digest.update(start.to_bytes(4, 'big'))
+         digest.update(data)
+      return digest.hexdigest()
+
+   def check_fits (self, device):
+      # Raises HexError if this image won't fit in 'device'. Parts we don't
+      # know the size of are let through.
+      size = flash_sizes.get(device.lower())
+      if size is not None and self.end() > size:
+         raise HexError(
+            f'The image runs up to 0x{self.end():05X}, but the {device} only has '
+            f'{size // 1024}K of flash.')
+
+   def to_hex (self):
+      lines = []
+      upper = 0
+
+      def record (kind, address, data):
+         body = bytes((len(data), (address >> 8) & 0xFF, address & 0xFF, kind)) + data
+         return ':' + (body + bytes(((-sum(body)) & 0xFF,))).hex().upper()
+
+      for start, data in zip(self.starts, self.segments):
+         pos = 0
+         while pos < len(data):
+            address = start + pos
+            if address >> 16 != upper:
+               upper = address >> 16
+               lines.append(record(0x04, 0, upper.to_bytes(2, 'big')))
+
+            # Don't let a record run over a 64K boundary.
+            count = min(record_size, len(data) - pos, 0x10000 - (address & 0xFFFF))
+            lines.append(record(0x00, address & 0xFFFF, bytes(data[pos:pos + count])))
+            pos += count
+
+      lines.append(':00000001FF')
+      return '\n'.join(lines) + '\n'
+
+   def to_bin (self, fill = 0xFF):
+      # Raw image from address 0, with the gaps filled in.
+      out = bytearray([fill]) * self.end()
+      for start, data in zip(self.starts, self.segments):
+         out[start:start + len(data)] = data
+      return bytes(out)
+
+   def write (self, filename):
+      # Writes to a temporary name first, so nobody ever sees half a file.
+      temp = f'{filename}.{os.getpid()}.tmp'
+      if filename.endswith('.bin'):
+         with open(temp, 'wb') as f:
+            f.write(self.to_bin())
+      else:
+         with open(temp, 'w') as f:
+            f.write(self.to_hex())
+      os.replace(temp, filename)
@@ -6,6 +6,7 @@ import curses
 import time
 
 import config
+import data_index
 import draw
 import utils
 import programmer
@@ -21,6 +22,11 @@ from logger import log_debug
 # to change.
 
 injector_data = './data/injector'
+index = data_index.DataIndex(injector_data, './cache/injector_index.db')
+
+# Directory listings of ./compile, so the Advanced Compile menu only reads
+# what changed each time it's shown.
+header_cache = utils.WalkCache()
 default_fuses = {
    'hfuse': '0xD0',
    'lfuse': '0xFF',
@@ -68,9 +74,6 @@ class InjectorProgrammer:
 
       crumb(os.path.basename(defs.filename))
 
-      # Create a copy of the original data
-      originals = defs.items[:]
-
       while True:
          menu_items = [
             ('I\'m done making changes.', 'ok'), 
@@ -103,8 +106,9 @@ class InjectorProgrammer:
          ret = menu(menu_items)
 
          if ret == -1 or ret == 'quit':
-            defs.items.clear()
-            defs.items = originals[:]
+            # Throw the changes away. The header's parse is cached, so
+            # this doesn't read it again.
+            defs.find_defines()
             break
 
          elif ret == 'ok':
@@ -159,7 +163,7 @@ class InjectorProgrammer:
 
          # Get all possible header definitions
          all_defs = {}
-         header_files = utils.find_files(f'./compile', '.h', 'endswith')
+         header_files = utils.find_files(f'./compile', '.h', 'endswith', cache = header_cache)
          for header in header_files:
             defs = compiler.DefinitionEditor(header['path'])
             all_defs[defs.filename] = defs
@@ -282,7 +286,7 @@ class InjectorProgrammer:
       # If we don't find the bootloader, that's okay, but the user will
       # get a warning a bit later.
       draw.message(f'Version path is {self.version_path}.')
-      files = utils.find_files(self.version_path, '.hex', compare = 'endswith')
+      files = index.files(self.serial, self.version_path)
       self.main_files = [e for e in files if e['is_main'] and 'main' in e['name']]
       self.debounce_files = [e for e in files if e['is_debounce']]
       self.boot_files = [e for e in files if e['is_bootloader']]
@@ -300,6 +304,9 @@ class InjectorProgrammer:
          draw.end_wait()
          return False
       draw.end_wait()
+
+      # Whatever was just built shows up in can_program() straight away.
+      index.refresh(self.serial)
       return True
 
    def program (self):
@@ -380,7 +387,13 @@ class InjectorProgrammer:
          can_skip = True,
          speed = 1)
 
-      if not prog.program():
+      programmed = prog.program()
+
+      # The combined file was only wanted for this.
+      if filename != self.main_hex and os.path.exists(filename):
+         os.remove(filename)
+
+      if not programmed:
          draw.message('Something went wrong while programming the CPU.', colors = 10)
          return False
 
@@ -424,20 +437,17 @@ class InjectorProgrammer:
             # They'd like to cancel.
             return False
 
-      time.sleep(0.8)
       draw.end_wait()
 
       # Copy the firmware file and our local copy of the VDIP firmware.
       draw.begin_wait('Copying files...')
       shutil.copy(self.main_hex, f'{usb_scan.mount_dir}/firmware.bin')
       shutil.copy(self.vdip_firmware, f'{usb_scan.mount_dir}/ftrfb.ftd')
-      time.sleep(0.8)
       draw.end_wait()
 
       # Unmount.
       draw.begin_wait('Unmounting USB Flash drive...')
       usb_scan.unmount_device(result)
-      time.sleep(0.8)
       draw.end_wait()
 
       draw.begin_wait('You can now remove the USB Flash drive.', colors = 11)
@@ -447,27 +457,11 @@ class InjectorProgrammer:
       # Success, probably.
       return True
 
-def gather_descriptions ():
-   descs = {}
-   nondescs = 0
-
-   for entry in os.scandir(injector_data):
-      # Skip?
-      if not entry.is_dir(): continue
-      if not os.path.exists(f'{entry.path}/desc.txt'): 
-         nondescs += 1
-         continue
-
-      # It has it.
-      descs[entry.name] = open(f'{entry.path}/desc.txt', 'r').read().lower()
-
-   return descs, nondescs
-
 def search_descriptions ():
    crumb('Search All Descriptions')
 
    draw.begin_wait('Gathering descriptions...')
-   descs, nondescs = gather_descriptions()
+   descs, nondescs = index.counts()
    draw.end_wait()
 
    win = draw.newwin(20, 60, title = 'Search Descriptions', text =
@@ -476,7 +470,7 @@ def search_descriptions ():
        'Some older systems may not have a description file and cannot be searched, '
        'contradicting my previous sentence.\n'
        '\n'
-       f'I have found {len(descs)} systems with description files. Cross your fingers that it\'s '
+       f'I have found {descs} systems with description files. Cross your fingers that it\'s '
        f'one of those! That means there are {nondescs} systems without description files.\n'
        '\n'
        '\n'
@@ -499,12 +493,8 @@ def search_descriptions ():
       stdscr.refresh()
       return False
 
-   # Search away!
-   ret = ret.lower()
-   matches = []
-   for desc in descs:
-      if ret in descs[desc]:
-         matches.append((desc, desc))
+   # Search away! Best matches come first.
+   matches = [(f'{serial.ljust(12)}{excerpt[:70]}', serial) for serial, excerpt in index.search(ret)]
 
    if len(matches):
       draw.message((
@@ -539,7 +529,7 @@ def search_descriptions ():
 
 def show_all_injectors (recent_first = False):
    title = 'All Serial Numbers'
-   serials = [(serial, serial) for serial in sorted(os.listdir(injector_data))]
+   serials = [(serial, serial) for serial in index.serials()]
    ret = 0
 
    crumb(title)
@@ -0,0 +1,255 @@
+# Runs long jobs on background threads so the station isn't tied up by one
+# of them at a time.
+#
+# A job's function gets its Job as the first argument and reports back
+# with job.progress() and job.log(). Those only put events on a queue; it's
+# the main thread, between key presses (see draw.get_key), that applies
+# them and redraws. Job functions must never touch the screen themselves.
+#
+# Only jobs handed to start() leave the operator free: disk imaging
+# (utils.create_disk_image with background=True) and Buildroot board caching
+# (BuildrootCompiler.cache_board). Firmware compiles and Buildroot builds for
+# a card go through run(), which still holds the operator until they finish,
+# since the card build asks questions along the way.
+
+import time
+import queue
+import curses
+import threading
+import traceback
+
+import draw
+import utils
+import gfx_chars
+import block_devices
+from menu import menu
+from __main__ import stdscr, crumb, del_crumb
+
+# Where the one-line job summary goes, just under the crumbs.
+status_row = 3
+
+# How many finished jobs to keep around for the Background Jobs screen.
+max_finished = 20
+
+events = queue.Queue()
+jobs = []
+throttle = utils.Throttle()
+
+# Set when the summary line couldn't be drawn because a window was over it.
+stale = False
+
+class JobBusy (Exception):
+   pass
+
+class Job:
+   def __init__ (self, name, func, args = (), kwargs = None, resource = None):
+      self.name = name
+      self.func = func
+      self.args = args
+      self.kwargs = kwargs or {}
+      self.resource = resource
+      self.state = 'Waiting'
+      self.text = ''
+      self.percent = None
+      self.lines = []
+      self.result = None
+      self.error = None
+      self.trace = None
+      self.finished = False
+      self.seen = False
+      self.began = None
+      self.ended = None
+      self.thread = threading.Thread(target = self.run, daemon = True)
+
+   # These are called on the job's own thread.
+
+   def progress (self, percent = None, text = None):
+      events.put((self, 'progress', (percent, text)))
+
+   def log (self, text):
+      events.put((self, 'log', text))
+
+   def run (self):
+      events.put((self, 'started', time.monotonic()))
+      try:
+         result = self.func(self, *self.args, **self.kwargs)
+         events.put((self, 'done', result))
+      except Exception as e:
+         events.put((self, 'failed', (str(e) or type(e).__name__, traceback.format_exc())))
+
+   # And this one on the main thread.
+
+   def apply (self, kind, data):
+      if kind == 'started':
+         self.began = data
+         self.state = 'Running'
+      elif kind == 'progress':
+         percent, text = data
+         if percent is not None: self.percent = percent
+         if text is not None: self.text = text
+      elif kind == 'log':
+         self.lines.append(data)
+      elif kind == 'done':
+         self.result = data
+         self.state = 'Done' if data is not False else 'Failed'
+         self.finished = True
+      elif kind == 'failed':
+         self.error, self.trace = data
+         self.state = 'Failed'
+         self.finished = True
+
+      if self.finished:
+         self.ended = time.monotonic()
+
+   def elapsed (self):
+      if self.began is None:
+         return 0
+      return int((self.ended if self.finished else time.monotonic()) - self.began)
+
+   def summary (self):
+      text = f'{self.name}: {self.state}'
+      if self.error:
+         text += f' ({self.error})'
+      elif self.percent is not None and not self.finished:
+         text += f' {self.percent:.0f}%'
+      if self.text and not self.finished:
+         text += f', {self.text}'
+      return text
+
+def running ():
+   return [job for job in jobs if not job.finished]
+
+def holder (resource):
+   # The running job using 'resource', if there is one.
+   for job in running():
+      if job.resource == resource:
+         return job
+   return None
+
+def device_holder (dev):
+   # The running job using 'dev', or the disk it's a partition of. Nothing
+   # should write to a device while this says something is reading it.
+   busy = holder(dev)
+   if busy is None:
+      disk = block_devices.disk_of(dev)
+      if disk is not None and disk.path != dev:
+         busy = holder(disk.path)
+   return busy
+
+def start (name, func, *args, resource = None, **kwargs):
+   # Starts 'func(job, *args, **kwargs)' in the background and returns the
+   # Job. Raises JobBusy if another running job holds 'resource' (a device,
+   # a source tree...).
+   busy = holder(resource) if resource is not None else None
+   if busy is not None:
+      raise JobBusy(f'"{busy.name}" is still using {resource}.')
+
+   job = Job(name, func, args, kwargs, resource = resource)
+   jobs.append(job)
+
+   # Forget old finished jobs.
+   finished = [job for job in jobs if job.finished]
+   for old in finished[:max(0, len(finished) - max_finished)]:
+      jobs.remove(old)
+
+   job.thread.start()
+   return job
+
+def run (name, func, *args, resource = None, **kwargs):
+   # Runs a job and waits for it in the foreground: the operator can't do
+   # anything else until it finishes, but the screen and every other job stay
+   # alive meanwhile. Returns the job's result, or raises what it raised.
+   job = start(name, func, *args, resource = resource, **kwargs)
+   last = None
+   while not job.finished:
+      pump()
+      text = f'{job.summary()}\n\nElapsed: {job.elapsed() // 60}:{job.elapsed() % 60:02d}'
+      if text != last:
+         draw.begin_wait(text)
+         last = text
+      time.sleep(0.05)
+   draw.end_wait()
+   job.seen = True
+
+   if job.error is not None:
+      raise RuntimeError(job.error)
+   return job.result
+
+def pump ():
+   # Applies whatever the jobs have reported and redraws the summary line.
+   # Called from the main thread whenever it's waiting for a key.
+   changed = False
+   ended = False
+   while True:
+      try:
+         job, kind, data = events.get_nowait()
+      except queue.Empty:
+         break
+      job.apply(kind, data)
+      changed = True
+      ended = ended or job.finished
+
+   # Running jobs' clocks tick even without events; a job finishing is
+   # always shown straight away.
+   if (changed or stale or len(running())) and throttle.ready(force = ended):
+      draw_status()
+   return changed
+
+def draw_status ():
+   global stale
+   unseen = [job for job in jobs if job.finished and not job.seen]
+   active = running()
+
+   if not len(active) and not len(unseen):
+      text = ''
+   elif len(active) == 1 and not len(unseen):
+      text = active[0].summary()
+   else:
+      text = f'{len(active)} job(s) running'
+      if len(unseen):
+         text += f', {len(unseen)} finished: ' + '; '.join(job.summary() for job in unseen[-2:])
+      text += '. See Background Jobs on the main menu.'
+
+   if len(text):
+      text = f' {gfx_chars.right_arrow} {text}'
+   color = curses.color_pair(10) if any(job.error or job.state == 'Failed' for job in unseen) else curses.color_pair(2)
+
+   # Drawing straight onto stdscr would show through whatever window is
+   # over the line; pump() tries again once it's gone.
+   stale = draw.covers(status_row)
+   if stale:
+      return
+   stdscr.move(status_row, 0)
+   stdscr.clrtoeol()
+   stdscr.addstr(status_row, 2, text[:curses.COLS - 4], color | curses.A_BOLD)
+   stdscr.refresh()
+
+def do_jobs ():
+   crumb('Background Jobs')
+   while True:
+      pump()
+      if not len(jobs):
+         draw.message('Nothing has been run in the background yet.')
+         break
+
+      items = ['-State      Time    Job']
+      for job in reversed(jobs):
+         elapsed = job.elapsed()
+         items.append((f'{job.state.ljust(11)}{elapsed // 60:3d}:{elapsed % 60:02d}   {job.name}', job))
+
+      ret = menu(items, title = 'Background Jobs')
+      if ret == -1:
+         break
+
+      job = ret
+      job.seen = True
+      text = job.summary() + '\n\n' + '\n'.join(job.lines)
+      if job.trace:
+         text += '\n\n' + job.trace
+      draw.viewer(text, rows = 36, cols = 120, title = job.name,
+         colors = 10 if job.state == 'Failed' else 11 if job.finished else 4, attrs = curses.A_BOLD)
+      draw_status()
+
+   del_crumb()
+
+draw.idle_hooks.append(pump)
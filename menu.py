@@ -319,7 +319,7 @@ def menu (
          need_draw = False
          redraw()
 
-      key = stdscr.getch()
+      key = draw.get_key(win)
 
       if key > 0 and key < 255:
          # This is a standard ASCII key.
@@ -1,9 +1,9 @@
 import os
 import sys
+import subprocess
 
-def set_network (root_path, network, conf_path = None):
-   # Write a network configuration file.
-
+def network_files (network):
+   # The interfaces file and the resolver configuration, as text.
    text = ('auto lo\n'
       'iface lo inet loopback\n'
       'auto eth0\n')
@@ -16,13 +16,29 @@ def set_network (root_path, network, conf_path = None):
          f'netmask {network["netmask"]}\n'
          f'gateway {network["gateway"]}\n')
 
+   return text, f'nameserver {network["dns"]}'
+
+def write_file (path, text):
+   # The root file system on a card belongs to root, so its files can
+   # only be replaced through sudo.
+   try:
+      with open(path, 'w') as f:
+         f.write(text)
+   except PermissionError:
+      proc = subprocess.run(['sudo', 'tee', path], input = text.encode('utf-8'), stdout = subprocess.DEVNULL)
+      if proc.returncode != 0:
+         raise
+
+def set_network (root_path, network, conf_path = None):
+   # Write a network configuration file.
+   text, dns = network_files(network)
+
    if conf_path is None:
       out = os.path.join(root_path, 'etc', 'network', 'interfaces')
    else:
       out = os.path.join(conf_path, 'network')
 
-   with open(out, 'w') as f:
-      f.write(text)
+   write_file(out, text)
 
    # Now the DNS.
    if conf_path is None:
@@ -30,6 +46,5 @@ def set_network (root_path, network, conf_path = None):
    else:
       out = os.path.join(conf_path, 'dns')
 
-   with open(out, 'w') as f:
-      f.write(f'nameserver {network["dns"]}')
+   write_file(out, dns)
 
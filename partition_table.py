@@ -0,0 +1,159 @@
+# Writes MBR partition tables straight to a disk (or an image file), in
+# place of feeding keystrokes to fdisk.
+#
+# A layout is a list of (size, type) pairs: the size in MiB, or None for
+# whatever is left, and the MBR type byte. Every partition starts on a 1 MiB
+# boundary, the same places fdisk would have put them, so a table written
+# here lines up with images taken from cards fdisk partitioned.
+#
+# The whole table goes down in a single write, then the kernel is asked to
+# read it again. Nothing here touches the screen.
+
+import os
+import stat
+import fcntl
+import struct
+import subprocess
+
+sector_size = 512
+align_sectors = (1024 * 1024) // sector_size
+
+# MBR partition types.
+type_fat32_lba = 0x0c
+type_linux = 0x83
+
+# <linux/fs.h>
+BLKRRPART = 0x125f
+BLKGETSIZE64 = 0x80081272
+
+disk_id_offset = 440
+table_offset = 446
+entry_size = 16
+max_partitions = 4
+
+class TableError (Exception):
+   pass
+
+def align (sector):
+   return -(-sector // align_sectors) * align_sectors
+
+def layout (spec, total_sectors):
+   # Turns a spec into [(first sector, sector count, type)]. The last
+   # partition may be None, and runs to the end of the disk.
+   if len(spec) > max_partitions:
+      raise TableError(f'An MBR only has room for {max_partitions} partitions.')
+
+   parts = []
+   start = align_sectors
+   for n, (size, kind) in enumerate(spec):
+      start = align(start)
+      if size is None:
+         if n != len(spec) - 1:
+            raise TableError('Only the last partition can take the remaining space.')
+         count = total_sectors - start
+      else:
+         count = size * 1024 * 1024 // sector_size
+
+      if count <= 0 or start + count > total_sectors:
+         raise TableError(f'Partition {n+1} doesn\'t fit on a disk of {total_sectors * sector_size // (1024 * 1024)} MiB.')
+      parts.append((start, count, kind))
+      start += count
+
+   return parts
+
+def chs (lba):
+   # Cylinder/head/sector for the old BIOS fields, with the usual 255 heads
+   # and 63 sectors a track. Anything too far out gets the "use LBA" value.
+   cylinder, rest = divmod(lba, 255 * 63)
+   if cylinder > 1023:
+      return b'\xfe\xff\xff'
+   head, sector = divmod(rest, 63)
+   return bytes((head, ((cylinder >> 2) & 0xc0) | (sector + 1), cylinder & 0xff))
+
+def mbr (parts, disk_id, boot_code = bytes(disk_id_offset)):
+   # The 512-byte sector 0 for 'parts' (as layout() gives them).
+   sector = bytearray(sector_size)
+   sector[:disk_id_offset] = boot_code[:disk_id_offset]
+   struct.pack_into('<I', sector, disk_id_offset, disk_id)
+
+   for n, (start, count, kind) in enumerate(parts):
+      entry = (b'\x00' + chs(start) + bytes((kind,)) + chs(start + count - 1) +
+         struct.pack('<II', start, count))
+      sector[table_offset + n * entry_size:table_offset + (n + 1) * entry_size] = entry
+
+   sector[510:512] = b'\x55\xaa'
+   return bytes(sector)
+
+def read_table (fd):
+   # The partitions in an existing MBR as [(first sector, sector count,
+   # type)], and its disk ID; ([], None) if there isn't a valid one.
+   sector = os.pread(fd, sector_size, 0)
+   if len(sector) < sector_size or sector[510:512] != b'\x55\xaa':
+      return [], None
+
+   parts = []
+   for n in range(max_partitions):
+      offset = table_offset + n * entry_size
+      kind = sector[offset + 4]
+      start, count = struct.unpack_from('<II', sector, offset + 8)
+      if kind and count:
+         parts.append((start, count, kind))
+   return parts, struct.unpack_from('<I', sector, disk_id_offset)[0]
+
+def is_block_device (fd):
+   return stat.S_ISBLK(os.fstat(fd).st_mode)
+
+def total_sectors (fd):
+   if is_block_device(fd):
+      size = struct.unpack('<Q', fcntl.ioctl(fd, BLKGETSIZE64, bytes(8)))[0]
+   else:
+      size = os.fstat(fd).st_size
+   return size // sector_size
+
+def reread (dev, fd):
+   # Has the kernel pick up the new table. That takes CAP_SYS_ADMIN, which
+   # owning the device node doesn't give us, so fall back to blockdev.
+   try:
+      fcntl.ioctl(fd, BLKRRPART)
+      return True
+   except PermissionError:
+      pass
+   except OSError:
+      # Busy; something still has a partition open.
+      return False
+
+   code = subprocess.run(['sudo', 'blockdev', '--rereadpt', dev],
+      stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL).returncode
+   return code == 0
+
+def write_table (dev, spec, clear = False):
+   # Partitions 'dev' (a disk or an image file) as 'spec' says. With
+   # 'clear', everything in front of the first partition is zeroed too,
+   # along with any old boot code, GPT or boot loader left in it. Otherwise
+   # the disk keeps its ID, so PARTUUIDs don't change. Returns the layout;
+   # raises TableError or OSError if it couldn't be written.
+   fd = os.open(dev, os.O_RDWR)
+   try:
+      parts = layout(spec, total_sectors(fd))
+
+      disk_id = read_table(fd)[1]
+      if clear or disk_id is None:
+         disk_id = struct.unpack('<I', os.urandom(4))[0]
+         boot_code = bytes(disk_id_offset)
+      else:
+         boot_code = os.pread(fd, disk_id_offset, 0)
+
+      data = mbr(parts, disk_id, boot_code)
+      if clear:
+         data += bytes((parts[0][0] if len(parts) else align_sectors) * sector_size - len(data))
+
+      if os.pwrite(fd, data, 0) != len(data):
+         raise TableError(f'Short write to {dev}.')
+      os.fsync(fd)
+
+      if is_block_device(fd) and not reread(dev, fd):
+         raise TableError(f'The kernel didn\'t re-read the partition table on {dev}; is a partition still in use?')
+   finally:
+      os.close(fd)
+
+   return parts
@@ -3,12 +3,123 @@ import os
 import curses
 import time
 import shutil
+import threading
+import json
+import hashlib
+import datetime
 
 import config
 import draw
 import utils
+import gfx_chars
+import hexfile
 from __main__ import stdscr, crumb, del_crumb
 
+# The slow ISP clock (avrdude -B, in microseconds) fuses have always been
+# written at.
+fuse_speed = 128
+
+# Clocks at least this slow are comfortably inside f/4 for a chip running
+# from its factory 1 MHz clock (-B 8 is 125 kHz), so a target at such a
+# speed can have its fuses and memories all done in the same avrdude
+# session.
+factory_safe_speed = 8
+
+# ISP clocks (avrdude -B) to try when tuning, fastest first.
+clock_steps = [0.1, 0.5, 1, 2, 4, 8, 16, 32, 64, 128]
+
+# The fastest clock each (device, port) has failed at, and when.
+clock_file = './cache/isp_clocks.json'
+clock_lock = threading.Lock()
+
+# How long (seconds) a failure holds a device and port back. A loose
+# header shouldn't slow a station down for good.
+clock_failure_expiry = 24 * 60 * 60
+
+def load_clocks ():
+   try:
+      with open(clock_file, 'r') as f:
+         return json.loads(f.read())
+   except (IOError, OSError, ValueError):
+      return {}
+
+def clock_key (device, port):
+   return f'{device} {port or config.data["port"]}'
+
+def clock_candidates (device, port):
+   # Clocks worth trying, fastest first: everything slower than the fastest
+   # clock that has lately failed for this device and port.
+   known = load_clocks().get(clock_key(device, port), {})
+   failed = known.get('failed')
+   if time.time() - known.get('failed_at', 0) > clock_failure_expiry:
+      failed = None
+   steps = [step for step in clock_steps if failed is None or step > failed]
+   return steps or clock_steps[-1:]
+
+def record_clock (device, port, speed, failed = None):
+   # 'speed' worked. 'failed' is the slowest clock that didn't, on the way
+   # down to it.
+   with clock_lock:
+      clocks = load_clocks()
+      known = clocks.setdefault(clock_key(device, port), {})
+      known.pop('ok', None)
+      if speed <= known.get('failed', 0):
+         # Something at least as fast as an old failure works now, so that
+         # failure doesn't count any more.
+         known.pop('failed', None)
+         known.pop('failed_at', None)
+      if failed is not None:
+         known['failed'] = max(failed, known.get('failed', failed))
+         known['failed_at'] = time.time()
+      os.makedirs(os.path.dirname(clock_file), exist_ok = True)
+      with open(clock_file, 'w') as f:
+         f.write(json.dumps(clocks))
+
+# Every chip we program gets a line in <board>.jsonl in here.
+history_dir = './cache/program_history'
+
+def history_path (target):
+   return f'{history_dir}/{target.copy_name or target.device}.jsonl'
+
+def record_history (target, port, result):
+   # Results are 'written', 'identical' (nothing needed doing) or 'failed'.
+   os.makedirs(history_dir, exist_ok = True)
+   entry = {
+      'time': datetime.datetime.now().isoformat(timespec = 'seconds'),
+      'device': target.device,
+      'port': port or config.data['port'],
+      'image': target.image_digest(),
+      'result': result}
+   with open(history_path(target), 'a') as f:
+      f.write(json.dumps(entry) + '\n')
+
+def seen_before (target):
+   # Has this exact firmware gone onto one of these boards before? If not,
+   # there's no point asking the chip whether it already has it. Once it
+   # has, is_identical() still has to tell a new chip from a programmed one.
+   digest = target.image_digest()
+   try:
+      with open(history_path(target), 'r') as f:
+         for line in f:
+            try:
+               entry = json.loads(line)
+            except ValueError:
+               continue
+            if entry.get('image') == digest and entry.get('result') != 'failed':
+               return True
+   except (IOError, OSError):
+      pass
+   return False
+
+def programmer_ports ():
+   # Every programmer that's plugged in: the main port plus any extras.
+   ports = [config.data['port']] + list(config.get('programmer_ports', []))
+   found = []
+   for port in ports:
+      if port not in found and os.path.exists(port):
+         found.append(port)
+   return found
+
 class ChipTarget:
    def __init__ (
       self,
@@ -42,12 +153,96 @@ class ChipTarget:
       self.require_prompt = require_prompt
       self.copy_to = copy_to
       self.copy_name = copy_name
+      self.digest = None
       if self.copy_name is not None and self.copy_name.endswith('.hex'):
          self.copy_name = self.copy_name[:-4]
 
+   def check (self):
+      # Makes sure the flash image can be read and fits the chip before
+      # avrdude gets anywhere near it. Returns what's wrong, or None.
+      if not self.hex_file:
+         return None
+      try:
+         hexfile.HexImage.read(self.hex_file).check_fits(self.device)
+      except (IOError, OSError, hexfile.HexError) as e:
+         return f'{os.path.basename(self.hex_file)}: {e}'
+      return None
+
+   def memories (self):
+      memories = []
+      if self.hex_file:
+         memories.append(('flash', self.hex_file))
+      if self.eeprom_hex:
+         memories.append(('eeprom', self.eeprom_hex))
+      return memories
+
+   def image_digest (self):
+      # Identifies exactly what this target would put on the chip.
+      if self.digest is None:
+         digest = hashlib.sha1()
+         for memory, filename in self.memories():
+            try:
+               digest.update(f'{memory}:'.encode('utf-8') + hexfile.HexImage.read(filename).digest().encode('utf-8'))
+            except (IOError, OSError, hexfile.HexError):
+               digest.update(f'{memory}:?'.encode('utf-8'))
+         self.digest = digest.hexdigest()
+      return self.digest
+
+   def sessions (self, memories = True, port = None):
+      # Splits the work into as few avrdude sessions as possible, as a list
+      # of ([speeds to try, fastest first], [(target, data), ...]). That's
+      # one session, unless this target's clock is too fast for a chip
+      # whose fuses haven't been set yet, in which case the fuses go first
+      # at a slow clock.
+      #
+      # With 'auto_isp_clock' on, the memories' clock is tuned instead of
+      # taken from 'speed': it starts at the fastest this device and port
+      # haven't failed at, and steps down from there if need be. Fuses on
+      # their own are always written at 'fuse_speed'; they only go faster
+      # in a shared session, where avrdude_command() verifies them.
+      fuses = list(self.fuses.items())
+      memories = self.memories() if memories else []
+
+      if not config.get('auto_isp_clock'):
+         if not len(memories):
+            return [([fuse_speed], fuses)]
+         if float(self.speed) >= factory_safe_speed:
+            return [([self.speed], fuses + memories)]
+         return [([fuse_speed], fuses), ([self.speed], memories)]
+
+      if not len(memories):
+         return [([fuse_speed], fuses)]
+
+      speeds = clock_candidates(self.device, port)
+      if speeds[0] >= factory_safe_speed:
+         return [(speeds, fuses + memories)]
+      return [([fuse_speed], fuses), (speeds, memories)]
+
+class TargetJob:
+   # One target being programmed on a worker thread. Workers never touch the
+   # screen; they update this, and the main thread draws it.
+   def __init__ (self, target):
+      self.target = target
+      self.reset()
+
+   def reset (self):
+      self.state = 'Waiting for a programmer'
+      self.percent = 0.0
+      self.port = None
+      self.error = None
+      self.finished = False
+      self.identical = False
+      self.tried = set()
+
+   def step (self, state, percent = None):
+      self.state = state
+      if percent is not None:
+         self.percent = percent
+
 class BoardProgrammer:
    def __init__ (self):
       self.targets = []
+      self.failed = []
 
    def add_target (
       self,      
@@ -99,9 +294,17 @@ class BoardProgrammer:
    def program (self):
       # Check for the programmer presence.
       if not self.programmer_check():
+         self.failed = list(self.targets)
          return False
 
-      # Do each target, unless the user can skip them.
+      # With more than one programmer, do everything at once.
+      if len(self.targets) > 1 and len(programmer_ports()) > 1:
+         return self.program_parallel()
+
+      self.failed = []
+
+      # Do each target, unless the user can skip them. One chip failing (or
+      # being cancelled) doesn't stop the rest; each is a board of its own.
       for target in self.targets:
          do_del = False
 
@@ -136,32 +339,101 @@ class BoardProgrammer:
             continue
 
          elif result == 'C':
-            # They want to cancel everything.
+            # They don't want this one.
             if do_del: del_crumb()
-            return False
+            self.failed.append(target)
 
          else:
             # Must be OK!
             if not self.program_target(target):
-               if do_del: del_crumb()
-               return False
+               self.failed.append(target)
             if do_del: del_crumb()   
 
-      # Looks like it worked.
-      return True
+      return not len(self.failed)
 
    def program_target (self, target):
-      if not self.program_fuses(target):
+      problem = target.check()
+      if problem is not None:
+         draw.message(f'Unable to program {target.device}.\n\n{problem}', colors = 10)
          return False
 
-      if target.hex_file:
-         if not self.program_main(target):
-            return False
+      # Re-programming a board with what it already has only needs its fuses.
+      draw.begin_wait(f'Checking what\'s on the {target.device}...')
+      identical = self.is_identical(target)
+      draw.end_wait()
 
-      if target.eeprom_hex:
-         if not self.program_eeprom(target):
+      for speeds, ops in target.sessions(memories = not identical):
+         if not self.program_session(target, speeds, ops):
+            record_history(target, None, 'failed')
             return False
 
+      record_history(target, None, 'identical' if identical else 'written')
+      self.save_copies(target)
+      return True
+
+   def is_identical (self, target, port = None):
+      # Asks the chip to compare its memories with the target's images,
+      # which is a read instead of an erase, write and read. stk500v2 can't
+      # rewrite only the pages that differ, so it's all or nothing.
+      memories = target.memories()
+      if not len(memories) or not seen_before(target):
+         return False
+
+      # The low and high fuses go first: a new chip still has the factory
+      # ones, so avrdude stops at them after reading two bytes instead of
+      # the whole flash. (The extended fuse's unused bits don't always read
+      # back as written, so it's left out.)
+      #
+      # A mismatch looks just like a clock that's too fast, so don't go
+      # stepping down through every clock for it; just try the first.
+      speeds = target.sessions(port = port)[-1][0][:1]
+      ops = [(memory, target.fuses[memory], 'v') for memory in ('lfuse', 'hfuse')]
+      ops += [(memory, value, 'v') for memory, value in memories]
+
+      # A check that was turned down (in verbose mode) proves nothing.
+      return self.run_session(target, speeds, ops, port = port, progress = False) == 0
+
+   def program_session (self, target, speeds, ops):
+      what = ', '.join(memory.upper() if 'fuse' in memory else memory for memory, value in ops)
+      while True:
+         draw.begin_wait(f'Programming {target.device} ({what})...')
+         ret = self.run_session(target, speeds, ops)
+         draw.end_wait()
+
+         # Turning the command down (in verbose mode) skips it, as ever.
+         if ret != 0 and ret != utils.avrdude_declined:
+            draw.message(f'Unable to program {target.device} ({what}).\n\nCheck your connections.', colors = 10)
+            if not (self.try_again()):
+               return False
+         else:
+            return True
+
+   def run_session (self, target, speeds, ops, port = None, progress = True):
+      # Runs one avrdude session, dropping to the next slower clock whenever
+      # it fails (a bad signature or a failed verify both look the same
+      # from here). Clocks that work for a memory are remembered for next
+      # time. Returns avrdude's exit code from the last try.
+      failed = None
+      for speed in speeds:
+         events = []
+         ret = utils.avrdude_command(
+            target.device, ops, None, run = True, progress = progress, speed = speed, port = port,
+            on_event = events.append)
+         if ret == 0:
+            if len(speeds) > 1 and any('fuse' not in op[0] for op in ops):
+               record_clock(target.device, port, speed, failed)
+            return ret
+         if ret == utils.avrdude_declined:
+            return ret
+
+         # A different chip on the other end won't get any better slower.
+         if any(event[0] == 'wrong_chip' for event in events):
+            return ret
+         failed = speed
+      return ret
+
+   def save_copies (self, target):
+      # Keep copies of what went onto the chip, if we were asked to.
       if target.copy_to is not None and target.copy_name is not None:
          if target.hex_file:
             shutil.copy(target.hex_file, f'{target.copy_to}/{target.copy_name}.hex')
@@ -173,58 +445,161 @@ class BoardProgrammer:
             f.write(f'hfuse: {target.fuses["hfuse"]}\n')
             f.write(f'efuse: {target.fuses["efuse"]}\n')
 
-      return True
+   def program_parallel (self):
+      # Every programmer gets plugged into a different board, in any order.
+      # Each port's worker asks every waiting target's chip for its signature
+      # and programs the first one that answers, so targets end up on
+      # whichever programmer they're connected to.
+      ports = programmer_ports()
+      names = '\n'.join(f'   {target.title or target.device} ({target.device})' for target in self.targets)
+      result = draw.question((
+         'Power the Fuel Boss on with no SD card inserted.\n'
+         '\n'
+         f'Then connect one of the {len(ports)} programmers to each of these, '
+         'with the white triangle pointing to the red wire:\n'
+         '\n'
+         f'{names}\n'
+         '\n'
+         'It doesn\'t matter which programmer goes where. '
+         'Press ENTER when ready, or ESCAPE to cancel.'),
+         choices = ('&OK', '&Cancel'), default = 0, escape = 1, title = 'Program Chips')
+
+      if result == 'C':
+         self.failed = list(self.targets)
+         return False
 
-   def program_eeprom (self, target):
+      jobs = [TargetJob(target) for target in self.targets]
       while True:
-         draw.begin_wait(f'Programming target EEPROM ({target.device})...')
-         ret = utils.avrdude_command(
-            target.device, 'eeprom', target.eeprom_hex, run = True, progress = True, speed = target.speed)
-         time.sleep(0.5)
-         draw.end_wait()
+         self.run_jobs([job for job in jobs if not job.finished or job.error], ports)
 
-         if ret != 0:
-            draw.message(f'Unable to program EEPROM ({target.device}).\n\nCheck your connections.', colors = 10)
-            if not (self.try_again()):
-               return False
-         else:
+         failed = [job for job in jobs if job.error]
+         if not len(failed):
+            self.failed = []
+            draw.message(f'All {len(jobs)} chips were programmed successfully.', colors = 11)
             return True
 
-   def program_main (self, target):
-      while True:
-         draw.begin_wait(f'Programming target CPU ({target.device})...')
-         ret = utils.avrdude_command(
-            target.device, 'flash', target.hex_file, run = True, progress = True, speed = target.speed)
-         time.sleep(0.5)
-         draw.end_wait()
+         # One summary instead of a prompt per chip.
+         text = f'{len(jobs) - len(failed)} of {len(jobs)} chips were programmed.\n\n'
+         text += '\n'.join(f'{job.target.title or job.target.device}: {job.error}' for job in failed)
+         text += '\n\nPress R to try the failed ones again, or ESCAPE to cancel.'
+         choices = ('&Retry', '&Cancel')
+         if all(job.target.can_skip for job in failed):
+            text += '\nYou can also press S to skip them.'
+            choices += ('&Skip',)
 
-         if ret != 0:
-            draw.message(f'Unable to program CPU ({target.device}).\n\nCheck your connections.', colors = 10)
-            if not (self.try_again()):
-               return False
-         else:
+         result = draw.question(text, choices = choices, default = 0, escape = 1,
+            title = 'Program Chips', colors = 10)
+
+         if result == 'S':
+            self.failed = []
             return True
+         elif result == 'C':
+            self.failed = [job.target for job in failed]
+            return False
 
-   def program_fuses (self, target):
+   def run_jobs (self, jobs, ports):
+      for job in jobs:
+         job.reset()
+
+      lock = threading.Lock()
+      workers = [threading.Thread(target = self.port_worker, args = (port, jobs, lock), daemon = True)
+         for port in ports]
+
+      win = draw.newwin(len(jobs) * 2 + 3, 110, title = f'Programming {len(jobs)} Chips', colors = 4)
+      for worker in workers:
+         worker.start()
+
+      throttle = utils.Throttle()
+      while any(worker.is_alive() for worker in workers):
+         if throttle.ready():
+            self.draw_jobs(win, jobs)
+         time.sleep(0.02)
+
+      # Whatever no programmer could see wasn't plugged in.
+      for job in jobs:
+         if not job.finished:
+            job.error = 'Not found on any programmer.'
+            job.state = 'Failed'
+            job.finished = True
+
+      self.draw_jobs(win, jobs)
+      del win
+      stdscr.touchwin()
+      stdscr.refresh()
+
+   def port_worker (self, port, jobs, lock):
       while True:
-         retry = False
-         for fuse, value in target.fuses.items():
-            draw.begin_wait(f'Programming {fuse.upper()} to {value:02X}...')
-            ret = utils.avrdude_command(
-               target.device, fuse, value, run = True, progress = False)
-            time.sleep(0.25)
-            draw.end_wait()
-
-            if ret != 0:
-               draw.message(f'Unable to program {fuse.upper()}.\n\nIs the value {value:02X} right?', colors = 10)
-               if not (self.try_again()):
-                  return False
-               else:
-                  retry = True
-                  break
-         if not retry:
-            break
-      return True
-
-      
+         with lock:
+            waiting = [job for job in jobs if job.port is None and port not in job.tried]
+            if not len(waiting):
+               return
+            job = waiting[0]
+            job.tried.add(port)
+
+         job.step(f'Looking on {port}')
+         ret = utils.avrdude_command(job.target.device, None, None, run = True, progress = False, port = port)
+         if ret != 0:
+            continue
 
+         with lock:
+            if job.port is not None:
+               continue
+            job.port = port
+
+         try:
+            job.error = self.program_job(job)
+         except (IOError, OSError) as e:
+            job.error = str(e)
+         if job.error:
+            job.step('Failed')
+         else:
+            job.step('Done (it was already up to date)' if job.identical else 'Done', 100.0)
+         job.finished = True
+
+   def program_job (self, job):
+      # Runs on a worker thread. Returns None, or what went wrong.
+      target = job.target
+      port = job.port
+
+      problem = target.check()
+      if problem is not None:
+         return problem
+
+      job.step(f'Comparing on {port}', 2.0)
+      identical = self.is_identical(target, port = port)
+
+      # Writing a memory takes the bar up to halfway through this
+      # session's share, verifying it the rest.
+      sessions = target.sessions(memories = not identical, port = port)
+      for n, (speeds, ops) in enumerate(sessions):
+         base = 5.0 + 90.0 * n / len(sessions)
+         share = 90.0 / len(sessions)
+
+         def progress (is_write, percent):
+            job.step(f'{"Writing" if is_write else "Verifying"} on {port}',
+               base + share * (percent / 200.0 + (0.0 if is_write else 0.5)))
+
+         job.step(f'Programming on {port}', base)
+         if self.run_session(target, speeds, ops, port = port, progress = progress) != 0:
+            record_history(target, port, 'failed')
+            return 'Unable to program the chip. Check your connections.'
+
+      record_history(target, port, 'identical' if identical else 'written')
+      job.identical = identical
+      self.save_copies(target)
+      return None
+
+   def draw_jobs (self, win, jobs):
+      rows, cols = win.getmaxyx()
+      bar_w = cols - 44
+      for n, job in enumerate(jobs):
+         row = 2 + n * 2
+         status = job.error or job.state
+         blocks = int((job.percent / 100.0) * bar_w)
+         color = curses.color_pair(10) if job.error else curses.color_pair(11) if job.finished else curses.color_pair(6)
+
+         win.addstr(row, 2, (job.target.title or job.target.device)[:30].ljust(32))
+         win.addstr(row, 34, (blocks * gfx_chars.block).ljust(bar_w), color | curses.A_BOLD)
+         win.addstr(row, 35 + bar_w, f'{job.percent:5.1f}%')
+         win.addstr(row + 1, 34, status[:cols - 36].ljust(cols - 36))
+      win.refresh()
@@ -1,58 +1,123 @@
 import os
 import sys
 import json
-import shutil
 import time
+import hashlib
 import datetime
 import subprocess
+import tarfile
 import curses
 
 import draw
 import utils
 import config
+import devices
+import block_devices
+import partition_table
+import ext_image
+import fat_image
+import buildroot
+import jobs
 from __main__ import stdscr, crumb, del_crumb
 from logger import log_debug
 
+# Golden boot/root partition images, one per Buildroot version and board.
+image_cache_dir = './cache/sd_images'
+
+# Golden images whose checksums have been checked, as path: (size, mtime).
+verified_images = {}
+
+def busy_error (dev):
+   # Something in the background (making an image of the last card, say)
+   # might still be using 'dev'. Returns what to tell the user, or None.
+   busy = jobs.device_holder(dev)
+   if busy is None:
+      return None
+   return f'{dev} is still busy with "{busy.name}". Wait for it to finish first.'
+
 class Partitioner:
-   def __init__ (self):
-      self.dev = config.get('sd_card_device')
-      self.script = bytearray()
+   # The run_* methods do the actual work and never touch the screen, so
+   # they can be used from worker threads (see card_batch.py). The rest wrap
+   # them with the usual waits and messages.
+   def __init__ (self, dev = None, mount_prefix = ''):
+      self.dev = config.get('sd_card_device') if dev is None else dev
+      self.mount_prefix = mount_prefix
       self.interfix = 'p' if 'mmc' in self.dev else ''
+      self.spec = []
       self.part_types = []
 
    def add_partition (self, size = None, is_vfat = False):
-      if isinstance(size, int): 
-         size = (f'+{size}M').encode('ascii')
-      elif size is None:
-         size = b''
-      else:
-         size = size.encode('ascii')
-
-      self.script += b'n\np\n' + bytes((ord('1') + len(self.part_types),)) + b'\n\n' + size + b'\n'
-      if is_vfat:
-         self.script += b't\nc\n'
-
+      # 'size' is in MiB; None takes the rest of the card.
+      self.spec.append((size, partition_table.type_fat32_lba if is_vfat else partition_table.type_linux))
       self.part_types.append(is_vfat)
 
-   def format_partition (self, id):
+   def run_format (self, id):
       kind = 'vfat' if self.part_types[id] else 'ext2'
-      draw.begin_wait(f'Formatting partition {self.dev + self.interfix + str(id+1)} as {kind.upper()}...')
-      dev = self.dev
-      if dev.endswith('/'): dev = dev[:-1]
-      command = f'sudo mkfs.{kind} {dev + self.interfix + str(id+1)}'
+      command = f'sudo mkfs.{kind} {self.partition_path(id)}'
       proc = subprocess.run(command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-      if proc.returncode != 0:
-         draw.end_wait()
-         draw.message(f'Unable to format partition {self.dev + self.interfix + str(id+1)}')
-         return False
-      time.sleep(2.0)
-      draw.end_wait()
-      return True
+
+      # udev probes the new file system as soon as mkfs lets go of it.
+      devices.settle()
+      return proc.returncode == 0
 
    def safety_check (self):
       return not 'nvme' in self.dev and not utils.is_root_device(self.dev)
 
-   def write_partitions (self):
+   def run_partition (self, clear = False):
+      # Returns None if it worked, or what went wrong.
+      error = busy_error(self.dev)
+      if error is not None:
+         return error
+      if not utils.claim_device(self.dev):
+         return f'Unable to write directly to {self.dev}.'
+
+      # udev may still have the disk open from whatever was done to it last,
+      # and then the kernel won't re-read the new table.
+      devices.settle()
+      try:
+         partition_table.write_table(self.dev, self.spec, clear = clear)
+      except (partition_table.TableError, OSError) as e:
+         return str(e)
+      finally:
+         utils.release_device(self.dev)
+      return None
+
+   def wait_for_partitions (self, timeout = 10.0):
+      # The nodes from the old table may well still be there, so first let
+      # udev finish with everything re-reading the new one set off.
+      devices.settle(timeout)
+      return devices.wait_device(self.partition_path(len(self.part_types) - 1), timeout)
+
+   def run_populate (self, id, contents, callback = None):
+      # Builds partition 'id' as an ext2 file system that already holds
+      # 'contents' (see ext_image.py). Returns None if it worked, or what
+      # went wrong.
+      path = self.partition_path(id)
+      error = busy_error(path)
+      if error is not None:
+         return error
+      if not utils.claim_device(path):
+         return f'Unable to write directly to {path}.'
+
+      try:
+         ext_image.build(path, contents, callback = callback)
+      except (ext_image.ImageError, OSError, EOFError, tarfile.TarError) as e:
+         return str(e)
+      finally:
+         utils.release_device(path)
+         devices.settle()
+      return None
+
+   def populate_partition (self, id, contents, what):
+      draw.begin_wait(f'Writing {what} to {self.partition_path(id)}...')
+      error = self.run_populate(id, contents)
+      draw.end_wait()
+      if error is not None:
+         draw.message(f'Unable to write {what} to {self.partition_path(id)}.\n\n{error}', colors = 10)
+         return False
+      return True
+
+   def write_partitions (self, clear = True):
       if not self.safety_check():
          draw.message(('Somehow this system was set up to write directly '
             f'to {self.dev}, which is probably a very bad idea.\n\n'
@@ -61,36 +126,31 @@ class Partitioner:
             colors = 10)
          return False
 
-      draw.begin_wait(f'Clearing {self.dev}...')
-      code = os.system(f'sudo dd if=/dev/zero of={self.dev} bs=16M count=1 > /dev/null 2>&1')
-      if code >> 8 != 0:
+      draw.begin_wait(f'Partitioning {self.dev}...')
+      error = self.run_partition(clear)
+      if error is not None:
          draw.end_wait()
+         draw.message(f'Unable to partition {self.dev}.\n\n{error}', colors = 10)
+         return False
+      if not self.wait_for_partitions():
+         draw.end_wait()
+         draw.message(f'The partitions on {self.dev} never showed up.', colors = 10)
          return False
-      time.sleep(1.0)
-      draw.end_wait()
-
-      draw.begin_wait(f'Partitioning {self.dev}...')
-      time.sleep(1.0)
-      self.script = b'o\n' + self.script + b'w\n'
-      proc = subprocess.Popen(f'sudo fdisk {self.dev} > /dev/null 2>&1', shell = True, stdin = subprocess.PIPE)
-      proc.communicate(self.script)
-      code = proc.returncode
       draw.end_wait()
       return True
 
-   def format_partitions (self):
-      for id in range(len(self.part_types)):
-         if not self.format_partition(id):
-            return False
-      return True
+   def partition_path (self, id):
+      return f'{self.dev.rstrip("/")}{self.interfix}{id+1}'
 
-   def mount_partition (self, id, name, is_vfat = False):
-      path = f'/dev/shm/{name}'
-      part = f'{self.dev}{self.interfix}{id+1}'
-      proc = subprocess.run(f'lsblk -nrpo KNAME | grep {part} > /dev/null 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-      if proc.returncode != 0:
-         draw.message(f'Unable to find partition "{part}".', colors = 10)
-         return (False, path)
+   def mount_path (self, name):
+      return f'/dev/shm/{self.mount_prefix}{name}'
+
+   def run_mount (self, id, path, is_vfat = False):
+      # Returns (return code, stdout, stderr) from mount, or a code of -1 if
+      # the partition doesn't exist.
+      part = self.partition_path(id)
+      if block_devices.find(part) is None:
+         return (-1, b'', b'')
 
       if not os.path.exists(path):
          os.mkdir(path, 0o777)
@@ -100,31 +160,50 @@ class Partitioner:
          options = '-o rw,uid=1000,gid=1000'
 
       proc = subprocess.run(f'sudo mount {part} {path} {options}', shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-      out, err = proc.stdout, proc.stderr
-
       if proc.returncode != 0:
+         return (proc.returncode, proc.stdout, proc.stderr)
+
+      user = utils.current_user()
+      code = os.system(f'sudo chown {user}:{user} {path}')
+      return (code >> 8, b'', b'')
+
+   def mount_partition (self, id, name, is_vfat = False):
+      path = self.mount_path(name)
+      part = self.partition_path(id)
+      code, out, err = self.run_mount(id, path, is_vfat)
+
+      if code == -1:
+         draw.message(f'Unable to find partition "{part}".', colors = 10)
+         return (False, path)
+
+      if code != 0 and (len(out) or len(err)):
          out = '\n   '.join(out.decode('utf-8').splitlines())
          err = '\n   '.join(err.decode('utf-8').splitlines())
          claim = f'Standard output text:\n{out}Standard error text:\n{err}'
          draw.viewer(
-            f'Unable to mount partition "{part}" to path "{path}". Is your SD card well-seated?\n\n(Mount returned error code {proc.returncode}.\n\n{claim}.)',
+            f'Unable to mount partition "{part}" to path "{path}". Is your SD card well-seated?\n\n(Mount returned error code {code}.\n\n{claim}.)',
             colors = 10, attrs = curses.A_BOLD)
          return (False, path)
 
-      user = os.getlogin()
-      code = os.system(f'sudo chown {user}:{user} {path}')
-      if code >> 8 != 0:
+      if code != 0:
          draw.message(f'Unable to set permissions for partition "{part}".', colors = 10)
          return (False, path)
 
       return (True, path)
 
+   def is_mounted (self, path):
+      code = os.system(f'mount | grep {path} > /dev/null 2>&1')
+      return code >> 8 == 0
+
+   def run_unmount (self, path):
+      code = os.system(f'sudo umount {path} > /dev/null 2>&1')
+      return code >> 8 == 0
+
    def unmount_partition (self, name, is_device_name = False):
-      path = f'/dev/shm/{name}' if not is_device_name else name
+      path = self.mount_path(name) if not is_device_name else name
 
       # Is it mounted at all?
-      code = os.system(f'mount | grep {path} > /dev/null 2>&1')
-      if code >> 8 != 0:
+      if not self.is_mounted(path):
          # It doesn't look that way.
          draw.begin_wait(f'{path} was not mounted; skipping.')
          time.sleep(0.7)
@@ -133,26 +212,28 @@ class Partitioner:
 
       draw.begin_wait(f'Unmounting {path}...')
 
-      code = os.system(f'sudo umount {path} > /dev/null 2>&1')
-      if code >> 8 != 0:
-         draw.message((f'Unable to unmount partition "{part}". Unplugging the SD card '
+      if not self.run_unmount(path):
+         draw.message((f'Unable to unmount partition "{path}". Unplugging the SD card '
             'may leave it in an unknown state, but likely won\'t damage it.\n'
             '\n'
             'Steven may be able to rescue it for you.'), colors = 10)
          draw.end_wait()
          return False
 
-      time.sleep(0.5)
+      devices.wait_unmounted(path, timeout = 5.0)
       draw.end_wait()
       return True
 
+   def device_partitions (self):
+      return [d.path for d in os.scandir('/dev')
+         if d.path.startswith(self.dev) and d.path != self.dev and d.path[-1] in '123456789']
+
    def unmount_all (self):
-      for dev in [d.path for d in os.scandir('/dev')]:
-         if dev.startswith(config.data['sd_card_device']) and dev[-1] in '123456789':
-            self.unmount_partition(dev, is_device_name = True)
+      for dev in self.device_partitions():
+         self.unmount_partition(dev, is_device_name = True)
 
 class SDCardBuilder:
-   def __init__ (self, buildroot_version = None, board_name = None):
+   def __init__ (self, buildroot_version = None, board_name = None, dev = None):
       # No board name? Use the Pi 2 board for now.
       if board_name is None: board_name = 'all_line_pi2'
 
@@ -165,6 +246,14 @@ class SDCardBuilder:
       self.br_path = f'./buildroot/{self.br_version}'
       self.board_name = board_name
 
+      # No device? Use the one from the configuration file.
+      self.dev = config.get('sd_card_device') if dev is None else dev
+
+      # What goes on the program and configuration partitions. Fill these
+      # in before build(), which writes them whole.
+      self.prog = ext_image.Contents()
+      self.conf = ext_image.Contents()
+
    def find_sd_card (self):
       # Is the SD card present?
       while True:
@@ -189,12 +278,9 @@ class SDCardBuilder:
 
          # Must have wanted to go ahead.
          # See if we can find the SD card device.
-         # We'll ask lsblk to output the kernel names only with no headings,
-         # as well as the full device path (e.g., sda -> /dev/sda)
+         # A card that's only just gone in gets a moment to show up.
          draw.begin_wait('Checking for SD card...')
-         proc = subprocess.run(f'lsblk -nrpo KNAME | grep {config.get("sd_card_device")} > /dev/null 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-         if proc.returncode != 0:
-            time.sleep(1.0)
+         if not devices.wait_for(self.is_present, timeout = 2.0):
             draw.end_wait()
             # No, it isn't.
             result = draw.question('No SD card was found.\n\nSelect a different device?')
@@ -205,20 +291,175 @@ class SDCardBuilder:
                if new_device is not None:
                   config.data['sd_card_device'] = new_device
                   config.save()
+                  self.dev = new_device
          else:
-            time.sleep(1.0)
             draw.end_wait()
             return True
 
-   def prepare_sd_card (self):
-      part = Partitioner()
-      part.unmount_all()
+   def is_present (self):
+      # An empty card reader is still a disk, just one with no size.
+      dev = block_devices.find(self.dev)
+      return dev is not None and dev.size > 0
+
+   def make_partitioner (self, dev = None, mount_prefix = ''):
+      # The configured card, unless 'dev' says otherwise (card_batch.py
+      # has one per reader).
+      part = Partitioner(self.dev if dev is None else dev, mount_prefix)
       part.add_partition(100, True)    # /boot
       part.add_partition(150, False)   # /
       part.add_partition(150, False)   # /program
       part.add_partition(None, False)  # /config (remaining space)
+      return part
+
+   def prepare_sd_card (self):
+      # No formatting here; build() writes every file system whole.
+      part = self.make_partitioner()
+      part.unmount_all()
       if not part.write_partitions(): return False
-      if not part.format_partitions(): return False
+      return True
+
+   def image_key (self):
+      # Fingerprint everything that ends up on the boot and root partitions,
+      # plus the partition layout itself. If none of it has changed, neither
+      # has the golden image.
+      digest = hashlib.sha1()
+      digest.update(f'{self.br_version}\n{self.board_name}\n'.encode('utf-8'))
+      digest.update(f'{self.make_partitioner().spec}\n'.encode('utf-8'))
+
+      sources = self.required_files + [
+         f'{self.cache_path}/../cmdline.txt',
+         f'{self.cache_path}/../config.txt']
+
+      for source in sources:
+         if os.path.isdir(source):
+            paths = sorted(os.path.join(d, f) for d, _, files in os.walk(source) for f in files)
+         else:
+            paths = [source]
+
+         for path in paths:
+            stat = os.stat(path)
+            digest.update(f'{path} {stat.st_size} {stat.st_mtime_ns}\n'.encode('utf-8'))
+
+      return digest.hexdigest()[:16]
+
+   def golden_image_path (self, key):
+      return f'{image_cache_dir}/{self.br_version}_{self.board_name}_{key}.img'
+
+   def find_golden_image (self):
+      # Returns the manifest for a cached image of this board, if there is
+      # one that still matches the Buildroot output.
+      try:
+         path = self.golden_image_path(self.image_key())
+         with open(f'{path}.json', 'r') as f:
+            manifest = json.loads(f.read())
+      except (IOError, OSError, ValueError):
+         return None
+
+      if not os.path.exists(path) or os.path.getsize(path) != manifest['length']:
+         return None
+
+      # Check the image against what was read off the card before it goes
+      # onto another one. That only has to happen once per file.
+      stat = os.stat(path)
+      if verified_images.get(path) != (stat.st_size, stat.st_mtime_ns):
+         draw.begin_wait('Checking the cached boot and root partitions...')
+         try:
+            good = utils.file_sha256(path) == manifest.get('sha256')
+         except (IOError, OSError):
+            good = False
+         draw.end_wait()
+
+         if not good:
+            log_debug(f'cached image {path} is damaged; removing it')
+            for name in (path, f'{path}.json'):
+               if os.path.exists(name): os.remove(name)
+            return None
+         verified_images[path] = (stat.st_size, stat.st_mtime_ns)
+
+      manifest['image'] = path
+      return manifest
+
+   def write_golden_image (self, manifest):
+      # Put the cached boot and root partitions down in one sequential pass,
+      # then give this card its own partition table. build() writes the
+      # prog/conf file systems.
+      part = self.make_partitioner()
+      part.unmount_all()
+
+      error = busy_error(part.dev)
+      if error is not None:
+         draw.message(error, colors = 10)
+         return False
+      if not part.safety_check() or not utils.claim_device(part.dev):
+         draw.message(f'Unable to write directly to {part.dev}.', colors = 10)
+         return False
+
+      draw.begin_wait('Writing cached boot and root partitions...')
+      try:
+         utils.write_device_image(manifest['image'], part.dev, callback = utils.byte_progress(True))
+      except (IOError, OSError) as e:
+         utils.draw_progress(True, 0, clear = True)
+         draw.end_wait()
+         draw.message(f'Unable to write the cached image to {part.dev}.\n\nPython says: {e}', colors = 10)
+         return False
+      finally:
+         utils.release_device(part.dev)
+      utils.draw_progress(True, 0, clear = True)
+      draw.end_wait()
+
+      # The image's own partition table came from whatever card it was taken
+      # from, so the last partition is the wrong size. The layout is
+      # otherwise identical, so rewriting the table leaves /boot and / alone.
+      if not part.write_partitions(clear = False): return False
+      return True
+
+   def capture_golden_image (self):
+      # Save the freshly-built boot and root partitions (and everything in
+      # front of them) so the next card of this kind can skip straight
+      # to a block copy.
+      part = self.make_partitioner()
+      extent = utils.partition_extent(part.partition_path(1))
+      if extent is None:
+         return False
+
+      key = self.image_key()
+      path = self.golden_image_path(key)
+      os.makedirs(image_cache_dir, exist_ok = True)
+
+      # The file systems have to be unmounted to be captured cleanly.
+      if not part.unmount_partition('root'): return False
+      if not utils.claim_device(part.dev):
+         part.mount_partition(1, 'root')
+         return False
+
+      draw.begin_wait('Caching boot and root partitions for the next card...')
+      try:
+         length = extent[0] + extent[1]
+         sha256 = utils.read_device_image(part.dev, path, length, callback = utils.byte_progress(False))
+
+         # Only one image per board is worth keeping.
+         prefix = f'{self.br_version}_{self.board_name}_'
+         for entry in os.scandir(image_cache_dir):
+            if entry.name.startswith(prefix) and not entry.name.startswith(os.path.basename(path)):
+               os.remove(entry.path)
+
+         with open(f'{path}.json', 'w') as f:
+            f.write(json.dumps({
+               'buildroot_version': self.br_version,
+               'board_name': self.board_name,
+               'key': key,
+               'length': length,
+               'sha256': sha256}))
+      except (IOError, OSError) as e:
+         log_debug(f'unable to cache golden image: {e}')
+         if os.path.exists(path): os.remove(path)
+      finally:
+         utils.release_device(part.dev)
+      utils.draw_progress(False, 0, clear = True)
+      draw.end_wait()
+
+      # Put things back the way the caller expects them.
+      if not part.mount_partition(1, 'root')[0]: return False
       return True
 
    def prepare_buildroot (self):
@@ -279,25 +520,27 @@ class SDCardBuilder:
       return True
 
    def make_buildroot (self):
-      draw.begin_wait(f'Recompiling "{self.br_version}" for board "{self.board_name}"...')
       begin = datetime.datetime.now()
-      code = os.system('make -C "{self.br_path}" 2> /dev/shm/br_errors')
-      if code >> 8 != 0:
-         draw.end_wait()
+      board = {'name': self.board_name, 'defconfig': f'{self.board_name}_defconfig'}
+      try:
+         jobs.run(f'Compile {self.br_version}, board {self.board_name}',
+            buildroot.compile_job, self.br_path, board, resource = os.path.abspath(self.br_path))
+      except (jobs.JobBusy, RuntimeError) as e:
          draw.message(('There was a problem compiling Buildroot.\n'
+            '\n'
+            f'{e}\n'
             '\n'
             'Unfortunately, you\'ll have to talk to Steven.'), colors = 10)
          return False
-      draw.end_wait()
       end = datetime.datetime.now()
-      dur = (end - start).total_seconds()
-      h, m, s = dur // 3600, (d // 60) % 60, int(d % 60)
+      dur = int((end - begin).total_seconds())
+      h, m, s = dur // 3600, (dur // 60) % 60, dur % 60
       draw.message((f'Success! That took {h} hours, {m} minutes and {s} seconds.\n'
          '\n'
          'Press ENTER to continue.'), colors = 11)
       return True
 
-   def build (self):
+   def locate (self):
       # Does it exist?
       if not os.path.exists(self.br_path):
          message = f'Buildroot version "{self.br_version}" cannot be found.'
@@ -312,6 +555,89 @@ class SDCardBuilder:
          draw.message(message, colors = 10)
          return False
 
+      return True
+
+   def boot_files (self):
+      # What goes on /boot, as [(path on the card, path here)]: the Pi
+      # firmware, the kernel, and the custom cmdline.txt and config.txt.
+      files = {}
+      for required in self.required_files:
+         # The root file system goes elsewhere.
+         if 'rootfs' in required: continue
+         name = os.path.basename(required)
+         if os.path.isdir(required):
+            for where, dirs, names in os.walk(required):
+               for n in names:
+                  path = os.path.join(where, n)
+                  files[f'{name}/{os.path.relpath(path, required)}'] = path
+         else:
+            files[name] = required
+
+      files['cmdline.txt'] = f'{self.cache_path}/../cmdline.txt'
+      files['config.txt'] = f'{self.cache_path}/../config.txt'
+      return sorted(files.items())
+
+   def boot_image (self):
+      # The FAT32 image of /boot, built the first time it's needed and
+      # again whenever any of its files change. Returns its path. Raises
+      # fat_image.FatError or OSError if it can't be made.
+      start, count, kind = partition_table.layout(self.make_partitioner().spec[:1], 1 << 40)[0]
+      files = self.boot_files()
+
+      digest = hashlib.sha1(f'{start} {count}\n'.encode('utf-8'))
+      for dest, src in files:
+         stat = os.stat(src)
+         digest.update(f'{dest} {src} {stat.st_size} {stat.st_mtime_ns}\n'.encode('utf-8'))
+
+      prefix = f'boot_{self.br_version}_{self.board_name}_'
+      path = f'{image_cache_dir}/{prefix}{digest.hexdigest()[:16]}.img'
+      if os.path.exists(path):
+         return path
+
+      os.makedirs(image_cache_dir, exist_ok = True)
+      for entry in os.scandir(image_cache_dir):
+         if entry.name.startswith(prefix):
+            os.remove(entry.path)
+
+      # The partition table says where the file system starts, and FAT
+      # likes to be told.
+      fat_image.write_image(f'{path}.tmp', files, count * partition_table.sector_size, hidden = start)
+      os.replace(f'{path}.tmp', path)
+      return path
+
+   def make_boot_image (self):
+      draw.begin_wait('Building the boot partition...')
+      try:
+         self.boot_image()
+      except (fat_image.FatError, IOError, OSError) as e:
+         draw.end_wait()
+         draw.message(f'Unable to build the boot partition.\n\nPython says: {e}', colors = 10)
+         return False
+      draw.end_wait()
+      return True
+
+   def write_boot (self, part, callback = None):
+      # Puts the /boot image on the card in one pass. Returns None if it
+      # worked, or what went wrong.
+      path = part.partition_path(0)
+      error = busy_error(path)
+      if error is not None:
+         return error
+      if not utils.claim_device(path):
+         return f'Unable to write directly to {path}.'
+
+      try:
+         utils.write_device_image(self.boot_image(), path, callback = callback)
+      except (fat_image.FatError, IOError, OSError) as e:
+         return str(e)
+      finally:
+         utils.release_device(path)
+      return None
+
+   def build (self):
+      if not self.locate():
+         return False
+
       # Does the SD card exist?
       result = self.find_sd_card()
       skip_part = False
@@ -323,96 +649,115 @@ class SDCardBuilder:
          # They canceled.
          return False
 
+      # Something in the background (making an image of the last card,
+      # say) might still be using it.
+      error = busy_error(self.dev)
+      if error is not None:
+         draw.message(error, colors = 10)
+         return False
+
+      # We'll need to see if the board has a cached final build.
+      if not self.prepare_buildroot():
+         return False
+
+      # Is there a golden image of the boot and root partitions we can use?
+      use_cache = config.get('image_cache') and not skip_part
+      golden = self.find_golden_image() if use_cache else None
+
       # Looks OK.
       # Let's do a wipe, then partition/format, then copy over all of the data.
-      if not skip_part:
+      if golden is not None:
+         if not self.write_golden_image(golden):
+            message = 'Something went wrong writing the cached image to the SD card.'
+            draw.message(message, colors = 10)
+            return False
+      elif not skip_part:
          if not self.prepare_sd_card():
-            message = f'Something went wrong preparing the SD card.'
+            message = 'Something went wrong preparing the SD card.'
             draw.message(message, colors = 10)
             return False
       else:
-         part = Partitioner()
+         part = Partitioner(self.dev)
          part.unmount_all()
 
-      # Okay, we found Buildroot, the board definition, the SD card,
-      # and the card has been cleared, partitioned and formatted.
-      # We'll need to see if the board has a cached final build.
-      if not self.prepare_buildroot():
+      # Every file system is built straight onto its partition, already
+      # owned by root and with the right modes, without mounting it.
+      part = Partitioner(self.dev)
+      if golden is None:
+         if not self.make_boot_image():
+            return False
+
+         draw.begin_wait('Writing the boot partition...')
+         error = self.write_boot(part, callback = utils.byte_progress(True))
+         utils.draw_progress(True, 0, clear = True)
+         draw.end_wait()
+         if error is not None:
+            draw.message(f'Unable to write the boot partition.\n\n{error}', colors = 10)
+            return False
+
+         if not self.unpack_rootfs():
+            return False
+         if not part.populate_partition(1, self.root_contents(), 'the root file system'):
+            return False
+      if not part.populate_partition(2, self.prog, 'the program files'):
+         return False
+      if not part.populate_partition(3, self.conf, 'the configuration files'):
          return False
 
-      # Mount our partitions.
+      # Mount what still gets changed file by file.
       draw.begin_wait('Mounting partitions...')
-      part = Partitioner()
-      boot_part = part.mount_partition(0, 'boot', is_vfat = True)
       root_part = part.mount_partition(1, 'root')
-      prog_part = part.mount_partition(2, 'prog')
-      conf_part = part.mount_partition(3, 'conf')
-      if not boot_part[0] or not root_part[0] or not prog_part[0] or not conf_part[0]:
-         draw.end_wait()
-         return False
-      boot_path, root_path, prog_path, conf_path = \
-         boot_part[1], root_part[1], prog_part[1], conf_part[1]
-      time.sleep(1.0)
       draw.end_wait()
+      if not root_part[0]:
+         return False
+      self.root_path = root_part[1]
 
-      self.boot_path = boot_path
-      self.root_path = root_path
-      self.prog_path = prog_path
-      self.conf_path = conf_path
+      # The cached image already has everything else on it.
+      if golden is not None:
+         return True
 
-      # Now we need to copy:
-      #  - Pi firmware
-      #  - Linux kernel
-      #  - Custom cmdline.txt and config.txt
-      #  - The root file system
+      # Keep a copy for next time?
+      # The card is done either way; a cache that couldn't be written only
+      # means the next card is built from scratch too.
+      if use_cache:
+         if not self.capture_golden_image():
+            log_debug(f'unable to cache a golden image from {self.dev}')
 
-      draw.begin_wait('Copying boot-up files...')
-      try:
-         for required in self.required_files:
-            # Don't copy the root file system; that's for later.
-            if 'rootfs' in required: continue
-            if os.path.isdir(required):
-               utils.copy_tree(required, boot_path.rstrip('/') + '/' + os.path.basename(required))
-            else:
-               shutil.copy(required, boot_path.rstrip('/') + '/' + os.path.basename(required))
-            time.sleep(0.25)
-
-         # Copy the cmdline.txt and config.txt files.
-         shutil.copy(f'{self.cache_path}/../cmdline.txt', f'{boot_path}/cmdline.txt')
-         shutil.copy(f'{self.cache_path}/../config.txt', f'{boot_path}/config.txt')
-      except (IOError, OSError, PermissionError) as e:
-         draw.message(f'Unable to copy required files.\n\nPython says: {e}', colors = 10)
-         return False
-      draw.end_wait()
+      # Looks good!
+      return True
 
-      # Un-tar the root file system
-      draw.begin_output(rows = 35, cols = 120, title = 'Decompressing Root File System')
-      proc = subprocess.Popen(
-         f'tar xvzf {self.cache_path}/rootfs.tar.gz -C {root_path}',
-         shell = True,
-         stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+   def root_contents (self):
+      return ext_image.Contents(tarball = f'{self.cache_path}/rootfs.tar.gz')
 
-      while True:
-         line = proc.stdout.readline()
-         if not line: break
-         draw.write_output(line.decode('utf-8'))
-         time.sleep(0.001)
+   def unpack_rootfs (self):
+      # Unpack rootfs.tar.gz for ext_image, unless that's been done since it
+      # last changed. Progress is measured in bytes and only redrawn a few
+      # times a second.
+      src = f'{self.cache_path}/rootfs.tar.gz'
+      draw.begin_wait('Decompressing root file system...')
+      begin = time.monotonic()
 
-      draw.end_output()
+      def progress (done, total, unpacked, name):
+         percent = (done / total) * 100.0 if total else 100.0
+         rate = unpacked / max(time.monotonic() - begin, 0.001)
+         utils.draw_progress(True, percent, border = True,
+            add_text = f'; {utils.format_size(unpacked, space = True)} unpacked at {utils.format_size(rate, space = True)}/s.')
 
-      draw.begin_wait('Synchronizing file systems...')
-      os.system('sync')
-      draw.end_wait()
+      try:
+         ext_image.unpack_tarball(src, callback = progress)
+      except (IOError, OSError, EOFError, tarfile.TarError) as e:
+         utils.draw_progress(False, 0, clear = True)
+         draw.end_wait()
+         draw.message(f'Unable to decompress the root file system.\n\nPython says: {e}', colors = 10)
+         return False
 
-      # Looks good!
+      utils.draw_progress(False, 0, clear = True)
+      draw.end_wait()
       return True
 
    def cleanup (self):
-      part = Partitioner()
-      if not part.unmount_partition('boot'): return False
+      part = Partitioner(self.dev)
       if not part.unmount_partition('root'): return False
-      if not part.unmount_partition('prog'): return False
-      if not part.unmount_partition('conf'): return False
       return True
 
 # This is for making a development card and doesn't actually put any
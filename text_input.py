@@ -196,7 +196,7 @@ def text_input (
       if need_draw or force_draw:
          redraw()
 
-      key = stdscr.getch()
+      key = draw.get_key(win)
 
       if key < 255:
          # ASCII escape?
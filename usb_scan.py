@@ -2,12 +2,13 @@
 
 import subprocess
 import os
-import json
-import time
 
 from menu import menu
 from __main__ import stdscr
 import draw
+import utils
+import devices
+import block_devices
 
 mount_dir = '/dev/shm/usb_device'
 
@@ -41,33 +42,17 @@ def unmount_device (dev):
 
    command = f'sudo umount "{mount_dir}" > /dev/null'
    result = subprocess.run(command, shell = True)
-   return result.returncode == 0
+   return result.returncode == 0 and devices.wait_unmounted(mount_dir, timeout = 5.0)
 
 def find_devices ():
-   # Ask lsblk for some fancy JSON output.
-   try:
-      command = 'lsblk -o NAME,FSTYPE,HOTPLUG,LABEL,TYPE,SUBSYSTEMS,SIZE -J'
-      result = subprocess.run(command, stdout = subprocess.PIPE, shell = True)
-      text = result.stdout.decode('utf-8')
-      data = json.loads(text)
-   except (ValueError, AttributeError):
-      # Return an error; we couldn't get device information.
-      return None
-
-   out = []
-   for dev in data['blockdevices']:
-      # Is this very likely a USB device?
-      if dev['type'] == 'disk' and dev['hotplug'] in ('1', True) and 'usb' in dev['subsystems']:
-         # It is.
-         dev['device'] = f'/dev/{dev["name"]}'
-         out.append(dev)
-
-   return out
+   # Every USB disk, as block_devices.Disk objects.
+   return [dev for dev in block_devices.disks() if dev.hotplug and dev.transport == 'usb']
 
 def select_device (can_skip = True, narrow_selection = True):
    def rescan ():
+      # Let udev finish with anything just plugged in, so we know it's USB.
       draw.begin_wait('Scanning for USB devices...')
-      time.sleep(0.5)
+      devices.settle(timeout = 3.0)
       devs = find_devices()
       draw.end_wait()
 
@@ -82,14 +67,14 @@ def select_device (can_skip = True, narrow_selection = True):
       else:
          items.append('-Device Name'.ljust(27) + 'Size'.ljust(16) + 'Label'.ljust(20))
          for dev in devs:
-            label = dev['label']
+            label = dev.label or next((part.label for part in dev.partitions if part.label), None)
             if not label or not len(label):
                # Empty label.
                label = '(No Label)'
 
-            name = f'Device /dev/{dev["name"]}'.ljust(26)
-            size = dev['size'].ljust(16)
-            items.append((name + size + label, f'/dev/{dev["name"]}'))
+            name = f'Device {dev.path}'.ljust(26)
+            size = utils.format_size(dev.size, suffix = '').ljust(16)
+            items.append((name + size + label, dev.path))
 
       return (items, devs)
 
@@ -97,7 +82,7 @@ def select_device (can_skip = True, narrow_selection = True):
    while True:
       # Narrow the selection down to just a single device?
       if narrow_selection and len(devs) == 1:
-         return devs[0]['device']
+         return devs[0].path
 
       try:
          sel = menu(menu_items, title = 'Select a USB Device')
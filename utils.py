@@ -8,15 +8,68 @@ import shutil
 import xml.etree.ElementTree as xml
 import xml.dom.minidom as dom
 import fnmatch
+import tarfile
+import threading
+import hashlib
+import fcntl
+import mmap
+import struct
+import pwd
+import re
+import concurrent.futures
 
 import config
 import gfx_chars
+import block_devices
 import draw
 from __main__ import stdscr
 
 ramdisk = '/dev/shm'
 storage_dir = '/mnt/storage'
 
+# How many times per second long-running jobs are allowed to redraw progress.
+progress_fps = 10
+
+# How many files copy_tree copies at once.
+copy_threads = 8
+
+# How many directories walk_files reads at once on the NAS.
+walk_threads = 8
+
+# Raw device copies move this much at a time.
+block_size = 4 * 1024 * 1024
+
+# ioctl(2) request number for BLKZEROOUT from <linux/fs.h>.
+blkzeroout = 0x127f
+
+class Throttle:
+   # Tells a busy loop when it's time to redraw, so the UI doesn't
+   # become the bottleneck of whatever it's reporting on.
+   def __init__ (self, fps = None):
+      self.interval = 1.0 / (progress_fps if fps is None else fps)
+      self.last = 0.0
+
+   def ready (self, force = False):
+      now = time.monotonic()
+      if force or now - self.last >= self.interval:
+         self.last = now
+         return True
+      return False
+
+class CountingReader:
+   # Wraps a file object and counts how many bytes have been read from it.
+   def __init__ (self, f):
+      self.f = f
+      self.count = 0
+
+   def read (self, size = -1):
+      data = self.f.read(size)
+      self.count += len(data)
+      return data
+
+   def close (self):
+      self.f.close()
+
 def is_nas_available ():
    # Figure out if we're connected to the NAS.
    code = os.system(f'mount | grep "{storage_dir}" > /dev/null 2>&1')
@@ -32,72 +85,308 @@ def is_nas_available ():
 
 def get_device_size (dev):
    # Find out how big the device is.
-   command = 'lsblk -bpo KNAME,SIZE -J'
-   result = subprocess.run(command, stdout = subprocess.PIPE, shell = True)
-   data = json.loads(result.stdout.decode('utf-8'))
-
-   for d in data['blockdevices']:
-      if d['kname'] == dev:
-         return int(d['size'])
+   node = block_devices.find(dev)
+   return node.size if node is not None else -1
+
+def create_disk_image (dev, dest, background = False):
+   # Image the card into a block-indexed .img.xz (see disk_image.py), only
+   # reading what the file systems on it actually use. With 'background',
+   # this returns straight away and the image is made as a job.
+   import disk_image
+   import jobs
+
+   if not claim_device(dev):
+      draw.message(f'Unable to read from {dev}.', colors = 10)
+      return False
 
-   return -1
+   if background:
+      # The job gives the device back when it's done.
+      try:
+         jobs.start(f'Image {dev} to {os.path.basename(dest)}', disk_image_job, dev, dest, resource = dev)
+      except jobs.JobBusy as e:
+         release_device(dev)
+         draw.message(f'Unable to image {dev} right now.\n\n{e}', colors = 10)
+         return False
+      return True
 
-def create_disk_image (dev, dest):
-   cmd = f'sudo dd if={dev} bs=8M status=progress | xz -z -T {config.get("compression_threads")} -e -9 -c - > {dest}'
-   size = get_device_size(dev)
-   proc = subprocess.Popen(
-      cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.PIPE, bufsize = 0)
-   progress = bytearray()
+   begin = time.monotonic()
 
-   while True:
-      ch = proc.stderr.read(1)
-      if not ch: break
-      progress += ch
+   def progress (done, total, read):
+      percent = (done / total) * 100.0 if total else 100.0
+      rate = read / max(time.monotonic() - begin, 0.001)
+      draw_progress(False, percent, border = True,
+         add_text = f'; {format_size(read, space = True)} read at {format_size(rate, space = True)}/s.')
 
-      if ch == b'\r' or ch == b'\n':
-         try:
-            parts = progress.decode('utf-8').strip().split()
-            written = int(parts[0])
-            speed = parts[-2] + ' ' + parts[-1]
-            percent = (written / size) * 100.0
-            draw_progress(False, percent, border = True, add_text = f'; {format_size(written, space = True)} read at {speed}.')
-            progress.clear()
-         except (TypeError, ValueError, IndexError):
-            pass
+   try:
+      disk_image.capture(dev, dest, threads = config.get('compression_threads', 4), callback = progress)
+   except (IOError, OSError, MemoryError) as e:
+      draw_progress(False, 0, border = True, clear = True)
+      draw.message(f'Unable to create an image of {dev}.\n\nPython says: {e}', colors = 10)
+      return False
+   finally:
+      release_device(dev)
 
    draw_progress(False, 0, border = True, clear = True)
+   return True
 
-def restore_disk_image (filename, dev):
-   pass
+def disk_image_job (job, dev, dest):
+   # create_disk_image's background half (see jobs.py); no drawing in here.
+   import disk_image
 
-def is_root_device (dev):
-   # Find the root device's real name
-   text = open('/proc/cmdline', 'r').read()
-   start = text.find('root=')
-   end = text.find(' ', start)
-   uuid = text[start+10:end].lower()
-
-   command = 'lsblk -o KNAME,UUID -J'
-   result = subprocess.run(command, stdout = subprocess.PIPE, shell = True)
-   data = json.loads(result.stdout.decode('utf-8'))
-   root_dev = None
-
-   for device in data['blockdevices']:
-      if device['uuid'] is not None and device['uuid'].lower() == uuid:
-         # This is the root device.
-         root_dev = device['kname']
-         break
+   begin = time.monotonic()
+
+   def progress (done, total, read):
+      percent = (done / total) * 100.0 if total else 100.0
+      rate = read / max(time.monotonic() - begin, 0.001)
+      job.progress(percent, f'{format_size(read, space = True)} read at {format_size(rate, space = True)}/s')
+
+   try:
+      disk_image.capture(dev, dest, threads = config.get('compression_threads', 4), callback = progress)
+   finally:
+      release_device(dev)
+   job.log(f'Saved {dest}. The card can be taken out now.')
+   return True
 
-   if root_dev is not None:
-      # Ditch the number on the end.
-      root_dev = root_dev[:-1]
+def partition_extent (part):
+   # Returns (offset, length) in bytes of a partition such as /dev/sda2,
+   # straight from sysfs. The kernel always counts in 512-byte sectors here.
+   name = os.path.basename(part)
+   try:
+      start = int(open(f'/sys/class/block/{name}/start', 'r').read())
+      size = int(open(f'/sys/class/block/{name}/size', 'r').read())
+   except (IOError, OSError, ValueError):
+      return None
+   return (start * 512, size * 512)
+
+def current_user ():
+   # Who we're running as. os.getlogin() wants a controlling terminal, which
+   # build_cli.py run from a scheduler doesn't have.
+   return pwd.getpwuid(os.geteuid()).pw_name
+
+# Device nodes claim_device() took over, as dev: [uid, gid, claims].
+claims = {}
+claim_lock = threading.Lock()
+
+def claim_device (dev):
+   # Raw block devices usually belong to root. Take ownership of the device
+   # node so we can read and write it directly instead of going through
+   # "sudo dd". Every claim needs a release_device() once the work's done,
+   # or the node stays ours for whatever card or disk turns up on it next.
+   with claim_lock:
+      if dev in claims:
+         claims[dev][2] += 1
+         return True
+      if os.access(dev, os.R_OK | os.W_OK):
+         return True
+      try:
+         info = os.stat(dev)
+         user = current_user()
+      except (OSError, KeyError):
+         return False
+      code = os.system(f'sudo chown {user} {dev} > /dev/null 2>&1')
+      if code >> 8 != 0:
+         return False
+      claims[dev] = [info.st_uid, info.st_gid, 1]
+      return True
 
-      if root_dev in dev:
-         # It's the root device or another device on the same disk.
+def release_device (dev):
+   # Gives the node back to whoever had it before claim_device().
+   with claim_lock:
+      claim = claims.get(dev)
+      if claim is None:
+         return
+      claim[2] -= 1
+      if claim[2] > 0:
+         return
+      del claims[dev]
+   os.system(f'sudo chown {claim[0]}:{claim[1]} {dev} > /dev/null 2>&1')
+
+def byte_progress (is_write, verb = None):
+   # Makes a callback for the copy functions below that draws the default
+   # progress bar along with a running MB/s figure.
+   if verb is None: verb = 'written' if is_write else 'read'
+   begin = time.monotonic()
+
+   def progress (done, total):
+      percent = (done / total) * 100.0 if total else 100.0
+      rate = done / max(time.monotonic() - begin, 0.001)
+      draw_progress(is_write, percent, border = True,
+         add_text = f'; {format_size(done, space = True)} {verb} at {format_size(rate, space = True)}/s.')
+
+   return progress
+
+def is_zero (view, zeros):
+   # Is this buffer nothing but zero bytes?
+   return view == zeros[:len(view)]
+
+def read_device_image (dev, dest, length, callback = None):
+   # Copy the first 'length' bytes of 'dev' into 'dest'. Runs of zero blocks
+   # become holes, so the file only takes up as much room as the data.
+   # Returns the SHA-256 of everything that was read.
+   block = block_size
+   digest = hashlib.sha256()
+   zeros = memoryview(bytes(block))
+   throttle = Throttle()
+   done = 0
+
+   with open(dev, 'rb', buffering = 0) as src, open(dest, 'wb') as out:
+      buf = bytearray(block)
+      view = memoryview(buf)
+      while done < length:
+         want = min(block, length - done)
+         got = src.readinto(view[:want])
+         if not got: break
+         chunk = view[:got]
+         digest.update(chunk)
+
+         if is_zero(chunk, zeros):
+            out.seek(got, os.SEEK_CUR)
+         else:
+            out.write(chunk)
+
+         done += got
+         if callable(callback) and throttle.ready():
+            callback(done, length)
+
+      # Make sure trailing holes still count towards the file size.
+      out.truncate(done)
+
+   if callable(callback):
+      callback(done, length)
+
+   return digest.hexdigest()
+
+def file_sha256 (path):
+   # SHA-256 of a whole file, the same as read_device_image() gives.
+   digest = hashlib.sha256()
+   buf = bytearray(block_size)
+   view = memoryview(buf)
+   with open(path, 'rb', buffering = 0) as f:
+      while True:
+         got = f.readinto(buf)
+         if not got: break
+         digest.update(view[:got])
+   return digest.hexdigest()
+
+class DirectWriter:
+   # Writes to a block device in large, aligned, O_DIRECT writes so the page
+   # cache stays out of the way. All-zero blocks are not sent over USB; the
+   # device is asked to zero them itself instead (BLKZEROOUT), which the
+   # kernel falls back to doing by hand if the card can't.
+   def __init__ (self, dev, block = None):
+      self.block = block_size if block is None else block
+      self.zeros = memoryview(bytes(self.block))
+
+      # O_DIRECT wants a page-aligned buffer; an anonymous mmap is one.
+      self.buf = mmap.mmap(-1, self.block)
+      self.view = memoryview(self.buf)
+
+      try:
+         self.fd = os.open(dev, os.O_WRONLY | getattr(os, 'O_DIRECT', 0))
+      except OSError:
+         # Some file systems (tmpfs, for one) won't do O_DIRECT.
+         self.fd = os.open(dev, os.O_WRONLY)
+
+   def write (self, offset, data):
+      # Write 'data' at 'offset'. Callers can save a copy by reading straight
+      # into self.view and passing a slice of it back.
+      length = len(data)
+      if not (isinstance(data, memoryview) and data.obj is self.buf):
+         self.view[:length] = data
+
+      # O_DIRECT needs whole sectors. Pad the tail with zeros.
+      size = (length + 511) & ~511
+      if size != length:
+         self.view[length:size] = self.zeros[:size - length]
+      chunk = self.view[:size]
+
+      if is_zero(chunk, self.zeros) and self.zero(offset, size):
+         return length
+
+      os.pwrite(self.fd, chunk, offset)
+      return length
+
+   def zero (self, offset, length):
+      # Ask the device to zero a range. Returns False if it can't (it's a
+      # plain file, say) and the zeros have to be written by hand.
+      try:
+         fcntl.ioctl(self.fd, blkzeroout, struct.pack('QQ', offset, length))
          return True
+      except OSError:
+         return False
 
-   # Probably not a root device.
-   return False
+   def close (self):
+      try:
+         os.fsync(self.fd)
+      finally:
+         os.close(self.fd)
+
+def write_device_image (src, dev, callback = None):
+   # Stream an image file onto the start of 'dev' in one sequential pass.
+   # Returns the number of bytes written.
+   length = os.path.getsize(src)
+   throttle = Throttle()
+   done = 0
+
+   writer = DirectWriter(dev)
+   try:
+      with open(src, 'rb', buffering = 0) as f:
+         while done < length:
+            got = f.readinto(writer.view)
+            if not got: break
+            writer.write(done, writer.view[:got])
+
+            done += got
+            if callable(callback) and throttle.ready():
+               callback(done, length)
+   finally:
+      writer.close()
+
+   if callable(callback):
+      callback(done, length)
+
+   return done
+
+def restore_disk_image (filename, dev):
+   # Write an image made by create_disk_image (or the old "dd | xz"
+   # pipeline) back onto a card, checking it as it goes.
+   import disk_image
+   import lzma
+   import jobs
+
+   # Something in the background might still be reading it.
+   busy = jobs.device_holder(dev)
+   if busy is not None:
+      draw.message(f'{dev} is still busy with "{busy.name}".\n\nWait for it to finish first.', colors = 10)
+      return False
+
+   if is_root_device(dev) or not claim_device(dev):
+      draw.message(f'Unable to write to {dev}.', colors = 10)
+      return False
+
+   begin = time.monotonic()
+
+   def progress (done, total, written):
+      percent = (done / total) * 100.0 if total else 100.0
+      rate = written / max(time.monotonic() - begin, 0.001)
+      draw_progress(True, percent, border = True,
+         add_text = f'; {format_size(written, space = True)} written at {format_size(rate, space = True)}/s.')
+
+   try:
+      disk_image.restore(filename, dev, threads = config.get('compression_threads', 4), callback = progress)
+   except (IOError, OSError, ValueError, EOFError, lzma.LZMAError) as e:
+      draw_progress(True, 0, border = True, clear = True)
+      draw.message(f'Unable to restore {os.path.basename(filename)} to {dev}.\n\nPython says: {e}', colors = 10)
+      return False
+   finally:
+      release_device(dev)
+
+   draw_progress(True, 0, border = True, clear = True)
+   return True
+
+def is_root_device (dev):
+   # Is this the disk we booted from, or a partition on it?
+   return block_devices.is_root_device(dev)
 
 def add_child (parent, tag, data = None, attrs = None):
    sub = xml.SubElement(parent, tag)
@@ -136,86 +425,350 @@ def format_size (num, suffix = 'B', space = False):
       num /= 1024.0
    return "%.1f%s%s%s" % (num, space, 'Y', suffix)
 
-def copy_tree (src, dst, ignore = None, callback = None):
+def copy_file (src, dst):
+   # Copy one file's data and permission bits, letting the kernel move the
+   # data (copy_file_range, then sendfile) where it can.
+   with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+      infd, outfd = fsrc.fileno(), fdst.fileno()
+      size = os.fstat(infd).st_size
+      copied = 0
+
+      try:
+         while copied < size:
+            n = os.copy_file_range(infd, outfd, size - copied)
+            if not n: break
+            copied += n
+      except (AttributeError, OSError):
+         # Not available, or not across these two file systems.
+         try:
+            while copied < size:
+               n = os.sendfile(outfd, infd, copied, size - copied)
+               if not n: break
+               copied += n
+         except OSError:
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+   shutil.copymode(src, dst)
+
+def copy_tree (src, dst, ignore = None, callback = None, threads = None):
+   # Copy a directory tree. The tree is listed once, every directory is
+   # created up front, and then the files are copied on a thread pool.
+   # Anything whose name matches one of the 'ignore' globs is skipped, at
+   # any depth.
+   #
+   # 'callback' is called at most progress_fps times per second with
+   # (bytes copied, total bytes, path of the last file copied).
    if not os.path.exists(src):
       raise FileNotFoundError(f'{src} does not exist.')
 
-   if not os.path.exists(dst):
-      os.mkdir(dst)
+   skip = None
+   if ignore:
+      skip = re.compile('|'.join(fnmatch.translate(item) for item in ignore))
+
+   # List everything first.
+   dirs = [dst.rstrip('/')]
+   files = []
+   total = 0
+   pending = [(src.rstrip('/'), dst.rstrip('/'))]
+   while pending:
+      src_dir, dst_dir = pending.pop()
+      for f in os.scandir(src_dir):
+         if skip is not None and skip.match(f.name): continue
+         target = dst_dir + '/' + f.name
+         if f.is_dir():
+            dirs.append(target)
+            pending.append((f.path, target))
+         else:
+            size = f.stat().st_size
+            files.append((f.path, target, size))
+            total += size
+
+   for d in dirs:
+      os.makedirs(d, exist_ok = True)
+
+   # Biggest files first keeps the pool busy to the end.
+   files.sort(key = lambda f: -f[2])
+   throttle = Throttle()
+   done = 0
+
+   with concurrent.futures.ThreadPoolExecutor(max_workers = threads or copy_threads) as pool:
+      jobs = {pool.submit(copy_file, s, d): (s, size) for s, d, size in files}
+      for job in concurrent.futures.as_completed(jobs):
+         job.result()
+         path, size = jobs[job]
+         done += size
+         if callable(callback) and throttle.ready():
+            callback(done, total, path)
+
+   if callable(callback):
+      callback(total, total, None)
+
+def extract_tarball (src, dest, callback = None, threads = None, transform = None):
+   # Unpack a .tar.gz into 'dest' in a single streaming pass instead of
+   # running "tar xvzf" and echoing every file name. If pigz is installed,
+   # it does the gzip decoding in its own process (and on its own threads)
+   # while we unpack; otherwise zlib does it in-process.
+   #
+   # 'callback' is called at most progress_fps times per second with
+   # (compressed bytes read, compressed size, bytes unpacked, member name).
+   # 'transform' gets every member first, and returns it (changed or not)
+   # or None to leave it out.
+   total = os.path.getsize(src)
+   throttle = Throttle()
+   unpacked = 0
+   proc = None
+   pump = None
+
+   raw = CountingReader(open(src, 'rb'))
+   pigz = shutil.which('pigz')
+
+   if pigz:
+      if threads is None: threads = config.get('compression_threads', 4)
+      proc = subprocess.Popen(
+         [pigz, '-d', '-c', '-p', str(threads)],
+         stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+         stderr = subprocess.DEVNULL, bufsize = 1 << 20)
 
-   for f in os.scandir(src):
-      skip = False
-      
-      if ignore is not None:
-         for item in ignore:
-            if fnmatch.fnmatch(f.name, item):
-               skip = True
+      def feed ():
+         # Keep pigz fed from a separate thread so we can count what
+         # it has been given.
+         try:
+            while True:
+               chunk = raw.read(1 << 20)
+               if not chunk: break
+               proc.stdin.write(chunk)
+         except (BrokenPipeError, OSError):
+            pass
+         finally:
+            try:
+               proc.stdin.close()
+            except (BrokenPipeError, OSError):
+               pass
+
+      pump = threading.Thread(target = feed, daemon = True)
+      pump.start()
+      tar = tarfile.open(fileobj = proc.stdout, mode = 'r|')
+   else:
+      tar = tarfile.open(fileobj = raw, mode = 'r|gz')
+
+   def members ():
+      nonlocal unpacked
+      for member in tar:
+         if transform is not None:
+            member = transform(member)
+            if member is None: continue
+         unpacked += member.size
+         if callable(callback) and throttle.ready():
+            callback(raw.count, total, unpacked, member.name)
+         yield member
+
+   options = {}
+   if hasattr(tarfile, 'fully_trusted_filter'):
+      # A root file system is full of absolute symlinks and device nodes,
+      # which the newer default extraction filters refuse to create.
+      options['filter'] = 'fully_trusted'
 
-      if skip: continue
+   try:
+      with tar:
+         tar.extractall(dest, members = members(), **options)
+   finally:
+      if proc is not None:
+         proc.stdout.close()
+         proc.wait()
+         pump.join()
+      raw.close()
+
+   if proc is not None and proc.returncode != 0:
+      raise tarfile.ReadError(f'pigz exited with code {proc.returncode} while reading {src}.')
+
+   if callable(callback):
+      callback(total, total, unpacked, None)
+
+   return unpacked
+
+def file_entry (name, path, where, size, timestamp):
+   # What find_files() tells about each file it finds.
+   return {
+      'name': name,
+      'path': path,
+      'dir': where,
+      'size': size,
+      'size_str': format_size(size),
+      'date': datetime.datetime.fromtimestamp(timestamp),
+      'timestamp': timestamp,
+      'is_debounce': 'debounce' in path.lower(),
+      'is_bootloader': 'bootloader' in path.lower(),
+      'is_main': not any(('debounce' in where.lower(), 'bootloader' in where.lower())),
+      'is_header': path.endswith('.h')
+   }
+
+def file_matcher (name, compare = None):
+   # Turns find_files()'s 'name' and 'compare' into a test of a file name,
+   # once, rather than on every directory.
+   if callable(compare):
+      return compare
+
+   name = name.lower()
+   if compare is None:
+      return lambda x: x.lower() == name
+   elif compare == 'endswith':
+      return lambda x: x.lower().endswith(name)
+   elif compare == 'startswith':
+      return lambda x: x.lower().startswith(name)
+   elif compare == 'contains':
+      return lambda x: name in x.lower()
+   raise ValueError(f'Unknown comparison "{compare}".')
+
+class FoundFile:
+   # A file walk_files() found. It isn't stat()ed until someone asks.
+   __slots__ = ('name', 'path', 'dir', 'info')
+
+   def __init__ (self, name, path, where):
+      self.name = name
+      self.path = path
+      self.dir = where
+      self.info = None
+
+   def stat (self):
+      if self.info is None:
+         self.info = os.stat(self.path)
+      return self.info
+
+def read_dir (path):
+   # Returns the names of the (subdirectories, files) in 'path'.
+   dirs = []
+   files = []
+   with os.scandir(path) as entries:
+      for entry in entries:
+         (dirs if entry.is_dir() else files).append(entry.name)
+   return dirs, files
+
+class WalkCache:
+   # Remembers directory listings along with the directory's mtime, so that
+   # walk_files() only has to read the directories that changed. Give it a
+   # file name to keep it from one run to the next.
+   def __init__ (self, filename = None):
+      self.filename = filename
+      self.lock = threading.Lock()
+      self.dirs = {}
+
+      if filename is not None:
+         try:
+            with open(filename, 'r') as f:
+               self.dirs = json.load(f)
+         except (IOError, OSError, ValueError):
+            pass
 
-      if f.is_dir():
-         copy_tree(f.path, dst.rstrip('/') + '/' + f.name)
-      else:
-         if callable(callback):
-            callback(f.path, dst.rstrip('/') + '/' + f.name)
-         shutil.copy(f.path, dst.rstrip('/') + '/' + f.name)
-
-def sub_find_files (data, where, name, compare):
-   # Only decide the comparison type once.
-   if not callable(compare):
-      if compare is None: 
-         compare = lambda x: x.lower() == name.lower()
-      elif compare == 'endswith': 
-         compare = lambda x: x.lower().endswith(name.lower())
-      elif compare == 'startswith':
-         compare = lambda x: x.lower().startswith(name.lower())
-      elif compare == 'contains':
-         compare = lambda x: x.lower() in name.lower()
-
-   if not os.path.isdir(where): return
-
-   for entry in os.scandir(where):
-      # Did we find a subdirectory to scan?
-      if entry.is_dir():
-         sub_find_files(data, entry.path, name, compare)
-
-      elif compare(entry.name):
-         stat = entry.stat()
-         data.append({
-            'name': entry.name,
-            'path': entry.path,
-            'dir': where,
-            'size': stat.st_size,
-            'size_str': format_size(stat.st_size),
-            'date': datetime.datetime.fromtimestamp(stat.st_mtime),
-            'timestamp': stat.st_mtime,
-            'is_debounce': 'debounce' in entry.path.lower(),
-            'is_bootloader': 'bootloader' in entry.path.lower(),
-            'is_main': not any(('debounce' in where.lower(), 'bootloader' in where.lower())),
-            'is_header': entry.path.endswith('.h')
-         })
-
-def find_files (where, name, compare = None):
+   def listing (self, path):
+      stamp = os.stat(path).st_mtime_ns
+      with self.lock:
+         cached = self.dirs.get(path)
+      if cached is not None and cached[0] == stamp:
+         return cached[1], cached[2]
+
+      dirs, files = read_dir(path)
+
+      # Something could change in the same clock tick we read it in without
+      # moving the mtime, so a listing that fresh isn't trusted next time.
+      if time.time_ns() - stamp > 2 * 10 ** 9:
+         with self.lock:
+            self.dirs[path] = (stamp, dirs, files)
+      return dirs, files
+
+   def save (self):
+      if self.filename is None:
+         return
+      with self.lock:
+         data = dict(self.dirs)
+      os.makedirs(os.path.dirname(self.filename) or '.', exist_ok = True)
+      temp = f'{self.filename}.{os.getpid()}.tmp'
+      with open(temp, 'w') as f:
+         json.dump(data, f)
+      os.replace(temp, self.filename)
+
+def on_storage (path):
+   # Is 'path' on the NAS?
+   storage = os.path.realpath(storage_dir)
+   path = os.path.realpath(path)
+   return path == storage or path.startswith(storage + '/')
+
+def walk_files (where, match = None, cache = None, threads = None):
+   # Yields a FoundFile for every file under 'where' that 'match' accepts
+   # the name of (every file, without one). 'cache' is a WalkCache. With
+   # more than one thread, each directory at the top of the tree is walked
+   # on its own; that's the default on the NAS, where every directory read
+   # is a round trip.
+   listing = cache.listing if cache is not None else read_dir
+   if threads is None:
+      threads = walk_threads if on_storage(where) else 1
+
+   def walk (top):
+      stack = [top]
+      while len(stack):
+         path = stack.pop()
+         try:
+            dirs, files = listing(path)
+         except OSError:
+            # Not there (any more), or not a directory at all.
+            continue
+
+         for name in files:
+            if match is None or match(name):
+               yield FoundFile(name, os.path.join(path, name), path)
+         stack.extend(os.path.join(path, name) for name in reversed(dirs))
+
+   if threads <= 1:
+      yield from walk(where)
+      return
+
+   try:
+      dirs, files = listing(where)
+   except OSError:
+      return
+
+   for name in files:
+      if match is None or match(name):
+         yield FoundFile(name, os.path.join(where, name), where)
+
+   with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as pool:
+      futures = [pool.submit(lambda top: list(walk(top)), os.path.join(where, name)) for name in dirs]
+      for future in futures:
+         yield from future.result()
+
+def find_files (where, name, compare = None, cache = None, threads = None):
    data = []
-   sub_find_files(data, where, name, compare)
+   for found in walk_files(where, file_matcher(name, compare), cache = cache, threads = threads):
+      try:
+         stat = found.stat()
+      except OSError:
+         # Gone since we saw it.
+         continue
+      data.append(file_entry(found.name, found.path, found.dir, stat.st_size, stat.st_mtime))
    return data
 
 def combine_hexes (one, two, out = None):
+   # Merges two HEX files (usually a program and its bootloader) and
+   # returns (success, filename). Unless 'out' is given, the file gets a
+   # name of its own in the RAM disk, so builds running side by side never
+   # collide; whoever asked for it removes it once it's been programmed.
+   import hexfile
+   import tempfile
+
+   made = None
    try:
-      if out is None: out = f'{ramdisk}/combined.hex'
-
-      if os.path.exists(out):
-         os.remove(out)
-
-      result = subprocess.run(
-         f'srec_cat "{one}" -I "{two}" -I -o "{out}" -I',
-         shell = True, 
-         stdout = subprocess.DEVNULL,
-         stderr = subprocess.DEVNULL)
-      
-      return (result.returncode == 0, out)
-   except (IOError, OSError, PermissionError):
-      return False
+      image = hexfile.HexImage.read(one).merge(hexfile.HexImage.read(two))
+      if out is None:
+         fd, out = tempfile.mkstemp(prefix = f'combined_{image.digest()[:16]}_', suffix = '.hex', dir = ramdisk)
+         os.close(fd)
+         made = out
+      image.write(out)
+      return (True, out)
+   except (IOError, OSError, hexfile.HexError):
+      if made is not None and os.path.exists(made):
+         os.remove(made)
+      return (False, None)
 
 def draw_progress (is_write, percent, clear = False, border = True, places = 1, add_text = None):
    # Used by avrdude_command below to draw a default progress bar.
@@ -260,13 +813,140 @@ def draw_progress (is_write, percent, clear = False, border = True, places = 1,
 
    stdscr.refresh()
 
-def avrdude_command (device, target, data, run = False, speed = None, progress = True):
+class AvrdudeParser:
+   # Turns avrdude's stderr into events, a chunk at a time:
+   #    ('signature', '1e9801')
+   #    ('phase', is_write)            a progress bar started
+   #    ('percent', is_write, percent) it moved
+   #    ('wrong_chip', line)           a real chip answered, but not the
+   #                                   expected one
+   #    ('mismatch', line)             a verify failed
+   #    ('error', line)                anything else avrdude complained about
+   # Progress bars are 50 '#' characters between two '|'s and are drawn a
+   # character at a time, so they're followed as they arrive. Everything
+   # else is looked at a line at a time.
+   bar = re.compile(rb'(Reading|Writing) \|')
+   signature = re.compile(rb'Device signature = (?:0x)?([0-9a-fA-F ]+)')
+
+   # What comes back when nothing sensible answered, usually because the
+   # ISP clock is too fast for the chip. A slower one may well work.
+   no_signature = ('000000', 'ffffff')
+
+   def __init__ (self):
+      self.buf = b''
+      self.phase = None
+      self.hashes = 0
+      self.last_signature = None
+
+   def feed (self, chunk):
+      self.buf += chunk
+      events = []
+
+      while len(self.buf):
+         if self.phase is not None:
+            # In a progress bar; it ends at the next '|', or the end of
+            # the line if avrdude gave up part way.
+            ends = [n for n in (self.buf.find(b'|'), self.buf.find(b'\n')) if n >= 0]
+            end = min(ends) if len(ends) else -1
+            part = self.buf if end < 0 else self.buf[:end]
+            count = part.count(b'#')
+            if count:
+               self.hashes += count
+               events.append(('percent', self.phase, min(self.hashes * 2, 100)))
+            if end < 0:
+               self.buf = b''
+               break
+            self.buf = self.buf[end + 1:]
+            self.phase = None
+            continue
+
+         match = self.bar.search(self.buf)
+         if match is not None:
+            events += self.lines(self.buf[:match.start()])
+            self.buf = self.buf[match.end():]
+            self.phase = match.group(1) == b'Writing'
+            self.hashes = 0
+            events.append(('phase', self.phase))
+            continue
+
+         # Keep any unfinished line, which might be the start of a bar.
+         end = max(self.buf.rfind(b'\n'), self.buf.rfind(b'\r'))
+         if end >= 0:
+            events += self.lines(self.buf[:end + 1])
+            self.buf = self.buf[end + 1:]
+         break
+
+      return events
+
+   def close (self):
+      events = self.lines(self.buf) if self.phase is None else []
+      self.buf = b''
+      return events
+
+   def lines (self, data):
+      events = []
+      for line in data.replace(b'\r', b'\n').split(b'\n'):
+         line = line.strip()
+         if not line: continue
+
+         match = self.signature.search(line)
+         text = line.decode('utf-8', 'replace')
+         lower = text.lower()
+         if match is not None:
+            self.last_signature = match.group(1).replace(b' ', b'').decode('ascii').lower()
+            events.append(('signature', self.last_signature))
+         elif 'expected signature' in lower or 'invalid device signature' in lower:
+            if self.last_signature is not None and self.last_signature not in self.no_signature:
+               events.append(('wrong_chip', text))
+            else:
+               events.append(('error', text))
+         elif 'verification error' in lower or 'mismatch' in lower:
+            events.append(('mismatch', text))
+         elif 'error' in lower:
+            events.append(('error', text))
+      return events
+
+# What avrdude_command() returns when, in verbose mode, the command it was
+# about to run was turned down. It isn't 0: nothing was checked or written.
+avrdude_declined = -1
+
+def avrdude_command (device, target, data, run = False, speed = None, progress = True, port = None, on_event = None):
    # Craft an avrdude command that will program 'target' with
    # 'data'. If 'fuse' is in the target, handle that specially.
+   #
+   # 'target' can also be a list of (target, data) pairs, which are all
+   # done in one avrdude session (and so one handshake) at 'speed'. A pair
+   # can be given a third item of 'v' to only verify that memory.
+   #
+   # While it runs with progress, 'on_event' (if given) gets every
+   # AvrdudeParser event, ending with ('status', return code).
 
    logfile = f'{ramdisk}/avrdude.log'
 
-   if target is None:
+   if isinstance(target, (list, tuple)):
+      # Automatic verification has to be off for the fuses' sake (see
+      # below), so memories get an explicit verify instead. So do the low
+      # and high fuses, which decide the chip's clock; a bad one written at
+      # a marginal ISP clock has to fail the session. (The extended fuse's
+      # unused bits don't always read back as written, so it can't be.)
+      ops = ['-s -V']
+      for op in target:
+         memory, value = op[:2]
+         if len(op) > 2 and op[2] == 'v':
+            # Only compare what's there with 'value'; write nothing.
+            if 'fuse' in memory:
+               ops.append(f'-U {memory}:v:0x{int(value):02X}:m')
+            else:
+               ops.append(f'-U {memory}:v:{value}:i')
+         elif 'fuse' in memory:
+            ops.append(f'-U {memory}:w:0x{int(value):02X}:m')
+            if memory in ('lfuse', 'hfuse'):
+               ops.append(f'-U {memory}:v:0x{int(value):02X}:m')
+         else:
+            ops.append(f'-U {memory}:w:{value}:i -U {memory}:v:{value}:i')
+      target = ' '.join(ops)
+      speed = '-B 0.1' if speed is None else f'-B {speed}'
+   elif target is None:
       # Likely a connectivity check.
       target = ''
       speed = '-B 128'
@@ -280,13 +960,15 @@ def avrdude_command (device, target, data, run = False, speed = None, progress =
       speed = '-B 0.1' if speed is None else f'-B {speed}'
 
    import config
-   port = config.data['port']
+   if port is None:
+      port = config.data['port']
    command = f'avrdude -c stk500v2 -P {port} -p {device} {speed} {target}'
 
-   if config.data['verbose']:
+   # Only the main thread can ask questions.
+   if config.data['verbose'] and threading.current_thread() is threading.main_thread():
       result = draw.question('AVRdude command:\n\n' + command + '\n\nRun it?', default = 0, escape = 1)
       if result == 'N':
-         return 0
+         return avrdude_declined
 
    # Run it?
    if run:
@@ -306,63 +988,46 @@ def avrdude_command (device, target, data, run = False, speed = None, progress =
       # own progress bar slightly lower than screen center.
 
       proc = subprocess.Popen(
-         command, shell = True, 
-         stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+         command, shell = True,
+         stdout = subprocess.DEVNULL, stderr = subprocess.PIPE,
          bufsize = 0)
 
-      state_detect = bytearray()
+      parser = AvrdudeParser()
+      fd = proc.stderr.fileno()
       ok = False
-      in_read = False
-      in_write = False
-      read_pct = 0
-      write_pct = 0
-
-      while True:
-         ch = proc.stderr.read(1)
-         if not ch: break
 
-         # Store the last 20 characters we've read.
-         state_detect += ch
-         if len(state_detect) > 20:
-            state_detect = state_detect[1:]
+      def handle (event):
+         nonlocal ok
+         if callable(on_event):
+            on_event(event)
 
-         # Have we passed the device signature stuff?
-         if 'Device signature'.encode('ascii') in state_detect:
+         # Progress bars before the signature are just avrdude starting up.
+         if event[0] == 'signature':
             ok = True
-
-         if not ok: continue
-
-         # We have. Detect a read or write.
-         if 'Reading |'.encode('ascii') in state_detect:
-            in_read = True
-            in_write = False
-
-         if 'Writing |'.encode('ascii') in state_detect:
-            in_write = True
-            in_read = False
-
-         if in_read and ch == b'#':
-            read_pct += 2
+         elif event[0] == 'percent' and ok:
             if callable(progress):
-               progress(False, read_pct)
+               progress(event[1], event[2])
             elif progress:
-               draw_progress(False, read_pct)
+               draw_progress(event[1], event[2])
 
-         if in_write and ch == b'#':
-            write_pct += 2
-            if callable(progress):
-               progress(True, write_pct)
-            elif progress:
-               draw_progress(True, write_pct)
+      while True:
+         chunk = os.read(fd, 4096)
+         if not chunk: break
+         for event in parser.feed(chunk):
+            handle(event)
+
+      for event in parser.close():
+         handle(event)
 
-      # end while
+      proc.stderr.close()
       proc.wait()
+      handle(('status', proc.returncode))
 
       # Clear the progress bar area if we need to.
       if not callable(progress) and progress:
          draw_progress(False, 0, clear = True)
 
-      return 0 # TODO: proc.returncode
+      return proc.returncode
 
    # We didn't run it; maybe someone else will.
    return command
@@ -419,7 +1084,7 @@ def avrdude_connect (device, message = None, allow_skip = False):
       ret = avrdude_command(device, None, None, run = True, progress = False)
       draw.end_wait()
 
-      if ret != 0:
+      if ret != 0 and ret != avrdude_declined:
          result = draw.question((
             f'Unable to communicate with CPU ({device}).'
             '\n'